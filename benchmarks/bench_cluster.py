@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import logging
+
+from pathlib import Path
+
+# Runnable from a checkout, without rtestnet installed
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import fake_cloud as fake
+
+from rtestnet.cluster import ClusterContext, ClusterCtl
+from rtestnet.cluster.node import scheduler
+
+# Drives ClusterCtl (directly or through the HTTP API) against the
+# in-memory fake cloud and reports throughput, completion latency, cloud
+# API call counts and peak RSS. Example:
+#
+#   python benchmarks/bench_cluster.py -n 10,100,1000 --latency 0.05 \
+#       --op-duration 1
+
+_NODE_CONFIG = {
+    'gce_zone': 'fake-zone-a',
+    'gce_machine_type': 'n1-standard-1',
+    'gce_boot_image': 'rnode',
+    'gce_vpc_net': 'default',
+    'gce_vpc_subnet': 'default',
+    'gce_tags': ['rnode'],
+    'gdns_zone': 'fake-dns-zone',
+    'gdns_domain': 'bench.example.',
+    'data_disk_size': 10,
+}
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        '-n',
+        '--nodes',
+        default='10,100,1000',
+        help='Comma separated fleet sizes'
+    )
+    parser.add_argument(
+        '-w',
+        '--workloads',
+        default='start,restart,stop',
+        help='Comma separated actions, run in order on each fleet'
+    )
+    parser.add_argument(
+        '-m',
+        '--mode',
+        default='dispatch',
+        choices=['dispatch', 'http'],
+        help='Call ClusterCtl.dispatch directly or go through the Quart app'
+    )
+    parser.add_argument(
+        '-j',
+        '--job-workers',
+        default=256,
+        type=int,
+        help='Size of the thread job engine pool'
+    )
+    parser.add_argument('--latency', default=0.0, type=float)
+    parser.add_argument('--op-duration', default=0.0, type=float)
+    parser.add_argument('--failure-rate', default=0.0, type=float)
+    parser.add_argument('--quota-rate', default=0.0, type=float)
+    parser.add_argument('--seed', default=None, type=int)
+    parser.add_argument(
+        '--api-quotas',
+        default='compute.read=0,compute.write=0,dns.read=0,dns.write=0',
+        help='Client-side API rate limits (see ' + scheduler.QUOTAS_ENV +
+        '), unlimited by default'
+    )
+    parser.add_argument(
+        '--json', action='store_true', help='Print results as JSON lines'
+    )
+
+    return parser
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def _setup_conf_dir(root: Path, n: int):
+    (root / 'config.json').write_text(json.dumps(_NODE_CONFIG))
+    nodes = [f'node{i:04d}' for i in range(n)]
+    for node in nodes:
+        (root / node).mkdir()
+    return nodes
+
+
+async def _submit_dispatch(ctl, req):
+    return await ctl.dispatch(req)
+
+
+async def _submit_http(client, ctl, req):
+    response = await client.post(
+        f'/cluster/control/nodes/{req["node"]}/{req["action"]}'
+    )
+    if response.status_code != 202:
+        raise RuntimeError(f'HTTP {response.status_code} for {req}')
+    return ctl.get_job((await response.get_json())['id'])
+
+
+async def run_workload(ctl, submit, nodes, action, cloud):
+    calls_before = sum(cloud.calls.values())
+    start = time.monotonic()
+    latencies = []
+    failed = 0
+
+    async def one(node):
+        nonlocal failed
+        t0 = time.monotonic()
+        job = await submit({'node': node, 'action': action, 'args': {}})
+        await asyncio.wait([job.done])
+        latencies.append(time.monotonic() - t0)
+        if job.done.cancelled() or job.done.result() != 0:
+            failed += 1
+
+    await asyncio.gather(*[one(node) for node in nodes])
+    elapsed = time.monotonic() - start
+    return {
+        'nodes': len(nodes),
+        'action': action,
+        'seconds': round(elapsed, 3),
+        'jobs_per_sec': round(len(nodes) / elapsed, 1),
+        'p50': round(_percentile(latencies, 50), 3),
+        'p99': round(_percentile(latencies, 99), 3),
+        'failed': failed,
+        'api_calls': sum(cloud.calls.values()) - calls_before,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+async def run_fleet(args, n):
+    cloud = fake.install(
+        fake.FakeCloud(
+            latency=args.latency,
+            op_duration=args.op_duration,
+            failure_rate=args.failure_rate,
+            quota_rate=args.quota_rate,
+            seed=args.seed
+        )
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        nodes = _setup_conf_dir(Path(tmp), n)
+        ctl = ClusterCtl(
+            ClusterContext(
+                tmp, job_engine='thread', job_workers=args.job_workers
+            )
+        )
+        if args.mode == 'http':
+            from rtestnet.cluster import api
+            api.cluster = ctl
+            client = api.app.test_client()
+            submit = lambda req: _submit_http(client, ctl, req)
+        else:
+            submit = lambda req: _submit_dispatch(ctl, req)
+        results = []
+        for action in args.workloads.split(','):
+            results.append(
+                await run_workload(ctl, submit, nodes, action, cloud)
+            )
+        ctl._engine.close()
+    fake.uninstall()
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    args = create_arg_parser().parse_args()
+    os.environ[scheduler.QUOTAS_ENV] = args.api_quotas
+    for n in [int(x) for x in args.nodes.split(',')]:
+        for result in asyncio.run(run_fleet(args, n)):
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(
+                    '{nodes:5d} {action:8s} {seconds:8.3f}s '
+                    '{jobs_per_sec:8.1f} jobs/s p50={p50:.3f}s '
+                    'p99={p99:.3f}s failed={failed} api_calls={api_calls} '
+                    'peak_rss={peak_rss_mb}MB'.format(**result)
+                )
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
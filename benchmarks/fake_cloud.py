@@ -0,0 +1,416 @@
+import re
+import time
+import random
+import itertools
+import threading
+
+from collections import Counter
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+
+from libcloud.common.google import (
+    GoogleBaseError, ResourceExistsError, ResourceNotFoundError
+)
+
+from rtestnet.cluster.node import gce
+
+# In-memory stand-in for the GCE compute and Cloud DNS drivers NodeOpsGCE
+# uses, for benchmarks and local experiments. State lives in the process
+# that created the FakeCloud, so it must be used with the 'thread' job
+# engine.
+
+
+@dataclass
+class FakeCloud:
+    # Seconds added to every API call (uniformly jittered by +-50%)
+    latency: float = 0.0
+    # Seconds a zone operation stays RUNNING (also how long create_node
+    # blocks)
+    op_duration: float = 0.0
+    # Probability of a call failing with a backend error
+    failure_rate: float = 0.0
+    # Probability of a call being rejected with rateLimitExceeded
+    quota_rate: float = 0.0
+    seed: int = None
+
+    calls: Counter = field(default_factory=Counter)
+
+    def __post_init__(self):
+        self._lock = threading.RLock()
+        self._random = random.Random(self.seed)
+        self._op_ids = itertools.count(1)
+        self.instances = {}
+        self.disks = {}
+        self.snapshots = {}
+        self.addresses = {}
+        self.records = {}
+        self.operations = {}
+        self._effects = []
+
+    def call(self, api: str, method: str):
+        with self._lock:
+            self.calls[f'{api}.{method}'] += 1
+            r = self._random.random()
+            delay = self.latency * (0.5 + self._random.random())
+        if delay:
+            time.sleep(delay)
+        if r < self.quota_rate:
+            raise GoogleBaseError(
+                'Rate Limit Exceeded', 403, 'rateLimitExceeded'
+            )
+        if r < self.quota_rate + self.failure_rate:
+            raise GoogleBaseError('Backend Error', 500, 'backendError')
+        self.settle()
+
+    def settle(self):
+        # Applies effects of operations whose time has come
+        now = time.monotonic()
+        with self._lock:
+            due = [e for e in self._effects if e[0] <= now]
+            self._effects = [e for e in self._effects if e[0] > now]
+            for _, op, effect in due:
+                effect()
+                op['status'] = 'DONE'
+                op['progress'] = 100
+
+    def operation(self, zone: str, kind: str, target: str, effect):
+        with self._lock:
+            op = {
+                'name': f'operation-{next(self._op_ids)}',
+                'zone': zone,
+                'operationType': kind,
+                'targetLink': target,
+                'status': 'RUNNING',
+                'progress': 0,
+            }
+            self.operations[op['name']] = op
+            self._effects.append(
+                (time.monotonic() + self.op_duration, op, effect)
+            )
+        self.settle()
+        return dict(op)
+
+
+def _not_found(kind, name):
+    return ResourceNotFoundError(
+        f'The resource \'{kind}/{name}\' was not found', 404, 'notFound'
+    )
+
+
+class _FakeConnection:
+    _PATHS = [
+        ('POST', r'/zones/([^/]+)/disks', '_insert_disk'),
+        (
+            'POST', r'/zones/([^/]+)/disks/([^/]+)/createSnapshot',
+            '_create_snapshot'
+        ),
+        ('POST', r'/zones/([^/]+)/instances/([^/]+)/(\w+)', '_instance_op'),
+        ('GET', r'/zones/([^/]+)/operations', '_list_operations'),
+    ]
+
+    def __init__(self, driver, api='compute'):
+        self.driver = driver
+        self.cloud = driver.cloud
+        self.api = api
+
+    def request(self, action, method='GET', data=None, params=None, **kw):
+        if not action.startswith('/'):
+            # The one request a fake driver method stands for
+            self.cloud.call(self.api, action)
+            return None
+        self.cloud.call(self.api, f'{method} {action}')
+        for m, pattern, handler in self._PATHS:
+            match = re.fullmatch(pattern, action)
+            if m == method and match:
+                obj = getattr(self, handler)(*match.groups(), data, params)
+                return SimpleNamespace(object=obj, status=200)
+        raise GoogleBaseError(f'Unsupported {method} {action}', 400, 'fake')
+
+    def _insert_disk(self, zone, data, params):
+        source = data.get('sourceSnapshot')
+        if source and source.rsplit('/', 1)[-1] not in self.cloud.snapshots:
+            raise _not_found('snapshots', source)
+        disk = SimpleNamespace(
+            name=data['name'],
+            size=data['sizeGb'],
+            extra={
+                'selfLink': f'zones/{zone}/disks/{data["name"]}',
+                'type': data['type'],
+                'sourceSnapshot': data.get('sourceSnapshot'),
+                'sourceImage': data.get('sourceImage'),
+            }
+        )
+
+        def create():
+            self.cloud.disks[disk.name] = disk
+
+        return self.cloud.operation(
+            zone, 'insert', disk.extra['selfLink'], create
+        )
+
+    def _create_snapshot(self, zone, disk_name, data, params):
+        disk = self.cloud.disks.get(disk_name)
+        if not disk:
+            raise _not_found('disks', disk_name)
+        with self.cloud._lock:
+            if data['name'] in self.cloud.snapshots:
+                raise ResourceExistsError(
+                    f'The resource \'snapshots/{data["name"]}\' already '
+                    'exists', 409, 'alreadyExists'
+                )
+            snapshot = SimpleNamespace(
+                name=data['name'],
+                size=disk.size,
+                status='CREATING',
+                extra={
+                    'selfLink': f'global/snapshots/{data["name"]}',
+                    'creationTimestamp': datetime.now(timezone.utc)
+                    .isoformat(timespec='microseconds'),
+                    'sourceDisk': disk.extra['selfLink'],
+                }
+            )
+            self.cloud.snapshots[snapshot.name] = snapshot
+
+        def ready():
+            snapshot.status = 'READY'
+
+        return self.cloud.operation(
+            zone, 'createSnapshot', disk.extra['selfLink'], ready
+        )
+
+    def _instance_op(self, zone, name, verb, data, params):
+        vm = self.cloud.instances.get(name)
+        if not vm:
+            raise _not_found('instances', name)
+        statuses = {
+            'stop': 'TERMINATED',
+            'start': 'RUNNING',
+            'suspend': 'SUSPENDED',
+            'resume': 'RUNNING',
+        }
+
+        def apply():
+            if verb == 'attachDisk':
+                vm.extra['disks'].append(dict(data))
+            elif verb == 'setLabels':
+                vm.extra['labels'] = dict(data['labels'])
+            else:
+                vm.extra['status'] = statuses[verb]
+                vm.state = statuses[verb].lower()
+
+        if verb not in statuses and verb not in ('attachDisk', 'setLabels'):
+            raise GoogleBaseError(f'Unsupported {verb}', 400, 'fake')
+        return self.cloud.operation(zone, verb, vm.extra['selfLink'], apply)
+
+    def _list_operations(self, zone, data, params):
+        expr = (params or {}).get('filter', '')
+        names = re.findall(r'name = "([^"]+)"', expr)
+        with self.cloud._lock:
+            ops = self.cloud.operations
+            return {'items': [dict(ops[n]) for n in names if n in ops]}
+
+
+def _request(connection, method: str):
+    # Fake driver methods make a single request, scheduled like a real one
+    http_method = 'GET' if gce._request_class(method) == 'read' else 'POST'
+    connection.request(method, method=http_method)
+
+
+class FakeGCENodeDriver:
+    def __init__(self, cloud: FakeCloud, zone: str):
+        self.cloud = cloud
+        self.zone = zone
+        self.connection = _FakeConnection(self)
+
+    def _call(self, method):
+        _request(self.connection, method)
+
+    def _get(self, kind, store, name):
+        with self.cloud._lock:
+            obj = store.get(name)
+        if not obj:
+            raise _not_found(kind, name)
+        return obj
+
+    def ex_get_node(self, name):
+        self._call('ex_get_node')
+        return self._get('instances', self.cloud.instances, name)
+
+    def ex_get_address(self, name):
+        self._call('ex_get_address')
+        return self._get('addresses', self.cloud.addresses, name)
+
+    def ex_get_volume(self, name):
+        self._call('ex_get_volume')
+        return self._get('disks', self.cloud.disks, name)
+
+    def ex_get_snapshot(self, name):
+        self._call('ex_get_snapshot')
+        return self._get('snapshots', self.cloud.snapshots, name)
+
+    def ex_list_snapshots(self):
+        self._call('ex_list_snapshots')
+        with self.cloud._lock:
+            return list(self.cloud.snapshots.values())
+
+    def list_nodes(self, ex_zone=None):
+        self._call('list_nodes')
+        with self.cloud._lock:
+            return list(self.cloud.instances.values())
+
+    def ex_list_addresses(self, region=None):
+        self._call('ex_list_addresses')
+        with self.cloud._lock:
+            return list(self.cloud.addresses.values())
+
+    def list_volumes(self, ex_zone=None):
+        self._call('list_volumes')
+        with self.cloud._lock:
+            return list(self.cloud.disks.values())
+
+    def ex_create_address(self, name, region=None, **kwargs):
+        self._call('ex_create_address')
+        with self.cloud._lock:
+            n = len(self.cloud.addresses) + 1
+            addr = SimpleNamespace(
+                name=name,
+                address=f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}',
+                extra={'selfLink': f'regions/r/addresses/{name}'}
+            )
+            self.cloud.addresses[name] = addr
+        return addr
+
+    def ex_destroy_address(self, address):
+        self._call('ex_destroy_address')
+        name = getattr(address, 'name', address)
+        with self.cloud._lock:
+            self.cloud.addresses.pop(name, None)
+        return True
+
+    def destroy_volume(self, volume):
+        self._call('destroy_volume')
+        with self.cloud._lock:
+            self.cloud.disks.pop(volume.name, None)
+        return True
+
+    def create_node(self, name, size, image, external_ip=None, **kwargs):
+        self._call('create_node')
+        if self.cloud.op_duration:
+            time.sleep(self.cloud.op_duration)
+        vm = SimpleNamespace(
+            name=name,
+            state='running',
+            public_ips=[getattr(external_ip, 'address', None)],
+            extra={
+                'status': 'RUNNING',
+                'selfLink': f'zones/{self.zone}/instances/{name}',
+                'machineType': size,
+                'image': image,
+                'tags': kwargs.get('ex_tags'),
+                'labels': dict(kwargs.get('ex_labels') or {}),
+                'labelFingerprint': 'fake',
+                'disks': [],
+            }
+        )
+        with self.cloud._lock:
+            self.cloud.instances[name] = vm
+        return vm
+
+    def destroy_node(self, node, **kwargs):
+        self._call('destroy_node')
+        if self.cloud.op_duration:
+            time.sleep(self.cloud.op_duration)
+        with self.cloud._lock:
+            vm = self.cloud.instances.pop(node.name, None)
+            for disk in vm.extra['disks'] if vm else []:
+                if disk.get('autoDelete'):
+                    self.cloud.disks.pop(disk['deviceName'], None)
+        return True
+
+
+class FakeDNSDriver:
+    def __init__(self, cloud: FakeCloud):
+        self.cloud = cloud
+        self.connection = _FakeConnection(self, 'dns')
+
+    def get_zone(self, zone_id):
+        _request(self.connection, 'get_zone')
+        return SimpleNamespace(id=zone_id, domain=zone_id)
+
+    def list_records(self, zone):
+        _request(self.connection, 'list_records')
+        with self.cloud._lock:
+            records = list(self.cloud.records.get(zone.id, {}).values())
+        return [
+            SimpleNamespace(
+                name=r['name'], type=r['type'], data=dict(r), zone=zone
+            ) for r in records
+        ]
+
+    def ex_bulk_record_changes(self, zone, records):
+        _request(self.connection, 'ex_bulk_record_changes')
+        # Applied atomically, like a Cloud DNS change
+        with self.cloud._lock:
+            current = self.cloud.records.setdefault(zone.id, {})
+            updated = dict(current)
+            for r in records.get('deletions', []):
+                key = (r['name'], r['type'])
+                if updated.pop(key, None) != r:
+                    raise GoogleBaseError(
+                        'Precondition not met for deletion', 412,
+                        'conditionNotMet'
+                    )
+            for r in records.get('additions', []):
+                key = (r['name'], r['type'])
+                if key in updated:
+                    raise GoogleBaseError(
+                        'Record exists', 409, 'alreadyExists'
+                    )
+                updated[key] = dict(r)
+            self.cloud.records[zone.id] = updated
+        return SimpleNamespace(status='done')
+
+
+class FakeSession(gce.GCESession):
+    def __init__(self, cloud: FakeCloud):
+        self.cloud = cloud
+        self.project = 'fake-project'
+        self.client_email = 'fake@fake-project.iam.gserviceaccount.com'
+        self.credentials_file = None
+        self.scheduler = gce.get_scheduler(self.project)
+        self._drivers_by_key = {}
+        self._lock = threading.Lock()
+
+    def compute(self, zone: str):
+        with self._lock:
+            key = ('compute', zone)
+            if key not in self._drivers_by_key:
+                driver = FakeGCENodeDriver(self.cloud, zone)
+                gce.schedule_requests(
+                    driver.connection, 'compute', self.scheduler
+                )
+                self._drivers_by_key[key] = gce._Instrumented(
+                    driver, 'compute'
+                )
+            return self._drivers_by_key[key]
+
+    def dns(self):
+        with self._lock:
+            key = ('dns', )
+            if key not in self._drivers_by_key:
+                driver = FakeDNSDriver(self.cloud)
+                gce.schedule_requests(driver.connection, 'dns', self.scheduler)
+                self._drivers_by_key[key] = gce._Instrumented(driver, 'dns')
+            return self._drivers_by_key[key]
+
+
+def install(cloud: FakeCloud = None) -> FakeCloud:
+    # Makes every NodeOpsGCE of this process use the fake cloud
+    cloud = cloud or FakeCloud()
+    gce.set_session_override(FakeSession(cloud))
+    return cloud
+
+
+def uninstall():
+    gce.set_session_override(None)
@@ -1,26 +1,241 @@
+import os
 import asyncio
 import traceback
 import logging
 
-from quart import Quart, request
+from quart import Quart, request, make_response, send_file
 
-from . import ClusterError, ClusterContext, ClusterCtl
+from . import ClusterError, ClusterContext, ClusterCtl, metrics, tracing
+from .events import FINAL_STATES, format_sse
 
 logging.basicConfig(level=logging.DEBUG)
 
 CONFIG_DIR = '/home/woky/rchain/20wip/public-testnet/data/config'
 
+# The job engine is 'process' unless RTESTNET_JOB_ENGINE says otherwise, so
+# killed jobs are killed at once. Then every job lists the whole zone and
+# DNS zone again, and /metrics only has the controller's own metrics, none
+# of the node operations', see ClusterContext.job_engine.
+
+# Comment lines sent on idle event streams so proxies don't drop them
+_SSE_KEEPALIVE = 15
+
 app = Quart(__name__)
-cluster = ClusterCtl(ClusterContext(CONFIG_DIR, kill_jobs=True))
+cluster = ClusterCtl(
+    ClusterContext(
+        CONFIG_DIR,
+        kill_jobs=True,
+        journal_jobs=True,
+        job_engine=os.environ.get('RTESTNET_JOB_ENGINE', 'process'),
+        job_queue=os.environ.get('RTESTNET_JOB_QUEUE', 'local'),
+        reconcile_interval=float(os.environ.get('RTESTNET_RECONCILE', 0)),
+        warm_pool_interval=float(os.environ.get('RTESTNET_WARM_POOL', 0)),
+        health_url=os.environ.get('RTESTNET_HEALTH_URL'),
+        job_log_spill=os.environ.get('RTESTNET_JOB_LOG_SPILL') == '1'
+    )
+)
+
+
+@app.before_serving
+async def start_cluster():
+    await cluster.recover()
+    if cluster.ctx.reconcile_interval > 0:
+        app.reconciler = asyncio.create_task(cluster.run_reconciler())
+    if cluster.ctx.warm_pool_interval > 0:
+        app.warm_pool = asyncio.create_task(cluster.run_warm_pool())
+
+
+@app.after_serving
+async def stop_cluster():
+    await cluster.close()
+
+
+@app.route('/metrics', methods=['GET'])
+async def handle_metrics():
+    return metrics.render(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4'
+    }
+
 
 @app.route('/cluster/control/nodes/<node>/<action>', methods=['POST'])
 async def handle_node_ctl(*, node, action):
     req = {'node': node, 'action': action, 'args': request.args.to_dict()}
     try:
-        await cluster.dispatch(req)
-        return '', 202
+        with tracing.span('http', path=request.path):
+            job = await cluster.dispatch(req)
+        # Jobs published to the Redis queue run elsewhere
+        return (job.to_dict() if job else {}), 202
+    except ClusterError as e:
+        return str(e), 400
+    except Exception as e:
+        traceback.print_exc()
+        return '', 500
+
+
+@app.route('/cluster/control/bulk', methods=['POST'])
+async def handle_bulk_ctl():
+    breq = await request.get_json(force=True)
+    try:
+        bulk = await cluster.dispatch_bulk(breq)
+        return {'id': bulk.id, 'nodes': bulk.nodes}, 202
+    except ClusterError as e:
+        return str(e), 400
+    except Exception as e:
+        traceback.print_exc()
+        return '', 500
+
+
+@app.route('/cluster/control/bulk/<bulk_id>', methods=['GET'])
+async def handle_bulk_status(*, bulk_id):
+    try:
+        return cluster.get_bulk_job(bulk_id).to_dict()
+    except ClusterError as e:
+        return str(e), 404
+
+
+@app.route('/cluster/reconcile', methods=['POST'])
+async def handle_reconcile():
+    manifest = await request.get_json(silent=True)
+    dry_run = request.args.get('dry_run', '') in ('1', 'true')
+    try:
+        result = await cluster.reconcile(manifest, dry_run=dry_run)
+        if dry_run:
+            return result
+        return {'id': result.id, 'nodes': result.nodes}, 202
     except ClusterError as e:
         return str(e), 400
     except Exception as e:
         traceback.print_exc()
         return '', 500
+
+
+@app.route('/cluster/rollout', methods=['POST'])
+async def handle_rollout():
+    rreq = await request.get_json(silent=True) or {}
+    dry_run = request.args.get('dry_run', '') in ('1', 'true')
+    try:
+        result = await cluster.rollout(rreq, dry_run=dry_run)
+        if dry_run:
+            return result
+        return {'id': result.id, 'nodes': result.nodes}, 202
+    except ClusterError as e:
+        return str(e), 400
+    except Exception as e:
+        traceback.print_exc()
+        return '', 500
+
+
+@app.route('/cluster/jobs', methods=['GET'])
+async def handle_jobs():
+    return {'jobs': cluster.list_jobs()}
+
+
+@app.route('/cluster/operations', methods=['GET'])
+async def handle_operations():
+    return {'operations': cluster.pending_operations()}
+
+
+@app.route('/cluster/jobs/<job_id>', methods=['GET'])
+async def handle_job_status(*, job_id):
+    try:
+        job = cluster.get_job(job_id)
+    except ClusterError as e:
+        return str(e), 404
+    return dict(job.to_dict(), history=list(job.history))
+
+
+async def _event_stream(match=None, job=None):
+    # Subscribed before the job's history is copied, without awaiting in
+    # between, so no event is missed or sent twice
+    with cluster.events.subscribe(match) as sub:
+        last_seq = 0
+        for event in list(job.history) if job else []:
+            last_seq = event['seq']
+            yield format_sse(event)
+            if event['state'] in FINAL_STATES:
+                return
+        while True:
+            try:
+                event = await asyncio.wait_for(sub.get(), _SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ': keepalive\n\n'
+                continue
+            if event['seq'] <= last_seq:
+                continue
+            yield format_sse(event)
+            if job and event['state'] in FINAL_STATES:
+                return
+
+
+async def _sse_response(stream):
+    response = await make_response(
+        stream, 200, {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+    response.timeout = None
+    return response
+
+
+@app.route('/cluster/jobs/<job_id>/events', methods=['GET'])
+async def handle_job_events(*, job_id):
+    try:
+        job = cluster.get_job(job_id)
+    except ClusterError as e:
+        return str(e), 404
+    return await _sse_response(
+        _event_stream(lambda e: e['job'] == job_id, job)
+    )
+
+
+@app.route('/cluster/jobs/<job_id>/log', methods=['GET'])
+async def handle_job_log(*, job_id):
+    # The last lines the job's worker wrote, or all that were kept, and
+    # with follow=1 what it writes until it finishes
+    try:
+        job = cluster.get_job(job_id)
+    except ClusterError as e:
+        return str(e), 404
+    lines = request.args.get('tail', None, type=int)
+    if not job.log:
+        return 'Job output is not captured', 404
+    headers = {'Content-Type': 'text/plain; charset=utf-8'}
+    if request.args.get('follow') not in ('1', 'true'):
+        dropped, tail = job.log.tail(lines)
+        return b''.join(tail), 200, dict(headers, **{
+            'X-Lines-Dropped': str(dropped)
+        })
+    response = await make_response(
+        job.log.follow(lines), 200,
+        dict(headers, **{
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+    )
+    response.timeout = None
+    return response
+
+
+@app.route('/cluster/jobs/<job_id>/log.gz', methods=['GET'])
+async def handle_job_log_spill(*, job_id):
+    # Complete output of a finished job, see ClusterContext.job_log_spill
+    try:
+        job = cluster.get_job(job_id)
+    except ClusterError as e:
+        return str(e), 404
+    if not job.log or not job.log.closed or not job.log.spill_file:
+        return 'No spilled output', 404
+    # Writes queued before the close, and the gzip trailer, land first
+    await asyncio.wrap_future(job.log.spill_closed)
+    if not job.log.spill_file.exists():
+        return 'No spilled output', 404
+    return await send_file(job.log.spill_file, mimetype='application/gzip')
+
+
+@app.route('/cluster/events', methods=['GET'])
+async def handle_events():
+    node = request.args.get('node')
+    match = (lambda e: e['node'] == node) if node else None
+    return await _sse_response(_event_stream(match))
@@ -7,11 +7,83 @@ class ClusterContext:
     conf_dir: Path
     private_dir: Path = None
     kill_jobs: bool = False
+    # Merge requests arriving for a busy slot into a single follow-up job
+    # instead of cancelling the active one
+    coalesce_jobs: bool = False
+    # 'process' spawns a node CLI interpreter per job, 'thread' runs NodeCtl
+    # operations in a long-lived worker pool inside the controller process.
+    # Only 'thread' shares the cloud session, DNS zone index, inventory,
+    # operation tracker and API scheduler between jobs; with 'process' each
+    # job builds its own with full zone listings, and the metrics of node
+    # operations (cloud API, DNS, config, render) stay in the job's process
+    # and never reach /metrics.
+    job_engine: str = 'process'
+    job_workers: int = 16
+    bulk_concurrency: int = 32
+    # 'local' runs jobs in this process, 'redis' publishes them to the
+    # control stream for rtestnet.cluster.worker processes to consume
+    job_queue: str = 'local'
+    # Seconds between reconciliations against manifest_file, 0 disables
+    reconcile_interval: float = 0
+    # Where spans are appended, see rtestnet.cluster.tracing
+    trace_file: Path = None
+    # Record jobs in job_journal_file, starting with ClusterCtl.recover(),
+    # which resumes the jobs a previous controller left unfinished
+    journal_jobs: bool = False
+    # Seconds between warm pool refills, 0 disables them. The pool size is
+    # warm_pool_size of config_defaults_file.
+    warm_pool_interval: float = 0
+    # Supervisor whose node health gates rollout waves; without it a node
+    # is healthy once its instance runs
+    health_url: str = None
+    # Bytes of each job's output kept in memory, 0 leaves the output to the
+    # controller's stdout and stderr. With job_log_spill all of it is also
+    # written to job_log_dir.
+    job_log_size: int = 64 * 1024
+    job_log_spill: bool = False
 
     def __post_init__(self):
+        self.conf_dir = Path(self.conf_dir)
         if not self.private_dir:
             self.private_dir = self.conf_dir
+        self.private_dir = Path(self.private_dir)
 
     @property
     def config_defaults_file(self):
         return self.conf_dir / 'config.json'
+
+    @property
+    def config_cache_file(self):
+        return self.private_dir / '_config_cache.json'
+
+    @property
+    def manifest_file(self):
+        return self.conf_dir / 'manifest.json'
+
+    @property
+    def job_journal_file(self):
+        return self.private_dir / '_jobs.journal'
+
+    @property
+    def job_log_dir(self):
+        return self.private_dir / '_job_logs'
+
+    @property
+    def warm_pool_file(self):
+        return self.private_dir / '_warm_pool.json'
+
+    @property
+    def local_ports_file(self):
+        return self.private_dir / '_local_ports.json'
+
+    @property
+    def local_dns_file(self):
+        return self.private_dir / '_local_dns.json'
+
+    @property
+    def local_hosts_file(self):
+        return self.private_dir / 'hosts'
+
+    @property
+    def local_snapshot_dir(self):
+        return self.private_dir / '_snapshots'
@@ -1,30 +1,86 @@
-import sys
+import time
+import uuid
+import fnmatch
 import asyncio
 import traceback
 import logging, reprlib
 
-from dataclasses import dataclass
-from typing import Dict
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Dict, List
 from asyncio import Task, create_task, CancelledError
-from asyncio.subprocess import Process, create_subprocess_exec
 from pprint import pprint
 
 from schema import Schema, SchemaError, And, Or, Use, Optional as Opt
 
-from . import ClusterError, ClusterContext
+from . import ClusterError, ClusterContext, events, metrics, tracing
+from .engine import Worker, adopt_worker, create_job_engine
+from .events import EventBus
+from .joblog import JobLog
+from .journal import JobJournal
 
 _REQUEST_SCHEMA = Schema(
     {
         'node': And(str, len),
-        'action': Or('start', 'stop', 'restart', 'lead'),
+        'action': Or('start', 'stop', 'restart', 'lead', 'snapshot'),
         'args': {
-            Opt('clean'): Or('data', 'all')
+            Opt('clean'): Or('data', 'all'),
+            # stop and restart without clean
+            Opt('suspend'): Or('0', '1', 'false', 'true'),
+            # snapshot
+            Opt('name'): And(str, len),
+            Opt('consistent'): Or('0', '1', 'false', 'true')
         }
     }
 )
 
+_BULK_REQUEST_SCHEMA = Schema(
+    And(
+        {
+            'action': Or('start', 'stop', 'restart'),
+            Opt('args', default={}): {
+                Opt('clean'): Or('data', 'all'),
+                Opt('suspend'): Or('0', '1', 'false', 'true')
+            },
+            Opt('nodes'): [And(str, len)],
+            Opt('selector'): {
+                Opt('name'): And(str, len),
+                Opt('labels'): {str: str}
+            },
+            Opt('concurrency'): And(int, lambda n: n > 0)
+        },
+        lambda r: ('nodes' in r) != ('selector' in r),
+        error='Exactly one of "nodes" or "selector" must be given'
+    )
+)
+
+_MAX_BULK_JOBS = 100
+# Finished jobs kept for status queries, each with up to job_log_size bytes
+# of output
+_MAX_RECENT_JOBS = 200
+_MAX_JOB_HISTORY = 100
+
 logger = logging.getLogger(__name__)
 
+_jobs_active = metrics.gauge(
+    'rtestnet_jobs_active', 'Jobs occupying a slot, including waiting ones'
+)
+_jobs_pending = metrics.gauge(
+    'rtestnet_jobs_pending', 'Coalesced follow-up jobs waiting for a slot'
+)
+_job_latency = metrics.histogram(
+    'rtestnet_job_seconds', 'Time from request to job completion'
+)
+_spawn_latency = metrics.histogram(
+    'rtestnet_worker_spawn_seconds', 'Time to start a job worker'
+)
+_jobs_cancelled = metrics.counter(
+    'rtestnet_jobs_cancelled_total', 'Jobs cancelled by a newer request'
+)
+_workers_killed = metrics.counter(
+    'rtestnet_workers_terminated_total', 'Job workers terminated'
+)
+
 
 class ClusterCtlError(ClusterError):
     pass
@@ -35,13 +91,74 @@ class _Job:
     key: str
     req: Dict
     task: Task = None
-    process: Process = None
+    worker: Worker = None
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    returncode: int = None
+    # Resolved with the return code when the job finishes, cancelled when
+    # the job is superseded by a newer request in the same slot
+    done: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_event_loop().create_future()
+    )
+    # Follow-up job coalesced from requests received while this one runs
+    next: '_Job' = None
+    created: float = field(default_factory=time.monotonic)
+    state: str = events.QUEUED
+    history: deque = field(
+        default_factory=lambda: deque(maxlen=_MAX_JOB_HISTORY)
+    )
+    # Output of the job's worker, see ClusterContext.job_log_size
+    log: JobLog = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'slot': self.key,
+            'node': self.req['node'],
+            'action': self.req['action'],
+            'args': self.req['args'],
+            'state': self.state,
+            'returncode': self.returncode,
+        }
+
+
+@dataclass
+class _BulkJob:
+    action: str
+    nodes: List[str]
+    concurrency: int
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    results: Dict = field(default_factory=dict)
+    task: Task = None
+
+    def __post_init__(self):
+        for node in self.nodes:
+            self.results[node] = {'status': 'pending'}
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'concurrency': self.concurrency,
+            'done': self.task is not None and self.task.done(),
+            'results': self.results,
+        }
 
 
 class ClusterCtl:
     def __init__(self, ctx: ClusterContext):
         self.ctx = ctx
         self._jobs = {}
+        self._recent_jobs = OrderedDict()
+        self._event_seq = 0
+        self.events = EventBus()
+        self._bulk_jobs = OrderedDict()
+        self._engine = create_job_engine(ctx)
+        self._queue = None
+        self._journal = None
+        if ctx.journal_jobs:
+            self._journal = JobJournal(ctx.job_journal_file)
+        if ctx.trace_file:
+            tracing.configure(ctx.trace_file)
 
     def _req_key(self, req: Dict) -> str:
         if req['action'] == 'lead':
@@ -58,92 +175,536 @@ class ClusterCtl:
             raise ClusterCtlError('Invalid requst: ' + str(e)) from e
 
         key = self._req_key(req)
+        if self.ctx.job_queue == 'redis':
+            await self._publish(key, req)
+            return None
         new_job = _Job(key, req)
         logger.debug('Job slot: %s', key)
 
+        if key in self._jobs and self.ctx.coalesce_jobs:
+            job = self._coalesce(self._jobs[key], new_job)
+            if job is new_job:
+                self._track(new_job)
+                self._emit(new_job, events.PENDING)
+            return job
+
         if key in self._jobs:
             old_job = self._jobs[key]
             logger.debug('Active job exists in the slot')
             if req == old_job.req and not self.ctx.kill_jobs:
                 logger.debug('Ignoring duplicate request')
-                return
+                return old_job
 
             logger.debug('Cancelling active job')
             old_job.task.cancel()
-            if old_job.process:
+            old_job.done.cancel()
+            self._emit(old_job, events.CANCELLED, superseded_by=new_job.id)
+            _jobs_cancelled.inc(action=old_job.req['action'])
+            if old_job.worker:
                 if self.ctx.kill_jobs:
                     logger.debug(
-                        'Terminating active job\'s worker process PID=%d',
-                        old_job.process.pid
+                        'Terminating active job\'s worker PID=%d',
+                        old_job.worker.pid
                     )
-                    old_job.process.terminate()
-                new_job.process = old_job.process
+                    old_job.worker.terminate()
+                    _workers_killed.inc()
+                new_job.worker = old_job.worker
                 logger.debug(
-                    'Inherited active job\'s worker process PID=%d',
-                    new_job.process.pid
+                    'Inherited active job\'s worker PID=%d',
+                    new_job.worker.pid
                 )
             del self._jobs[key]
             logger.debug('Active job removed')
 
         new_job.task = create_task(self._run_job(new_job))
         self._jobs[key] = new_job
+        self._track(new_job)
+        self._emit(new_job, events.QUEUED)
+        self._update_gauges()
         logger.debug('New job scheduled for the request')
+        return new_job
+
+    def _track(self, job: _Job, journal=True):
+        if self._journal and journal:
+            self._journal.begin(job.id, job.key, job.req)
+            if job.worker and job.worker.adoptable:
+                self._journal.worker(job.id, job.worker.pid)
+        if self.ctx.job_log_size and not job.log:
+            spill_file = None
+            if self.ctx.job_log_spill:
+                spill_file = self.ctx.job_log_dir / f'{job.id}.log.gz'
+            job.log = JobLog(self.ctx.job_log_size, spill_file)
+        self._recent_jobs[job.id] = job
+        # Unfinished jobs stay however old they are, the oldest finished
+        # ones make room
+        excess = len(self._recent_jobs) - _MAX_RECENT_JOBS
+        if excess <= 0:
+            return
+        evicted = []
+        for old_job in self._recent_jobs.values():
+            if old_job.state in events.FINAL_STATES:
+                evicted.append(old_job)
+                if len(evicted) == excess:
+                    break
+        for old_job in evicted:
+            del self._recent_jobs[old_job.id]
+            if old_job.log:
+                old_job.log.discard()
+
+    def _emit(self, job: _Job, state: str, journal=True, **attrs):
+        # Final states are final, a job cancelled twice is reported once.
+        # Without journal the job stays unfinished in the journal, for the
+        # next controller to resume.
+        if job.state in events.FINAL_STATES:
+            return
+        if state != events.STEP:
+            job.state = state
+        if state in events.FINAL_STATES:
+            if self._journal and journal:
+                self._journal.end(job.id, state)
+            if job.log:
+                job.log.close()
+        self._event_seq += 1
+        event = dict(
+            attrs,
+            seq=self._event_seq,
+            ts=time.time(),
+            job=job.id,
+            slot=job.key,
+            node=job.req['node'],
+            action=job.req['action'],
+            state=state,
+        )
+        job.history.append(event)
+        self.events.publish(event)
+
+    async def recover(self) -> List[_Job]:
+        # Resumes jobs the journal has as unfinished, e.g. after the
+        # controller was restarted. A resumed job keeps its id, so its
+        # worker skips the provisioning steps that already finished, and
+        # first waits for the previous worker process if that still runs.
+        # Jobs are journaled from here on.
+        if not self._journal:
+            return []
+        loop = asyncio.get_event_loop()
+        unfinished = await loop.run_in_executor(None, self._journal.open)
+        jobs = []
+        for rec in unfinished:
+            job = _Job(rec['slot'], rec['req'], id=rec['job'])
+            if rec.get('worker'):
+                job.worker = adopt_worker(rec['worker'], job.req['node'])
+            active = self._jobs.get(job.key)
+            self._track(job, journal=False)
+            if active:
+                # Coalesced follow-up of the job recovered before it
+                active.next = job
+                self._emit(job, events.PENDING, recovered=True)
+            else:
+                job.task = create_task(self._run_job(job))
+                self._jobs[job.key] = job
+                self._emit(
+                    job,
+                    events.QUEUED,
+                    recovered=True,
+                    adopted=job.worker.pid if job.worker else None
+                )
+            jobs.append(job)
+        if jobs:
+            logger.info('Recovered %d unfinished jobs', len(jobs))
+        self._update_gauges()
+        return jobs
+
+    async def close(self):
+        # Cancels the jobs in progress without ending them in the journal,
+        # their workers keep running and recover() resumes them
+        tasks = [job.task for job in self._jobs.values() if job.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._jobs.clear()
+        self._update_gauges()
+        self._engine.close()
+        if self._journal:
+            self._journal.close()
+
+    def get_job(self, job_id: str) -> _Job:
+        try:
+            return self._recent_jobs[job_id]
+        except KeyError:
+            raise ClusterCtlError(f'Unknown job "{job_id}"') from None
+
+    def list_jobs(self) -> List[Dict]:
+        return [job.to_dict() for job in self._recent_jobs.values()]
+
+    def pending_operations(self) -> List[Dict]:
+        # Cloud operations the thread engine's jobs wait for; jobs of the
+        # process engine track theirs in their own processes
+        if self.ctx.job_engine != 'thread':
+            return []
+        from .node.operations import pending_operations
+
+        return pending_operations()
+
+    def _update_gauges(self):
+        _jobs_active.set(len(self._jobs))
+        _jobs_pending.set(sum(1 for j in self._jobs.values() if j.next))
+
+    @staticmethod
+    def _satisfies(req: Dict, desired: Dict) -> bool:
+        # Whether running req leaves the node in the state desired asks for
+        if req == desired:
+            return True
+        return (
+            desired['action'] == 'start' and not desired['args'] and
+            req['action'] in ('start', 'restart')
+        )
+
+    def _coalesce(self, job: _Job, new_job: _Job) -> _Job:
+        logger.debug('Active job exists in the slot, coalescing')
+        pending = job.next
+        if self._satisfies(job.req, new_job.req):
+            logger.debug('Request is served by the active job')
+            if pending:
+                logger.debug('Dropping pending follow-up job')
+                pending.done.cancel()
+                self._emit(pending, events.CANCELLED, superseded_by=job.id)
+                job.next = None
+            return job
+        if pending:
+            if self._satisfies(pending.req, new_job.req):
+                logger.debug('Request is served by the pending follow-up job')
+                return pending
+            logger.debug('Replacing pending follow-up job')
+            pending.done.cancel()
+            self._emit(pending, events.CANCELLED, superseded_by=new_job.id)
+        job.next = new_job
+        self._update_gauges()
+        return new_job
+
+    def _release_slot(self, job: _Job):
+        if self._jobs.get(job.key) is not job:
+            return
+        if job.next:
+            logger.debug('Scheduling follow-up job in slot %s', job.key)
+            self._jobs[job.key] = job.next
+            job.next.task = create_task(self._run_job(job.next))
+            self._emit(job.next, events.QUEUED)
+            job.next = None
+        else:
+            del self._jobs[job.key]
+        self._update_gauges()
+
+    async def _publish(self, key: str, req: Dict):
+        if not self._queue:
+            from .common import create_redis_from_env
+            from .queue import RedisJobQueue
+            self._queue = RedisJobQueue(await create_redis_from_env())
+        await self._queue.publish(key, req)
 
     async def _run_job(self, job: _Job):
+        with tracing.span(
+            'job', job=job.id, slot=job.key, action=job.req['action']
+        ):
+            await self._run_job_traced(job)
+
+    async def _run_job_traced(self, job: _Job):
         logger.debug('Running job in slot %s', job.key)
         try:
-            if job.process:
+            if job.worker:
                 logger.debug(
-                    'Waiting for inherited worker process PID=%d to finish',
-                    job.process.pid
+                    'Waiting for inherited worker PID=%d to finish',
+                    job.worker.pid
                 )
-                await job.process.wait()
-                job.process = None
-                logger.debug('Inherited worker process finished')
-
-            cmd = self._get_node_ctl_cmd(job.req)
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug('Creating worker process: %s', ' '.join(cmd))
+                self._emit(job, events.WAITING, worker=job.worker.pid)
+                with tracing.span('wait inherited'):
+                    await job.worker.wait()
+                job.worker = None
+                logger.debug('Inherited worker finished')
 
-            # XXX make sure the process is killed if cancel happens here
-            job.process = await create_subprocess_exec(
-                *cmd, stdout=sys.stdout, stderr=sys.stderr
-            )
-            logger.debug('Created worker process PID=%d', job.process.pid)
+            # XXX make sure the worker is killed if cancel happens here
+            with tracing.span('worker', engine=self.ctx.job_engine):
+                with _spawn_latency.time(engine=self.ctx.job_engine):
+                    job.worker = await self._engine.spawn(
+                        job.req,
+                        lambda p: self._emit(job, events.STEP, **p),
+                        job_id=job.id,
+                        on_output=job.log.append if job.log else None
+                    )
+                logger.debug('Created worker PID=%d', job.worker.pid)
+                if self._journal and job.worker.adoptable:
+                    self._journal.worker(job.id, job.worker.pid)
+                self._emit(job, events.RUNNING, worker=job.worker.pid)
 
-            await job.process.wait()
+                job.returncode = await job.worker.wait()
             logger.debug(
-                'Worker process PID=%d finished with status=%d',
-                job.process.pid, job.process.returncode
+                'Worker PID=%d finished with status=%d',
+                job.worker.pid, job.worker.returncode
             )
 
-            del self._jobs[job.key]
+            self._release_slot(job)
+            job.done.set_result(job.returncode)
+            self._emit(
+                job,
+                events.DONE if job.returncode == 0 else events.FAILED,
+                returncode=job.returncode
+            )
+            _job_latency.observe(
+                time.monotonic() - job.created,
+                action=job.req['action'],
+                status='ok' if job.returncode == 0 else 'failed'
+            )
         except CancelledError as e:
+            # A job superseded by a newer request is already cancelled, any
+            # other cancellation is the controller shutting down
             logger.debug('Current job was cancelled')
+            job.done.cancel()
+            self._emit(job, events.CANCELLED, journal=False, shutdown=True)
             raise
         except:
             logger.debug(
                 'Current job ended with unhandled exception', exc_info=True
             )
             traceback.print_exc()
-            if job.key in self._jobs:
-                del self._jobs[job.key]
+            self._release_slot(job)
+            job.done.set_result(None)
+            self._emit(job, events.FAILED, error='unhandled exception')
             raise
 
-    def _get_node_ctl_cmd(self, req: Dict):
-        CLI_MODULE = 'rtestnet.cluster.node.cli'
-        cmd = [
-            sys.executable, '-m', CLI_MODULE,
-            '-d', str(self.ctx.conf_dir),
-            '-p', str(self.ctx.private_dir or self.ctx.conf_dir),
-            req['node'], req['action']
-        ] # yapf: disable
-
-        if req['action'] == 'stop' or req['action'] == 'restart':
-            clean = req['args'].get('clean', None)
-            if clean == 'data':
-                cmd.append('-c')
-            elif clean == 'all':
-                cmd.append('-C')
-
-        return cmd
+    def list_nodes(self) -> List[str]:
+        return sorted(
+            p.name for p in self.ctx.conf_dir.iterdir()
+            if p.is_dir() and not p.name.startswith(('.', '_'))
+        )
+
+    def _select_nodes(self, selector: Dict) -> List[str]:
+        from .node import NodeContext, NodeCtl
+
+        nodes = self.list_nodes()
+        if 'name' in selector:
+            nodes = fnmatch.filter(nodes, selector['name'])
+        labels = selector.get('labels')
+        if labels:
+            def match(node):
+                config = NodeCtl(NodeContext(self.ctx, node)).load_config()
+                node_labels = config.get('labels', {})
+                return all(node_labels.get(k) == v for k, v in labels.items())
+            nodes = [n for n in nodes if match(n)]
+        return nodes
+
+    async def dispatch_bulk(self, breq: Dict) -> _BulkJob:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Received bulk request: %s', reprlib.repr(breq))
+        try:
+            breq = _BULK_REQUEST_SCHEMA.validate(breq)
+        except SchemaError as e:
+            logger.info('Rejected invalid bulk request')
+            raise ClusterCtlError('Invalid requst: ' + str(e)) from e
+
+        if self.ctx.job_queue != 'local':
+            raise ClusterCtlError('Bulk requests need the local job queue')
+
+        if 'nodes' in breq:
+            nodes = list(OrderedDict.fromkeys(breq['nodes']))
+        else:
+            # Label matching loads node configs, keep it off the event loop
+            nodes = await asyncio.get_event_loop().run_in_executor(
+                None, self._select_nodes, breq['selector']
+            )
+        if not nodes:
+            raise ClusterCtlError('No nodes matched the bulk request')
+
+        reqs = [
+            {'node': node, 'action': breq['action'], 'args': breq['args']}
+            for node in nodes
+        ]
+        bulk = _BulkJob(
+            breq['action'], nodes,
+            breq.get('concurrency', self.ctx.bulk_concurrency)
+        )
+        bulk.task = create_task(self._run_bulk(bulk, reqs))
+        self._add_bulk_job(bulk)
+        logger.debug(
+            'Bulk job %s scheduled for %d nodes', bulk.id, len(nodes)
+        )
+        return bulk
+
+    def _add_bulk_job(self, bulk: _BulkJob):
+        self._bulk_jobs[bulk.id] = bulk
+        while len(self._bulk_jobs) > _MAX_BULK_JOBS:
+            self._bulk_jobs.popitem(last=False)
+
+    def get_bulk_job(self, bulk_id: str) -> _BulkJob:
+        try:
+            return self._bulk_jobs[bulk_id]
+        except KeyError:
+            raise ClusterCtlError(f'Unknown bulk job "{bulk_id}"') from None
+
+    async def reconcile(self, manifest: Dict = None, dry_run=False):
+        from . import reconcile
+
+        if self.ctx.job_queue != 'local':
+            raise ClusterCtlError('Reconciling needs the local job queue')
+        loop = asyncio.get_event_loop()
+        if manifest is None:
+            manifest = await loop.run_in_executor(
+                None, reconcile.load_manifest, self.ctx
+            )
+        else:
+            manifest = reconcile.validate_manifest(manifest)
+        observed, boot = await loop.run_in_executor(
+            None, reconcile.observe, self.ctx, list(manifest['nodes'])
+        )
+        reqs, lead_req = reconcile.plan(manifest, observed, boot)
+        logger.info(
+            'Reconciling: %d node actions%s', len(reqs),
+            ', leader change' if lead_req else ''
+        )
+        if dry_run:
+            return {
+                'observed': observed,
+                'actions': reqs + ([lead_req] if lead_req else []),
+            }
+
+        keys = [self._req_key(r) for r in reqs]
+        bulk = _BulkJob(
+            'reconcile', keys + (['lead'] if lead_req else []),
+            manifest.get('concurrency', self.ctx.bulk_concurrency)
+        )
+
+        async def run():
+            await self._run_bulk(bulk, reqs)
+            # The leader's address may only exist once it has been started
+            if lead_req:
+                await self._run_bulk(bulk, [lead_req])
+
+        bulk.task = create_task(run())
+        self._add_bulk_job(bulk)
+        return bulk
+
+    async def rollout(self, rreq: Dict, dry_run=False):
+        from . import rollout
+
+        if self.ctx.job_queue != 'local':
+            raise ClusterCtlError('Rollouts need the local job queue')
+        rreq = rollout.validate_request(rreq)
+        loop = asyncio.get_event_loop()
+        nodes = rreq.get('nodes') or await loop.run_in_executor(
+            None, self.list_nodes
+        )
+        leader = rreq.get('leader') or await loop.run_in_executor(
+            None, rollout.manifest_leader, self.ctx
+        )
+        changes = await loop.run_in_executor(
+            None, rollout.find_changes, self.ctx, nodes, rreq['force']
+        )
+        health = rollout.HealthCheck(self.ctx)
+        results = await asyncio.gather(*[health.healthy(n) for n in changes])
+        serving = dict(zip(changes, results))
+        waves = rollout.plan_waves(
+            list(changes), serving, leader, rreq['max_unavailable'],
+            rreq['max_surge']
+        )
+        logger.info(
+            'Rollout: %d of %d nodes affected, %d waves', len(changes),
+            len(nodes), len(waves)
+        )
+        if dry_run:
+            return {'changes': changes, 'serving': serving, 'waves': waves}
+
+        bulk = _BulkJob(
+            'rollout', list(changes),
+            rreq['max_unavailable'] + rreq['max_surge']
+        )
+        for i, wave in enumerate(waves):
+            for node in wave:
+                bulk.results[node].update(wave=i, changes=changes[node])
+        bulk.task = create_task(self._run_rollout(bulk, waves, rreq, health))
+        self._add_bulk_job(bulk)
+        return bulk
+
+    async def _run_rollout(self, bulk: _BulkJob, waves, rreq: Dict, health):
+        for i, wave in enumerate(waves):
+            # Health reported before the restart doesn't count
+            marks = await health.marks(wave)
+            await self._run_bulk(
+                bulk, [
+                    {'node': node, 'action': 'restart', 'args': rreq['args']}
+                    for node in wave
+                ]
+            )
+            failed = [n for n in wave if bulk.results[n]['status'] != 'ok']
+            if not failed:
+                failed = await health.wait(
+                    wave, marks, rreq['health_timeout']
+                )
+                for node in failed:
+                    bulk.results[node]['status'] = 'unhealthy'
+            if failed:
+                logger.error(
+                    'Rollout %s stopped in wave %d, failed nodes: %s',
+                    bulk.id, i, ', '.join(failed)
+                )
+                for node in sum(waves[i + 1:], []):
+                    bulk.results[node]['status'] = 'skipped'
+                return
+            logger.info(
+                'Rollout %s: wave %d of %d healthy', bulk.id, i + 1,
+                len(waves)
+            )
+
+    async def run_reconciler(self):
+        while True:
+            await asyncio.sleep(self.ctx.reconcile_interval)
+            try:
+                bulk = await self.reconcile()
+                await bulk.task
+            except CancelledError:
+                raise
+            except Exception:
+                logger.exception('Reconciliation failed')
+
+    def _refill_warm_pool(self) -> int:
+        from .node import NodeConfig
+        from .node.pool import WarmPool
+
+        config = NodeConfig.load(
+            self.ctx.config_defaults_file,
+            cache_file=self.ctx.config_cache_file
+        )
+        if not config.get('warm_pool_size'):
+            return 0
+        return WarmPool(self.ctx).refill(config)
+
+    async def run_warm_pool(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                created = await loop.run_in_executor(
+                    None, self._refill_warm_pool
+                )
+                if created:
+                    logger.info('Warm pool refilled with %d VMs', created)
+            except CancelledError:
+                raise
+            except Exception:
+                logger.exception('Warm pool refill failed')
+            await asyncio.sleep(self.ctx.warm_pool_interval)
+
+    async def _run_bulk(self, bulk: _BulkJob, reqs: List[Dict]):
+        sem = asyncio.Semaphore(bulk.concurrency)
+
+        async def run_one(req):
+            result = bulk.results[self._req_key(req)]
+            async with sem:
+                result['status'] = 'running'
+                job = await self.dispatch(req)
+                result['job'] = job.id
+                await asyncio.wait([job.done])
+            if job.done.cancelled():
+                result['status'] = 'superseded'
+            else:
+                result['returncode'] = job.done.result()
+                result['status'] = 'ok' if job.returncode == 0 else 'failed'
+
+        await asyncio.gather(*[run_one(req) for req in reqs])
+        logger.debug('Bulk job %s finished', bulk.id)
@@ -0,0 +1,386 @@
+import os
+import abc
+import sys
+import json
+import signal
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+
+from typing import Callable, Dict
+from concurrent.futures import ThreadPoolExecutor
+from asyncio import Task
+from asyncio.subprocess import PIPE, STDOUT, Process, create_subprocess_exec
+
+from . import ClusterError, ClusterContext, joblog, progress, tracing
+
+# Bytes read from a worker's output at once
+_OUTPUT_CHUNK = 65536
+
+logger = logging.getLogger(__name__)
+
+
+class JobEngineError(ClusterError):
+    pass
+
+
+class Worker(abc.ABC):
+    # Handle of a running node operation. Exposes the subset of
+    # asyncio.subprocess.Process that ClusterCtl relies on.
+    pid: int = None
+    # Whether pid is an OS process another controller could adopt
+    adoptable: bool = False
+
+    @property
+    @abc.abstractmethod
+    def returncode(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    async def wait(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def terminate(self):
+        pass
+
+
+async def _read_progress(read_fd: int, on_progress: Callable):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader),
+        os.fdopen(read_fd, 'rb', 0)
+    )
+    try:
+        async for line in reader:
+            try:
+                on_progress(json.loads(line))
+            except ValueError:
+                logger.warning('Invalid progress report: %r', line)
+    finally:
+        transport.close()
+
+
+async def _read_output(stream: asyncio.StreamReader, on_output: Callable):
+    # Chunks, not lines, so that a line without end can't grow unbounded
+    while True:
+        data = await stream.read(_OUTPUT_CHUNK)
+        if not data:
+            break
+        on_output(data)
+
+
+class _ProcessWorker(Worker):
+    adoptable = True
+
+    def __init__(
+        self, process: Process, progress_task: Task = None,
+        output_task: Task = None
+    ):
+        self.process = process
+        self.pid = process.pid
+        self.progress_task = progress_task
+        self.output_task = output_task
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    async def wait(self):
+        returncode = await self.process.wait()
+        # Deliver the reports and output written just before the process
+        # exited
+        tasks = [t for t in (self.progress_task, self.output_task) if t]
+        if tasks:
+            await asyncio.wait(tasks)
+        return returncode
+
+    def terminate(self):
+        if self.process.returncode is None:
+            self.process.terminate()
+
+
+class _ThreadWorker(Worker):
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        # Pseudo PID, only used to correlate log messages
+        self.pid = next(self._ids)
+        self.cancelled = threading.Event()
+        self.future = None
+
+    @property
+    def returncode(self):
+        if self.future and self.future.done():
+            return self.future.result()
+        return None
+
+    async def wait(self):
+        # Shielded so that cancelling the awaiting job doesn't detach the
+        # future; a job inheriting this worker must be able to wait for it.
+        return await asyncio.shield(asyncio.wrap_future(self.future))
+
+    def terminate(self):
+        # Threads cannot be killed. The operation is abandoned if it hasn't
+        # started yet, otherwise it stops before its next provisioning step
+        # or cloud operation, see rtestnet.cluster.progress; the one in
+        # flight runs to its end. A job inheriting the worker waits for
+        # that.
+        self.cancelled.set()
+
+
+class _AdoptedWorker(Worker):
+    # Worker process left running by a previous controller. It isn't our
+    # child, so it's polled for and its exit status is unknown.
+
+    POLL_INTERVAL = 1
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._exited = False
+
+    def _alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @property
+    def returncode(self):
+        return None
+
+    async def wait(self):
+        while not self._exited:
+            if not self._alive():
+                self._exited = True
+                break
+            await asyncio.sleep(self.POLL_INTERVAL)
+        return None
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def adopt_worker(pid: int, node: str) -> Worker:
+    # Returns a handle of the worker process pid if it still runs the node
+    # CLI for the node; a recycled pid must not be waited for or killed
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            argv = f.read().decode(errors='replace').split('\0')
+    except OSError:
+        return None
+    if ProcessJobEngine.CLI_MODULE not in argv or node not in argv:
+        return None
+    return _AdoptedWorker(pid)
+
+
+def _is_true(arg) -> bool:
+    # Flags come as query string values
+    return arg in ('1', 'true')
+
+
+class JobEngine(abc.ABC):
+    def __init__(self, ctx: ClusterContext):
+        self.ctx = ctx
+
+    @abc.abstractmethod
+    async def spawn(
+        self,
+        req: Dict,
+        on_progress: Callable = None,
+        job_id: str = None,
+        on_output: Callable = None
+    ) -> Worker:
+        # on_progress is called on the event loop with every progress
+        # report of the operation, see rtestnet.cluster.progress, and
+        # on_output with chunks of its output as bytes. Without on_output
+        # the output goes to the controller's.
+        pass
+
+    def close(self):
+        pass
+
+
+class ProcessJobEngine(JobEngine):
+    CLI_MODULE = 'rtestnet.cluster.node.cli'
+
+    def get_cmd(self, req: Dict, job_id: str = None):
+        cmd = [
+            sys.executable, '-m', self.CLI_MODULE,
+            '-d', str(self.ctx.conf_dir),
+            '-p', str(self.ctx.private_dir or self.ctx.conf_dir),
+        ] # yapf: disable
+        if job_id:
+            cmd += ['-j', job_id]
+        cmd += [req['node'], req['action']]
+
+        if req['action'] == 'stop' or req['action'] == 'restart':
+            clean = req['args'].get('clean', None)
+            if clean == 'data':
+                cmd.append('-c')
+            elif clean == 'all':
+                cmd.append('-C')
+            elif _is_true(req['args'].get('suspend')):
+                cmd.append('-s')
+        elif req['action'] == 'snapshot':
+            if req['args'].get('name'):
+                cmd += ['-n', req['args']['name']]
+            if _is_true(req['args'].get('consistent')):
+                cmd.append('--consistent')
+
+        return cmd
+
+    async def spawn(
+        self,
+        req: Dict,
+        on_progress: Callable = None,
+        job_id: str = None,
+        on_output: Callable = None
+    ) -> Worker:
+        cmd = self.get_cmd(req, job_id)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Creating worker process: %s', ' '.join(cmd))
+        env = tracing.child_env()
+        kwargs = {'stdout': sys.stdout, 'stderr': sys.stderr}
+        if on_output:
+            kwargs = {'stdout': PIPE, 'stderr': STDOUT}
+        read_fd = write_fd = None
+        if on_progress:
+            read_fd, write_fd = os.pipe()
+            env[progress.PROGRESS_FD_ENV] = str(write_fd)
+            kwargs['pass_fds'] = (write_fd, )
+        try:
+            process = await create_subprocess_exec(
+                *cmd, env=env, **kwargs
+            )
+        except:
+            if read_fd is not None:
+                os.close(read_fd)
+            raise
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+        progress_task = None
+        if on_progress:
+            progress_task = asyncio.create_task(
+                _read_progress(read_fd, on_progress)
+            )
+        output_task = None
+        if on_output:
+            output_task = asyncio.create_task(
+                _read_output(process.stdout, on_output)
+            )
+        return _ProcessWorker(process, progress_task, output_task)
+
+
+class ThreadJobEngine(JobEngine):
+    def __init__(self, ctx: ClusterContext):
+        super().__init__(ctx)
+        self._executor = ThreadPoolExecutor(
+            max_workers=ctx.job_workers, thread_name_prefix='node-ctl'
+        )
+
+    def _run(
+        self,
+        req: Dict,
+        worker: _ThreadWorker,
+        report: Callable,
+        job_id: str,
+        output: Callable = None
+    ) -> int:
+        # Imported here so that the process engine doesn't pull libcloud and
+        # friends into the controller process
+        from .node import NodeError
+        from .node.cli import run_action
+
+        if report:
+            progress.set_reporter(report)
+        progress.set_cancel_check(worker.cancelled.is_set)
+        if output:
+            # Operations run in this thread, their log records are all the
+            # output there is
+            joblog.capture_logging(output)
+        if worker.cancelled.is_set():
+            logger.debug('Worker %d cancelled before it started', worker.pid)
+            return -signal.SIGTERM
+        clean = req['args'].get('clean', None)
+        try:
+            run_action(
+                self.ctx,
+                req['node'],
+                req['action'],
+                clean_data=clean == 'data',
+                clean_all=clean == 'all',
+                cancelled=worker.cancelled.is_set,
+                job_id=job_id,
+                snapshot_name=req['args'].get('name'),
+                consistent=_is_true(req['args'].get('consistent')),
+                suspend=_is_true(req['args'].get('suspend'))
+            )
+            return 0
+        except progress.StepCancelled as e:
+            logger.info('Node %s: %s', req['node'], e)
+            return -signal.SIGTERM
+        except NodeError as e:
+            logger.error('Node %s: %s', req['node'], e, exc_info=e.__cause__)
+            return 1
+        except Exception:
+            logger.exception('Node %s: unhandled exception', req['node'])
+            return 1
+
+    async def spawn(
+        self,
+        req: Dict,
+        on_progress: Callable = None,
+        job_id: str = None,
+        on_output: Callable = None
+    ) -> Worker:
+        worker = _ThreadWorker()
+        loop = asyncio.get_running_loop()
+
+        def threadsafe(callback):
+            if not callback:
+                return None
+
+            def call(arg):
+                try:
+                    loop.call_soon_threadsafe(callback, arg)
+                except RuntimeError:
+                    # Event loop closed under a still running operation
+                    pass
+
+            return call
+
+        logger.debug('Submitting worker %d to the pool', worker.pid)
+        worker.future = self._executor.submit(
+            contextvars.copy_context().run, self._run, req, worker,
+            threadsafe(on_progress), job_id, threadsafe(on_output)
+        )
+        return worker
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+_ENGINES = {
+    'process': ProcessJobEngine,
+    'thread': ThreadJobEngine,
+}
+
+
+def create_job_engine(ctx: ClusterContext) -> JobEngine:
+    try:
+        return _ENGINES[ctx.job_engine](ctx)
+    except KeyError:
+        raise JobEngineError(
+            f'Unknown job engine "{ctx.job_engine}"'
+        ) from None
@@ -0,0 +1,83 @@
+import json
+import asyncio
+import logging
+
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+# Job event states. A job is queued until its worker starts, waiting while
+# it waits for a worker inherited from the job it replaced, pending while
+# it's a coalesced follow-up of a busy slot, running with step events in
+# between, and ends as done, failed or cancelled.
+QUEUED = 'queued'
+PENDING = 'pending'
+WAITING = 'waiting'
+RUNNING = 'running'
+STEP = 'step'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+FINAL_STATES = (DONE, FAILED, CANCELLED)
+
+
+class Subscription:
+    # Bounded queue of events for one consumer. A consumer that falls
+    # behind loses the oldest events rather than slowing publishers down;
+    # the number lost is reported with the next event it gets.
+
+    def __init__(self, bus: 'EventBus', match: Callable, max_size: int):
+        self._bus = bus
+        self._match = match
+        self._queue = asyncio.Queue(max_size)
+        self.dropped = 0
+
+    def _put(self, event: Dict):
+        if not self._match(event):
+            return
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(event)
+
+    async def get(self) -> Dict:
+        event = await self._queue.get()
+        if self.dropped:
+            event = dict(event, dropped=self.dropped)
+            self.dropped = 0
+        return event
+
+    def close(self):
+        self._bus._subscriptions.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+
+class EventBus:
+    def __init__(self, max_queue=1000):
+        self.max_queue = max_queue
+        self._subscriptions = set()
+
+    def publish(self, event: Dict):
+        for sub in list(self._subscriptions):
+            sub._put(event)
+
+    def subscribe(self, match: Callable = None) -> Subscription:
+        sub = Subscription(self, match or (lambda e: True), self.max_queue)
+        self._subscriptions.add(sub)
+        return sub
+
+
+def format_sse(event: Dict) -> str:
+    return f'event: {event["state"]}\ndata: {json.dumps(event)}\n\n'
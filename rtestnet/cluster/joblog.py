@@ -0,0 +1,225 @@
+import gzip
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+# Output of a job's worker: the last max_bytes of it as lines in memory
+# and, optionally, all of it in a gzip file. Appending never waits for
+# readers; a follower that falls behind the ring skips the lines it lost
+# and is told how many.
+
+# Longer lines are split
+_MAX_LINE = 8192
+
+logger = logging.getLogger(__name__)
+
+# Output waiting to be spilled, of all jobs. Beyond it output is dropped
+# from spill files, with a note of how much, rather than held in memory.
+_MAX_SPILL_PENDING = 8 * 1024 * 1024
+
+# Spill files are only touched by this thread, so their writes keep order
+_spill_executor = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='job-log'
+)
+_spill_pending = 0
+_spill_lock = threading.Lock()
+
+
+def _reserve_spill(size: int) -> bool:
+    global _spill_pending
+    with _spill_lock:
+        if _spill_pending + size > _MAX_SPILL_PENDING:
+            return False
+        _spill_pending += size
+        return True
+
+
+def _release_spill(size: int):
+    global _spill_pending
+    with _spill_lock:
+        _spill_pending -= size
+
+
+class JobLog:
+    def __init__(self, max_bytes: int, spill_file: Path = None):
+        self.max_bytes = max_bytes
+        self.spill_file = spill_file
+        self.closed = False
+        self._lines = deque()
+        self._size = 0
+        # Sequence number of the first line in the ring
+        self._first = 0
+        self._partial = b''
+        self._spill = None
+        self._spill_dropped = 0
+        # Done once the spill file is complete, after close()
+        self.spill_closed = None
+        self._wakeup = None
+
+    @property
+    def dropped(self) -> int:
+        # Lines that no longer fit in the ring
+        return self._first
+
+    @property
+    def _end(self) -> int:
+        return self._first + len(self._lines)
+
+    def _add(self, line: bytes):
+        self._lines.append(line)
+        self._size += len(line)
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            self._size -= len(self._lines.popleft())
+            self._first += 1
+
+    def _add_lines(self, lines: List[bytes]):
+        for line in lines:
+            for i in range(0, max(len(line), 1), _MAX_LINE):
+                self._add(line[i:i + _MAX_LINE] + b'\n')
+
+    def _wake(self):
+        if self._wakeup:
+            self._wakeup.set_result(None)
+            self._wakeup = None
+
+    def append(self, data: bytes):
+        # Called on the event loop
+        if self.closed or not data:
+            return
+        if self.spill_file:
+            self._submit_spill(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        if len(self._partial) >= _MAX_LINE:
+            lines.append(self._partial)
+            self._partial = b''
+        self._add_lines(lines)
+        self._wake()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.spill_file and self._spill_dropped:
+            self._submit_spill(b'')
+        if self._partial:
+            self._add_lines([self._partial])
+            self._partial = b''
+        self.closed = True
+        self._wake()
+        if self.spill_file:
+            self.spill_closed = _spill_executor.submit(self._close_spill)
+
+    def discard(self):
+        # Removes the spill file of a job that is forgotten
+        self.close()
+        if self.spill_file:
+            _spill_executor.submit(self.spill_file.unlink, missing_ok=True)
+
+    def tail(self, lines: int = None) -> Tuple[int, List[bytes]]:
+        # Returns how many lines were dropped before the returned ones
+        start = 0 if lines is None else max(len(self._lines) - lines, 0)
+        return (
+            self._first + start,
+            list(itertools.islice(self._lines, start, None))
+        )
+
+    async def follow(self, lines: int = None):
+        # Yields chunks of lines, starting with the last ones, until the
+        # log is closed
+        seq = self._first
+        if lines is not None:
+            seq = max(self._first, self._end - lines)
+        while True:
+            if seq < self._first:
+                yield f'[{self._first - seq} lines dropped]\n'.encode()
+                seq = self._first
+            if seq < self._end:
+                chunk = b''.join(
+                    itertools.islice(self._lines, seq - self._first, None)
+                )
+                seq = self._end
+                yield chunk
+                continue
+            if self.closed:
+                return
+            if not self._wakeup:
+                self._wakeup = asyncio.get_running_loop().create_future()
+            # Shared by all followers, one of them going away mustn't
+            # cancel it for the others
+            await asyncio.shield(self._wakeup)
+
+    def _submit_spill(self, data: bytes):
+        if self._spill_dropped:
+            note = f'\n[{self._spill_dropped} bytes dropped]\n'.encode()
+            if not _reserve_spill(len(note) + len(data)):
+                self._spill_dropped += len(data)
+                return
+            self._spill_dropped = 0
+            data = note + data
+        elif not _reserve_spill(len(data)):
+            self._spill_dropped += len(data)
+            return
+        _spill_executor.submit(self._write_spill, data)
+
+    def _write_spill(self, data: bytes):
+        try:
+            self._write_spill_file(data)
+        finally:
+            _release_spill(len(data))
+
+    def _write_spill_file(self, data: bytes):
+        if not self.spill_file:
+            return
+        try:
+            if not self._spill:
+                self.spill_file.parent.mkdir(parents=True, exist_ok=True)
+                self._spill = gzip.open(self.spill_file, 'ab')
+            self._spill.write(data)
+        except OSError:
+            logger.warning(
+                'Could not write %s, spilling disabled', self.spill_file,
+                exc_info=True
+            )
+            self.spill_file = None
+
+    def _close_spill(self):
+        if self._spill:
+            self._spill.close()
+            self._spill = None
+
+
+# Log records of the thread job engine's operations, which write no output
+# of their own, are captured by a handler on the root logger that writes
+# to the job of the current context
+
+_writer = contextvars.ContextVar('rtestnet_job_log', default=None)
+_handler = None
+_handler_lock = threading.Lock()
+
+
+class _CaptureHandler(logging.Handler):
+    def emit(self, record):
+        write = _writer.get()
+        if not write:
+            return
+        try:
+            write((self.format(record) + '\n').encode())
+        except Exception:
+            self.handleError(record)
+
+
+def capture_logging(write: Callable[[bytes], None]):
+    global _handler
+    with _handler_lock:
+        if not _handler:
+            _handler = _CaptureHandler()
+            _handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            logging.getLogger().addHandler(_handler)
+    _writer.set(write)
@@ -0,0 +1,73 @@
+import os
+import json
+import logging
+
+from pathlib import Path
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+
+class JobJournal:
+    # Write-ahead record of jobs as JSON lines: 'begin' before a job is
+    # scheduled, 'worker' once its worker process runs and 'end' when it
+    # reaches a final state. Appends are single writes to an O_APPEND
+    # descriptor, so a record is either there or not after the controller
+    # dies. The file is compacted to the unfinished jobs when opened.
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd = None
+
+    def _read(self) -> Dict[str, Dict]:
+        jobs = {}
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        logger.warning('Skipping corrupt journal record')
+                        continue
+                    op = rec.get('op')
+                    if op == 'begin':
+                        jobs[rec['job']] = rec
+                    elif op == 'worker' and rec['job'] in jobs:
+                        jobs[rec['job']]['worker'] = rec['worker']
+                    elif op == 'end':
+                        jobs.pop(rec['job'], None)
+        except FileNotFoundError:
+            pass
+        return jobs
+
+    def open(self) -> List[Dict]:
+        # Returns the begin records (with the last worker pid, if any) of
+        # jobs that never ended, in the order they were started
+        jobs = self._read()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+        tmp_file.write_text(
+            ''.join(json.dumps(rec) + '\n' for rec in jobs.values())
+        )
+        os.replace(tmp_file, self.path)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        return list(jobs.values())
+
+    def _append(self, rec: Dict):
+        if self._fd is None:
+            return
+        os.write(self._fd, (json.dumps(rec) + '\n').encode())
+
+    def begin(self, job_id: str, slot: str, req: Dict):
+        self._append({'op': 'begin', 'job': job_id, 'slot': slot, 'req': req})
+
+    def worker(self, job_id: str, pid: int):
+        self._append({'op': 'worker', 'job': job_id, 'worker': pid})
+
+    def end(self, job_id: str, state: str):
+        self._append({'op': 'end', 'job': job_id, 'state': state})
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,141 @@
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Tuple
+
+# Metrics in Prometheus text exposition format. Only values recorded in
+# this process are visible, i.e. with the 'process' job engine the node
+# operation metrics stay in the short-lived worker processes.
+
+_DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600
+)
+
+
+def _labels_key(labels: Dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k,
+                         str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in items
+    ) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{_format_labels(key)} {value}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, fn: Callable = None):
+        super().__init__(name, help)
+        self._fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_labels_key(labels)] = value
+
+    def render(self):
+        if self._fn:
+            self.set(self._fn())
+        yield from super().render()
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets=_DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield labels
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        with self._lock:
+            values = [(k, list(c), s) for k, (c, s) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += count
+                le = _format_labels(key, (('le', bound), ))
+                yield f'{self.name}_bucket{le} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(key)} {total}'
+            yield f'{self.name}_count{_format_labels(key)} {cumulative}'
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(cls, name, *args, **kwargs):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = cls(name, *args, **kwargs)
+        return _registry[name]
+
+
+def counter(name: str, help: str) -> Counter:
+    return _register(Counter, name, help)
+
+
+def gauge(name: str, help: str, fn: Callable = None) -> Gauge:
+    return _register(Gauge, name, help, fn)
+
+
+def histogram(name: str, help: str, buckets=_DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help, buckets)
+
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return '\n'.join(line for m in metrics for line in m.render()) + '\n'
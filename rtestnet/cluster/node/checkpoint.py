@@ -0,0 +1,66 @@
+import os
+import json
+import threading
+
+from pathlib import Path
+
+# Results of the provisioning steps a job has finished, kept in the node's
+# private directory. They're only valid for the job that recorded them: a
+# job the controller resumes after a restart keeps its id and skips what
+# already finished, any other job starts over.
+
+
+class StepCheckpoints:
+    def __init__(self, path: Path = None, job_id: str = None):
+        self.path = path
+        self.job_id = job_id
+        self._lock = threading.Lock()
+        self._steps = self._load() if path and job_id else {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path and self.job_id)
+
+    def _load(self):
+        try:
+            data = json.loads(self.path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+        if data.get('job') != self.job_id:
+            return {}
+        return data.get('steps', {})
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_name(
+            f'.{self.path.name}.{os.getpid()}.{threading.get_ident()}'
+        )
+        tmp_file.write_text(
+            json.dumps({'job': self.job_id, 'steps': self._steps})
+        )
+        os.replace(tmp_file, self.path)
+
+    def get(self, step: str):
+        with self._lock:
+            return self._steps.get(step)
+
+    def any(self, steps) -> bool:
+        with self._lock:
+            return any(s in self._steps for s in steps)
+
+    def done(self, step: str, result=True):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._steps[step] = result
+            self._save()
+
+    def clear(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._steps = {}
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
@@ -1,9 +1,10 @@
+import os
 import sys
 import argparse
 
 from pathlib import Path
 
-from .. import ClusterContext
+from .. import ClusterContext, tracing
 from . import NodeError, NodeContext, NodeCtl
 
 
@@ -24,6 +25,12 @@ def create_arg_parser():
         type=lambda x: Path(x),
         help='Private directory (defaults to --conf-dir)'
     )
+    parser.add_argument(
+        '-j',
+        '--job-id',
+        default=None,
+        help='Controller job this run belongs to, enables step checkpoints'
+    )
     parser.add_argument('node', help='Name of the node')
     subparsers = parser.add_subparsers(dest='action', required=True)
 
@@ -43,6 +50,12 @@ def create_arg_parser():
                 'Like --clean-data, but also remove static external IP and DNS record'
             )
         )
+        clean_group.add_argument(
+            '-s',
+            '--suspend',
+            action='store_true',
+            help='Suspend the VM instance, keeping its memory, to resume later'
+        )
 
     p = subparsers.add_parser(
         'start', help='Start the node if it is not running'
@@ -52,33 +65,66 @@ def create_arg_parser():
     p = subparsers.add_parser('restart', help='stop followed by start')
     add_clean_options(p)
     p = subparsers.add_parser('lead', help='Add "boot" DNS record to this node')
+    p = subparsers.add_parser(
+        'snapshot', help='Snapshot the data disk of the node'
+    )
+    p.add_argument(
+        '-n',
+        '--name',
+        default=None,
+        help='Snapshot name (defaults to the node name and time)'
+    )
+    p.add_argument(
+        '--consistent',
+        action='store_true',
+        help='Stop the node while it is snapshotted'
+    )
 
     return parser
 
 
-def run_with_args(args):
-    ctx = NodeContext(
-        ClusterContext(args.conf_dir, args.private_dir or args.conf_dir),
-        args.node
-    )
-    ctl = NodeCtl(ctx)
-    if args.action == 'stop' or args.action == 'restart':
-        ctl.stop(clean=args.clean_data, mrproper=args.clean_all)
-        if args.action == 'restart':
+def run_action(
+    cluster_ctx, node, action, clean_data=False, clean_all=False,
+    cancelled=lambda: False, job_id=None, snapshot_name=None,
+    consistent=False, suspend=False
+):
+    ctl = NodeCtl(NodeContext(cluster_ctx, node), job_id)
+    if action == 'stop' or action == 'restart':
+        ctl.stop(clean=clean_data, mrproper=clean_all, suspend=suspend)
+        if action == 'restart' and not cancelled():
             ctl.start()
-    elif args.action == 'start':
+    elif action == 'start':
         ctl.start()
-    elif args.action == 'lead':
+    elif action == 'lead':
         ctl.make_leader()
+    elif action == 'snapshot':
+        ctl.snapshot(snapshot_name, consistent=consistent)
     else:
-        raise RuntimeError(f'Invalid action "{args.action}"')
+        raise RuntimeError(f'Invalid action "{action}"')
+    ctl.checkpoints.clear()
+
+
+def run_with_args(args):
+    run_action(
+        ClusterContext(args.conf_dir, args.private_dir or args.conf_dir),
+        args.node,
+        args.action,
+        clean_data=getattr(args, 'clean_data', False),
+        clean_all=getattr(args, 'clean_all', False),
+        job_id=args.job_id,
+        snapshot_name=getattr(args, 'name', None),
+        consistent=getattr(args, 'consistent', False),
+        suspend=getattr(args, 'suspend', False)
+    )
 
 
 def main():
     args = create_arg_parser().parse_args()
     ec = 0
+    tracing.attach_traceparent(os.environ.get(tracing.TRACEPARENT_ENV))
     try:
-        run_with_args(args)
+        with tracing.span('node cli', node=args.node, action=args.action):
+            run_with_args(args)
     except NodeError as e:
         print('ERROR:', e, file=sys.stderr)
         if e.__cause__:
@@ -1,14 +1,44 @@
+import copy
 import json
+import hashlib
+import threading
 import os, os.path
 
+from collections import OrderedDict
 from pathlib import Path
 
 from pyhocon import ConfigFactory
-from schema import Schema, SchemaError, And, Use, Optional as Opt
-from deepmerge import always_merger as merger
+from schema import Schema, SchemaError, And, Or, Use, Optional as Opt
+from deepmerge import Merger
 
-_CONFIG_SCHEMA = Schema(
+from . import NodeError
+from .. import metrics
+
+_COMMON_KEYS = {
+    Opt('backend', default='gce'): Or('gce', 'local'),
+    Opt('gce_name'): And(str, len),
+    Opt('gce_name_prefix', default=''): str,
+    Opt('dns_name'): And(str, len),
+    Opt('data_disk_snapshot'): And(str, len),
+    Opt('labels'): {str: str},
+    Opt('rnode_tls_key'): And(str, len),
+    Opt('rdoctor_key'): And(str, len),
+    # HOCON, checked by _HOCON_SCHEMA
+    Opt('rnode_config'): str,
+    Opt('rnode_config_override'): str,
+}
+
+# Only checked; configs keep the HOCON strings so they stay JSON
+_HOCON_SCHEMA = Schema(
     {
+        Opt('rnode_config'): Use(ConfigFactory.parse_string),
+        Opt('rnode_config_override'): Use(ConfigFactory.parse_string),
+        object: object,
+    }
+)
+
+_BACKEND_KEYS = {
+    'gce': {
         'gce_zone': And(str, len),
         'gce_machine_type': And(str, len),
         'gce_boot_image': And(str, len),
@@ -19,47 +49,209 @@ _CONFIG_SCHEMA = Schema(
         'gdns_domain': And(str, len),
         'data_disk_size': And(Use(int), lambda n: n > 0),
         Opt('data_disk_type_ssd', default=False): bool,
-        Opt('gce_name'): And(str, len),
-        Opt('gce_name_prefix', default=''): str,
-        Opt('rnode_tls_key'): And(str, len),
-        Opt('rdoctor_key'): And(str, len),
-        Opt('rnode_config'): Use(ConfigFactory.parse_string),
-        Opt('rnode_config_override'): Use(ConfigFactory.parse_string),
-    }
+        Opt('data_disk_image'): And(str, len),
+        Opt('warm_pool_size'): And(Use(int), lambda n: n >= 0),
+        Opt('gce_inventory_ttl'): And(Use(float), lambda n: n >= 0),
+        # Seconds to wait for a zone operation before the job fails
+        Opt('gce_operation_timeout'): And(Use(float), lambda n: n > 0),
+    },
+    'local': {
+        # See rtestnet.cluster.node.local
+        Opt('local_mode', default='process'): Or('process', 'container'),
+        Opt('local_command'): [And(str, len)],
+        Opt('local_image'): And(str, len),
+        Opt('local_runtime', default='docker'): And(str, len),
+        Opt('local_ports', default=[]): [And(str, len)],
+        Opt('local_port_range', default=[40000, 49999]): And(
+            [Use(int)], lambda r: len(r) == 2 and 0 < r[0] <= r[1] < 65536
+        ),
+        Opt('local_host', default='127.0.0.1'): And(str, len),
+        Opt('local_domain', default='local'): And(str, len),
+        Opt('local_stop_timeout', default=30):
+            And(Use(float), lambda n: n >= 0),
+    },
+}
+
+_CONFIG_SCHEMAS = {
+    backend: Schema({**_COMMON_KEYS, **keys})
+    for backend, keys in _BACKEND_KEYS.items()
+}
+
+# Lists of a later file replace earlier ones, so merging the state file a
+# node was started with doesn't repeat e.g. gce_tags
+merger = Merger([(dict, ['merge']), (list, ['override'])], ['override'],
+                ['override'])
+
+# Bound on the number of validated config digests kept in the cache file
+_MAX_VALIDATED = 4096
+
+_load_latency = metrics.histogram(
+    'rtestnet_config_load_seconds', 'Node config load time'
 )
 
 
+class NodeConfigError(NodeError):
+    pass
+
+
+def _validate(kvs, check_hocon=True):
+    # Returns kvs with values converted and defaults filled in. Parsing the
+    # HOCON is the expensive part, skipped for configs that passed before.
+    backend = kvs.get('backend', 'gce')
+    if backend not in _CONFIG_SCHEMAS:
+        raise NodeConfigError(f'Unknown backend "{backend}"')
+    try:
+        if check_hocon:
+            _HOCON_SCHEMA.validate(kvs)
+        return _CONFIG_SCHEMAS[backend].validate(kvs)
+    except SchemaError as e:
+        raise NodeConfigError('Invalid configuration') from e
+
+
+def _stat_key(path: Path):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _digest(kvs) -> str:
+    return hashlib.sha256(
+        json.dumps(kvs, sort_keys=True).encode()
+    ).hexdigest()
+
+
+class _ConfigCache:
+    # Parsed config files keyed by path and (mtime, size), the latest merged
+    # config of each list of sources with their stat keys, and the digests
+    # of the last _MAX_VALIDATED merged configs that passed validation.
+    # Only the digests are persisted; parsing JSON and converting values is
+    # cheap, parsing rnode_config HOCON is not.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+        self._merged = {}
+        self._validated = OrderedDict()
+        self._loaded_files = set()
+
+    def load_file(self, path: Path, parse=json.loads):
+        key = _stat_key(path)
+        if key is None:
+            return {}, -1
+        with self._lock:
+            cached = self._files.get(path)
+        if not cached or cached[0] != key:
+            cached = key, parse(path.read_text())
+            with self._lock:
+                self._files[path] = cached
+        return cached[1], key[0] / 1e9
+
+    def get_merged(self, paths):
+        paths = tuple(paths)
+        key = paths, tuple(_stat_key(p) for p in paths)
+        with self._lock:
+            cached = self._merged.get(paths)
+        if cached and cached[0] == key[1]:
+            return key, cached[1]
+        return key, None
+
+    def put_merged(self, key, value):
+        # Replaces the merge of older versions of the same sources
+        paths, stat_keys = key
+        with self._lock:
+            self._merged[paths] = stat_keys, value
+
+    def _add_validated(self, digests):
+        for digest in digests:
+            self._validated[digest] = True
+            self._validated.move_to_end(digest)
+        while len(self._validated) > _MAX_VALIDATED:
+            self._validated.popitem(last=False)
+
+    def _load_validated(self, cache_file: Path):
+        if cache_file in self._loaded_files:
+            return
+        self._loaded_files.add(cache_file)
+        try:
+            self._add_validated(
+                json.loads(cache_file.read_text())['validated']
+            )
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def is_validated(self, digest: str, cache_file: Path = None) -> bool:
+        with self._lock:
+            if cache_file:
+                self._load_validated(cache_file)
+            return digest in self._validated
+
+    def set_validated(self, digest: str, cache_file: Path = None):
+        with self._lock:
+            self._add_validated([digest])
+            if not cache_file:
+                return
+            validated = list(self._validated)
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(
+                f'.{cache_file.name}.{os.getpid()}.{threading.get_ident()}'
+            )
+            tmp_file.write_text(json.dumps({'validated': validated}))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+
+_cache = _ConfigCache()
+
+
 class NodeConfig(dict):
-    def __init__(self, mtime, kvs):
+    def __init__(self, mtime, kvs, digest=None):
         self.mtime = mtime
+        self.digest = digest or _digest(kvs)
         self.update(kvs)
 
     @staticmethod
     def try_load_file(path: Path, parse=json.loads, default={}):
-        kvs, mtime = default, -1
-        if path.exists():
-            kvs = parse(path.read_text())
-            mtime = os.path.getmtime(path)
+        kvs, mtime = _cache.load_file(path, parse)
+        if mtime < 0:
+            return default, mtime
         return kvs, mtime
 
     @classmethod
-    def load(cls, *paths: Path):
+    def load(cls, *paths: Path, cache_file: Path = None):
+        with _load_latency.time() as labels:
+            key, cached = _cache.get_merged(paths)
+            labels['cache'] = 'hit' if cached else 'miss'
+            if cached:
+                mtime, kvs, digest = cached
+                return cls(mtime, copy.deepcopy(kvs), digest)
+            return cls._load(key, paths, cache_file)
+
+    @classmethod
+    def _load(cls, key, paths, cache_file):
         mtime, kvs = -1, {}
         for p in paths:
             _kvs, _mtime = cls.try_load_file(p)
             if _mtime > mtime:
                 mtime = _mtime
-            kvs = merger.merge(kvs, _kvs)
+            # Cached file contents must not be aliased by the merge result
+            kvs = merger.merge(kvs, copy.deepcopy(_kvs))
         if mtime < 0:
-            raise NodeCtlError(
+            raise NodeConfigError(
                 'No configuration file found. Tried:\n' +
                 '\n'.join(['  {}'.format(p) for p in paths])
             )
-        try:
-            _CONFIG_SCHEMA.validate(kvs)
-        except SchemaError as e:
-            raise NodeCtlError('Invalid configuration') from e
-        return cls(mtime, kvs)
+        digest = _digest(kvs)
+        validated = _cache.is_validated(digest, cache_file)
+        kvs = _validate(kvs, check_hocon=not validated)
+        if not validated:
+            _cache.set_validated(digest, cache_file)
+        digest = _digest(kvs)
+        _cache.put_merged(key, (mtime, kvs, digest))
+        return cls(mtime, copy.deepcopy(kvs), digest)
 
     def save(self, path: Path):
         path.parent.mkdir(exist_ok=True)
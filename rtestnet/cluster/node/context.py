@@ -22,3 +22,19 @@ class NodeContext:
     @property
     def config_state_file(self) -> Path:
         return self.private_dir / '_cached.config.json'
+
+    @property
+    def step_checkpoint_file(self) -> Path:
+        return self.private_dir / '_steps.json'
+
+    @property
+    def local_state_file(self) -> Path:
+        return self.private_dir / '_local.json'
+
+    @property
+    def local_data_dir(self) -> Path:
+        return self.private_dir / 'data'
+
+    @property
+    def local_log_file(self) -> Path:
+        return self.private_dir / 'rnode.log'
@@ -1,6 +1,15 @@
-from .. import ClusterContext
+import time
+import logging
+
+from typing import List
+
+from .. import ClusterContext, tracing
 from . import NodeError, NodeContext, NodeConfig, NodeFiles
-from .ops import NodeOpsGCE
+from .checkpoint import StepCheckpoints
+from .ops import create_node_ops
+from .pool import WarmPool
+
+logger = logging.getLogger(__name__)
 
 
 class NodeCtlError(NodeError):
@@ -8,36 +17,129 @@ class NodeCtlError(NodeError):
 
 
 class NodeCtl:
-    def __init__(self, ctx: NodeContext):
+    def __init__(self, ctx: NodeContext, job_id: str = None):
         self.ctx = ctx
+        self.checkpoints = StepCheckpoints(ctx.step_checkpoint_file, job_id)
+        self.pool = WarmPool(ctx.cluster)
 
-    def _load_config(self):
-        config = NodeConfig.load(
+    def load_config(self, with_state=True):
+        # The state file holds the config the node was started with
+        paths = [
             self.ctx.cluster.config_defaults_file,
-            self.ctx.config_override_file, self.ctx.config_state_file
+            self.ctx.config_override_file,
+        ]
+        if with_state:
+            paths.append(self.ctx.config_state_file)
+        config = NodeConfig.load(
+            *paths, cache_file=self.ctx.cluster.config_cache_file
         )
         if 'gce_name' not in config:
             prefix = config.get('gce_name_prefix', '')
             config['gce_name'] = prefix + self.ctx.name
+        if 'dns_name' not in config:
+            config['dns_name'] = config['gce_name']
+        # A node running on a warm pool VM is known by its DNS name only
+        claimed = self.pool.claimed(self.ctx.name)
+        if claimed:
+            config['gce_name'] = claimed
         return config
 
-    def _get_node_ops(self):
-        return NodeOpsGCE(self._load_config())
+    def pending_changes(self) -> List[str]:
+        # What a restart would change on a started node: its config and its
+        # rnode.conf. None if it isn't started, it gets both when it is.
+        if not self.ctx.config_state_file.exists():
+            return None
+        # Loaded like the config, so that a state file saved before
+        # defaults were filled in compares equal
+        started = NodeConfig.load(
+            self.ctx.config_state_file,
+            cache_file=self.ctx.cluster.config_cache_file
+        )
+        config = self.load_config(with_state=False)
+        changes = []
+        if config != started:
+            changes.append('config')
+        files = NodeFiles(self.ctx, config)
+        try:
+            current = files.rnode_conf_file.read_text()
+        except FileNotFoundError:
+            current = None
+        if files.render_rnode_conf() != current:
+            changes.append('rnode.conf')
+        return changes
+
+    def _get_node_ops(self, config=None):
+        return create_node_ops(
+            self.ctx,
+            config or self.load_config(),
+            checkpoints=self.checkpoints
+        )
 
-    def stop(self, clean=False, mrproper=False):
-        self._get_node_ops().stop(clean=clean, mrproper=mrproper)
+    def _claim_pool_vm(self, ops):
+        # Returns ops of a VM claimed from the warm pool for a node that
+        # has none yet, or the given ops
+        config = ops.config
+        if (
+            not config.get('warm_pool_size') or
+            self.pool.claimed(self.ctx.name) or ops.vm_exists()
+        ):
+            return ops
+        name = self.pool.claim(self.ctx.name, config)
+        if not name:
+            return ops
+        config['gce_name'] = name
+        pool_ops = self._get_node_ops(config)
+        try:
+            pool_ops.adopt_pool_vm(self.ctx.name)
+        except NodeError:
+            logger.warning(
+                'Could not adopt pool instance %s', name, exc_info=True
+            )
+            self.pool.release(self.ctx.name)
+            return self._get_node_ops()
+        return pool_ops
+
+    def stop(self, clean=False, mrproper=False, suspend=False):
+        # A resumed restart doesn't stop the node it already started again
+        if self.checkpoints.get('stopped'):
+            return
+        claimed = self.pool.claimed(self.ctx.name)
+        with tracing.span('node stop', node=self.ctx.name):
+            ops = self._get_node_ops()
+            ops.stop(clean=clean, mrproper=mrproper, suspend=suspend)
+            if claimed and clean and not mrproper:
+                ops.delete_pool_addr()
+        if clean or mrproper:
+            # The claimed pool VM is gone, the next start claims or creates
+            # another one
+            self.pool.release(self.ctx.name)
         if self.ctx.config_state_file.exists():
             self.ctx.config_state_file.unlink()
+        self.checkpoints.done('stopped')
 
     def start(self):
-        ops = self._get_node_ops()
-        NodeFiles(self.ctx, ops.config).update()
-        ops.start()
-        ops.config.save(self.ctx.config_state_file)
+        with tracing.span('node start', node=self.ctx.name):
+            ops = self._claim_pool_vm(self._get_node_ops())
+            NodeFiles(self.ctx, ops.config).update()
+            ops.start()
+            ops.config.save(self.ctx.config_state_file)
 
-    def restart(self, clean=False, mrproper=False):
-        self.stop(clean=clean, mrproper=mrproper)
+    def restart(self, clean=False, mrproper=False, suspend=False):
+        self.stop(clean=clean, mrproper=mrproper, suspend=suspend)
         self.start()
 
+    def snapshot(self, name=None, consistent=False):
+        config = self.load_config()
+        if not name:
+            name = '{}{}-{}'.format(
+                config.get('gce_name_prefix', ''), self.ctx.name,
+                time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+            )
+        with tracing.span('node snapshot', node=self.ctx.name):
+            self._get_node_ops(config).snapshot(name, consistent=consistent)
+        logger.info('Node %s snapshotted to %s', self.ctx.name, name)
+        return name
+
     def make_leader(self):
-        self._get_node_ops().add_dns_rec('boot', 0)
+        with tracing.span('node lead', node=self.ctx.name):
+            self._get_node_ops().add_dns_rec('boot', 0)
@@ -0,0 +1,192 @@
+import time
+import logging
+import threading
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from . import NodeError
+from .gce import GCESession
+
+logger = logging.getLogger(__name__)
+
+
+class DNSZoneError(NodeError):
+    pass
+
+
+def _absolute(fqdn: str) -> str:
+    return fqdn if fqdn.endswith('.') else fqdn + '.'
+
+
+@dataclass
+class _ChangeRequest:
+    # (fqdn, type) -> desired {'ttl', 'rrdatas'} or None to delete
+    changes: Dict[Tuple[str, str], Optional[Dict]]
+    done: threading.Event = field(default_factory=threading.Event)
+    error: Exception = None
+
+
+class DNSZone:
+    # Local index of one Cloud DNS managed zone. The index is loaded with a
+    # single list call and kept coherent with the changes made through it.
+    # Changes submitted by concurrent callers within batch_window seconds
+    # are committed as one atomic change set.
+
+    def __init__(
+        self,
+        session: GCESession,
+        name: str,
+        max_age: float = 60.0,
+        batch_window: float = 0.05
+    ):
+        self._session = session
+        self.name = name
+        self.max_age = max_age
+        self.batch_window = batch_window
+        self._zone = None
+        self._records = {}
+        self._loaded_at = None
+        self._index_lock = threading.RLock()
+        self._commit_lock = threading.Lock()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+
+    @property
+    def _driver(self):
+        return self._session.dns()
+
+    def refresh(self):
+        with self._index_lock:
+            driver = self._driver
+            if not self._zone:
+                self._zone = driver.get_zone(self.name)
+            records = {}
+            for rec in driver.list_records(self._zone):
+                rrset = {
+                    'name': _absolute(rec.name),
+                    'type': rec.type,
+                    'ttl': rec.data['ttl'],
+                    'rrdatas': list(rec.data['rrdatas']),
+                }
+                records[(rrset['name'], rrset['type'])] = rrset
+            self._records = records
+            self._loaded_at = time.monotonic()
+            logger.debug(
+                'Loaded %d records of DNS zone %s', len(records), self.name
+            )
+
+    def _ensure_fresh(self):
+        with self._index_lock:
+            if (
+                self._loaded_at is None or
+                time.monotonic() - self._loaded_at > self.max_age
+            ):
+                self.refresh()
+
+    def get(self, fqdn: str, rtype: str = 'A') -> Optional[Dict]:
+        self._ensure_fresh()
+        with self._index_lock:
+            rrset = self._records.get((_absolute(fqdn), rtype))
+            return dict(rrset) if rrset else None
+
+    def upsert(self, fqdn: str, rrdatas: List[str], ttl: int, rtype='A'):
+        self.change({(fqdn, rtype): {'ttl': ttl, 'rrdatas': rrdatas}})
+
+    def delete(self, fqdn: str, rtype='A'):
+        self.change({(fqdn, rtype): None})
+
+    def change(self, changes: Dict[Tuple[str, str], Optional[Dict]]):
+        req = _ChangeRequest({
+            (_absolute(fqdn), rtype): rrset
+            for (fqdn, rtype), rrset in changes.items()
+        })
+        with self._pending_lock:
+            self._pending.append(req)
+            leader = len(self._pending) == 1
+        if leader:
+            # The first submitter waits for others to join and commits the
+            # whole batch on their behalf
+            time.sleep(self.batch_window)
+            with self._pending_lock:
+                batch, self._pending = self._pending, []
+            self._commit_batch(batch)
+        req.done.wait()
+        if req.error:
+            raise DNSZoneError(
+                f'Failed to update DNS zone {self.name}'
+            ) from req.error
+
+    def _diff(self, desired):
+        additions, deletions = [], []
+        for key, rrset in desired.items():
+            current = self._records.get(key)
+            if rrset is not None:
+                rrset = dict(rrset, name=key[0], type=key[1])
+                rrset['rrdatas'] = list(rrset['rrdatas'])
+            if current == rrset:
+                continue
+            if current:
+                deletions.append(current)
+            if rrset:
+                additions.append(rrset)
+        return additions, deletions
+
+    def _commit_batch(self, batch: List[_ChangeRequest]):
+        desired = {}
+        for req in batch:
+            desired.update(req.changes)
+        try:
+            with self._commit_lock:
+                self._ensure_fresh()
+                try:
+                    self._commit(desired)
+                except Exception:
+                    # Most likely a conflict with a change made elsewhere
+                    logger.debug(
+                        'DNS change set failed, retrying with fresh index',
+                        exc_info=True
+                    )
+                    self.refresh()
+                    self._commit(desired)
+        except Exception as e:
+            for req in batch:
+                req.error = e
+        finally:
+            for req in batch:
+                req.done.set()
+
+    def _commit(self, desired):
+        with self._index_lock:
+            additions, deletions = self._diff(desired)
+        if not additions and not deletions:
+            return
+        logger.debug(
+            'Committing DNS change set to %s: +%d -%d', self.name,
+            len(additions), len(deletions)
+        )
+        self._driver.ex_bulk_record_changes(
+            self._zone, {
+                'additions': additions,
+                'deletions': deletions
+            }
+        )
+        with self._index_lock:
+            for rrset in deletions:
+                self._records.pop((rrset['name'], rrset['type']), None)
+            for rrset in additions:
+                self._records[(rrset['name'], rrset['type'])] = rrset
+
+
+_zones = {}
+_zones_lock = threading.Lock()
+
+
+def get_dns_zone(session: GCESession, name: str) -> DNSZone:
+    with _zones_lock:
+        key = (session, name)
+        zone = _zones.get(key)
+        if not zone:
+            zone = DNSZone(session, name)
+            _zones[key] = zone
+        return zone
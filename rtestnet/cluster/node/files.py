@@ -1,18 +1,96 @@
-import os.path
 import json
+import os
+import threading
 
+from collections import OrderedDict
+from concurrent import futures
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Dict
 
 from pyhocon import ConfigFactory
-from deepmerge import always_merger as merger
 
 from . import NodeContext, NodeConfig
+from .. import metrics
 
-def _mtime(path: Path):
-    if path.exists():
-        return os.path.getmtime(path)
-    return -1
+_render_latency = metrics.histogram(
+    'rtestnet_rnode_conf_render_seconds', 'rnode.conf render time'
+)
+
+# Renders by their inputs; nodes without overrides all share one
+_MAX_RENDERS = 256
+
+_hocon_cache = {}
+_render_cache = OrderedDict()
+_cache_lock = threading.Lock()
+# One per file, so that concurrent renders of a changed file wait for a
+# single parse rather than each parsing it
+_parse_locks = {}
+
+
+def _stat_key(path: Path):
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _parse_hocon_file(path: Path, key):
+    # Parsed once per (mtime, size) into plain dicts shared by all callers,
+    # which must not modify them
+    if key is None:
+        return {}
+    with _cache_lock:
+        cached = _hocon_cache.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        parse_lock = _parse_locks.setdefault(path, threading.Lock())
+    with parse_lock:
+        with _cache_lock:
+            cached = _hocon_cache.get(path)
+        if not cached or cached[0] != key:
+            tree = ConfigFactory.parse_file(str(path))
+            cached = key, tree.as_plain_ordered_dict()
+            with _cache_lock:
+                _hocon_cache[path] = cached
+    return cached[1]
+
+
+def _as_hocon(value):
+    if isinstance(value, str):
+        return ConfigFactory.parse_string(value).as_plain_ordered_dict()
+    return value
+
+
+def _merge(base, override):
+    # deepmerge's always_merger without modifying either argument: only the
+    # dicts on the paths override touches are copied
+    if isinstance(base, dict) and isinstance(override, dict):
+        merged = dict(base)
+        for k, v in override.items():
+            merged[k] = _merge(base[k], v) if k in base else v
+        return merged
+    if isinstance(base, list) and isinstance(override, list):
+        return base + override
+    if isinstance(base, set) and isinstance(override, set):
+        return base | override
+    return override
+
+
+def _write_if_changed(path: Path, content: str) -> bool:
+    try:
+        if path.read_text() == content:
+            return False
+    except FileNotFoundError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_name(
+        f'.{path.name}.{os.getpid()}.{threading.get_ident()}'
+    )
+    tmp_file.write_text(content)
+    os.replace(tmp_file, path)
+    return True
 
 
 @dataclass
@@ -31,30 +109,79 @@ class NodeFiles:
     def _node_dir(self):
         return
 
-    def _update_rnode_conf(self):
+    @property
+    def rnode_conf_file(self) -> Path:
+        return self.ctx.conf_dir / 'rnode.conf'
+
+    def render_rnode_conf(self) -> str:
+        with _render_latency.time():
+            return self._render_rnode_conf()
+
+    def _render_inputs(self):
+        if 'rnode_config' in self.config:
+            return ('config', json.dumps(self.config['rnode_config']))
         defaults_file = self.ctx.cluster.conf_dir / 'rnode.conf'
+        inputs = (defaults_file, _stat_key(defaults_file))
+        if 'rnode_config_override' in self.config:
+            return inputs + (
+                'config', json.dumps(self.config['rnode_config_override'])
+            )
         override_file = self.ctx.conf_dir / 'rnode.override.conf'
-        output_file = self.ctx.conf_dir / 'rnode.conf'
-
-        output_file_t = _mtime(override_file)
-        if (
-            self.config.mtime > output_file_t and (
-                'rnode_config' in self.config or
-                'rnode_config_override' in self.config
-            ) or
-            max(_mtime(defaults_file), _mtime(override_file)) > output_file_t
-        ):
-            output = {}
-            if 'rnode_config' in self.config:
-                output = self.config['rnode_config']
+        override_key = _stat_key(override_file)
+        if override_key is None:
+            return inputs
+        return inputs + (override_file, override_key)
+
+    def _render_rnode_conf(self) -> str:
+        # Rendered again only when a source file or the config changed
+        inputs = self._render_inputs()
+        with _cache_lock:
+            output = _render_cache.get(inputs)
+            if output is not None:
+                _render_cache.move_to_end(inputs)
+                return output
+        if 'rnode_config' in self.config:
+            output = _as_hocon(self.config['rnode_config'])
+        else:
+            defaults = _parse_hocon_file(inputs[0], inputs[1])
+            if 'rnode_config_override' in self.config:
+                override = _as_hocon(self.config['rnode_config_override'])
+            elif len(inputs) > 2:
+                override = _parse_hocon_file(inputs[2], inputs[3])
             else:
-                defaults = {}
-                if defaults_file.exists():
-                    defaults = ConfigFactory.parse_file(defaults_file)
                 override = {}
-                if 'rnode_config_override' in self.config:
-                    override = self.config['rnode_config_override']
-                elif override_file.exists():
-                    override = ConfigFactory.parse_file(override_file)
-                output = merger.merge(defaults, override)
-            output_file.write_text(json.dumps(outout))
+            output = _merge(defaults, override)
+        output = json.dumps(output)
+        with _cache_lock:
+            _render_cache[inputs] = output
+            while len(_render_cache) > _MAX_RENDERS:
+                _render_cache.popitem(last=False)
+        return output
+
+    def _update_rnode_conf(self) -> bool:
+        # Rewritten only when the rendered content differs, so touching a
+        # source file doesn't look like a configuration change
+        return _write_if_changed(self.rnode_conf_file, self.render_rnode_conf())
+
+    @classmethod
+    def update_rnode_confs(
+        cls, configs: Dict[NodeContext, NodeConfig], max_workers=16
+    ) -> Dict[str, bool]:
+        # Renders rnode.conf of many nodes and writes the changed ones.
+        # Rendering runs here, node after node: each source file is parsed
+        # once and nodes with the same inputs share a render, so threads
+        # would only contend for the GIL. The writes run concurrently.
+        # Returns which nodes' files were changed.
+        rendered = {
+            ctx: cls(ctx, config).render_rnode_conf()
+            for ctx, config in configs.items()
+        }
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            changed = {
+                ctx.name: executor.submit(
+                    _write_if_changed, cls(ctx, configs[ctx]).rnode_conf_file,
+                    output
+                )
+                for ctx, output in rendered.items()
+            }
+            return {name: f.result() for name, f in changed.items()}
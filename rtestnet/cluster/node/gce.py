@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import functools
+import threading
+
+from pathlib import Path
+
+from libcloud.compute.drivers.gce import GCENodeDriver
+from libcloud.dns.drivers.google import GoogleDNSDriver
+
+from . import NodeError
+from .. import metrics, tracing
+from .scheduler import ApiScheduler, get_scheduler
+
+_api_calls = metrics.counter(
+    'rtestnet_cloud_api_calls_total',
+    'Cloud API calls by API, method and outcome'
+)
+_api_latency = metrics.histogram(
+    'rtestnet_cloud_api_call_seconds', 'Cloud API call latency'
+)
+_api_requests = metrics.counter(
+    'rtestnet_cloud_api_requests_total',
+    'Cloud API HTTP requests by API and request class'
+)
+
+
+class GCESessionError(NodeError):
+    pass
+
+
+def request_kind(action: str) -> str:
+    # '/zones/z/instances/vm/stop' -> 'instances.stop'
+    segments = action.split('?')[0].strip('/').split('/')
+    if segments[:1] == ['zones'] or segments[:1] == ['regions']:
+        segments = segments[2:]
+    return '.'.join(segments[0::2]) or '/'
+
+
+_READ_PREFIXES = ('get_', 'list_', 'iterate_', 'ex_get_', 'ex_list_')
+
+
+def _request_class(method: str) -> str:
+    if method.startswith('GET ') or method.startswith(_READ_PREFIXES):
+        return 'read'
+    return 'write'
+
+
+def schedule_requests(connection, api: str, scheduler: ApiScheduler):
+    # Every HTTP request of a driver takes a token of the project's
+    # ApiScheduler, including the ones libcloud makes within a single
+    # driver method: resource lookups, pages of a listing and its own
+    # polling of operations
+    request = connection.request
+
+    def counted(request_class, *args, **kwargs):
+        _api_requests.inc(api=api, request_class=request_class)
+        return request(*args, **kwargs)
+
+    @functools.wraps(request)
+    def scheduled(action, *args, **kwargs):
+        request_class = 'read' if kwargs.get('method', 'GET') == 'GET' \
+            else 'write'
+        return scheduler.call(
+            api, request_class, counted, request_class, action, *args,
+            **kwargs
+        )
+
+    connection.request = scheduled
+
+
+class _Instrumented:
+    # Proxy recording the count and latency of every public method call,
+    # and of raw requests made through the driver's connection
+
+    def __init__(self, target, api: str, method_name=None):
+        self._target = target
+        self._api = api
+        self._method_name = method_name
+
+    def _timed(self, method, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            outcome = 'error'
+            try:
+                with tracing.span('api', api=self._api, method=method):
+                    result = fn(*args, **kwargs)
+                outcome = 'ok'
+                return result
+            finally:
+                _api_latency.observe(
+                    time.monotonic() - start, api=self._api, method=method
+                )
+                _api_calls.inc(api=self._api, method=method, outcome=outcome)
+
+        return timed
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name == 'connection':
+            return _Instrumented(attr, self._api, request_kind)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        if self._method_name:
+            if name != 'request':
+                return attr
+
+            def request(action, *args, **kwargs):
+                method = kwargs.get('method', 'GET') + ' ' + \
+                    self._method_name(action)
+                return self._timed(method, attr)(action, *args, **kwargs)
+
+            return request
+        return self._timed(name, attr)
+
+
+class GCESession:
+    # Process-wide holder of libcloud drivers for one service account.
+    #
+    # libcloud connections are not thread-safe, so drivers are kept per
+    # thread. Each driver keeps its keep-alive HTTP connection open and
+    # refreshes its OAuth token only when it expires; the token itself is
+    # persisted by libcloud in its auth cache file, so drivers created by
+    # other threads pick it up instead of doing a new token exchange.
+
+    def __init__(self, credentials_file: Path):
+        self.credentials_file = credentials_file
+        try:
+            credentials = json.loads(Path(credentials_file).read_text())
+            self.client_email = credentials['client_email']
+            self.project = credentials['project_id']
+        except Exception as e:
+            raise GCESessionError(
+                f'Could not read credentials_file = "{credentials_file}"'
+            ) from e
+        self.scheduler = get_scheduler(self.project)
+        self._local = threading.local()
+
+    def _drivers(self):
+        try:
+            return self._local.drivers
+        except AttributeError:
+            self._local.drivers = {}
+            return self._local.drivers
+
+    def compute(self, zone: str) -> GCENodeDriver:
+        drivers = self._drivers()
+        key = ('compute', zone)
+        if key not in drivers:
+            driver = GCENodeDriver(
+                self.client_email,
+                str(self.credentials_file),
+                project=self.project,
+                datacenter=zone
+            )
+            schedule_requests(driver.connection, 'compute', self.scheduler)
+            drivers[key] = _Instrumented(driver, 'compute')
+        return drivers[key]
+
+    def dns(self) -> GoogleDNSDriver:
+        drivers = self._drivers()
+        key = ('dns', )
+        if key not in drivers:
+            driver = GoogleDNSDriver(
+                self.client_email,
+                str(self.credentials_file),
+                project=self.project
+            )
+            schedule_requests(driver.connection, 'dns', self.scheduler)
+            drivers[key] = _Instrumented(driver, 'dns')
+        return drivers[key]
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_session_override = None
+
+
+def set_session_override(session: GCESession):
+    # Makes get_session() return the given session, e.g. a fake cloud
+    global _session_override
+    _session_override = session
+
+
+def get_session(credentials_file=None) -> GCESession:
+    if _session_override:
+        return _session_override
+    if not credentials_file:
+        try:
+            credentials_file = os.environ['GOOGLE_APPLICATION_CREDENTIALS']
+        except KeyError:
+            raise GCESessionError(
+                'You must pass path to credentials file either as ' +
+                'credentials_file argument or in ' +
+                'GOOGLE_APPLICATION_CREDENTIALS environment variable'
+            ) from None
+    path = Path(credentials_file).resolve()
+    try:
+        st = path.stat()
+    except OSError as e:
+        raise GCESessionError(
+            f'Could not read credentials_file = "{credentials_file}"'
+        ) from e
+    # Rotated credentials get a fresh session
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if not session:
+            session = GCESession(path)
+            _sessions[key] = session
+        return session
@@ -0,0 +1,114 @@
+import time
+import logging
+import threading
+
+from typing import Callable
+
+from libcloud.common.google import ResourceNotFoundError
+
+from .gce import GCESession
+
+logger = logging.getLogger(__name__)
+
+VM, ADDR, DISK = 'vm', 'addr', 'disk'
+
+
+class GCEInventory:
+    # Snapshot of the instances, disks and addresses of one zone, fetched
+    # with three list calls and indexed by name. Entries touched by a
+    # mutation can be invalidated individually; they are then fetched with
+    # a single GET on next lookup until the whole snapshot is refreshed.
+    # Another process may have created a resource since the snapshot was
+    # taken, so a miss is confirmed with a GET too unless the caller only
+    # observes.
+
+    def __init__(self, session: GCESession, zone: str, max_age=30.0):
+        self._session = session
+        self.zone = zone
+        self.region = zone.rsplit('-', 1)[0]
+        self.max_age = max_age
+        self._index = {VM: {}, ADDR: {}, DISK: {}}
+        self._stale = {VM: set(), ADDR: set(), DISK: set()}
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        compute = self._session.compute(self.zone)
+        with self._lock:
+            self._index = {
+                VM: {
+                    n.name: n
+                    for n in compute.list_nodes(ex_zone=self.zone)
+                },
+                ADDR: {
+                    a.name: a
+                    for a in compute.ex_list_addresses(region=self.region)
+                },
+                DISK: {
+                    d.name: d
+                    for d in compute.list_volumes(ex_zone=self.zone)
+                },
+            }
+            self._stale = {VM: set(), ADDR: set(), DISK: set()}
+            self._loaded_at = time.monotonic()
+            logger.debug(
+                'Loaded inventory of %s: %d instances, %d addresses, '
+                '%d disks', self.zone, len(self._index[VM]),
+                len(self._index[ADDR]), len(self._index[DISK])
+            )
+
+    def _ensure_fresh(self):
+        with self._lock:
+            if (
+                self._loaded_at is None or
+                time.monotonic() - self._loaded_at > self.max_age
+            ):
+                self.refresh()
+
+    def lookup(
+        self, kind: str, name: str, fetch: Callable, confirm_miss=True
+    ):
+        self._ensure_fresh()
+        with self._lock:
+            if name not in self._stale[kind]:
+                obj = self._index[kind].get(name)
+                if obj is not None or not confirm_miss:
+                    return obj
+        try:
+            obj = fetch()
+        except ResourceNotFoundError:
+            obj = None
+        self.update(kind, name, obj)
+        return obj
+
+    def update(self, kind: str, name: str, obj):
+        with self._lock:
+            self._stale[kind].discard(name)
+            if obj is None:
+                self._index[kind].pop(name, None)
+            else:
+                self._index[kind][name] = obj
+
+    def invalidate(self, kind: str, name: str):
+        with self._lock:
+            self._stale[kind].add(name)
+
+    def names(self, kind: str):
+        self._ensure_fresh()
+        with self._lock:
+            return list(self._index[kind])
+
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def get_inventory(session: GCESession, zone: str, max_age=30.0):
+    with _inventories_lock:
+        key = (session, zone)
+        inventory = _inventories.get(key)
+        if not inventory:
+            inventory = GCEInventory(session, zone, max_age)
+            _inventories[key] = inventory
+        inventory.max_age = max_age
+        return inventory
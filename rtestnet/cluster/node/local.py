@@ -0,0 +1,428 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import signal
+import socket
+import fnmatch
+import logging
+import threading
+import subprocess
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+from .. import ClusterContext, progress
+from . import NodeContext
+from .ops import NodeOps, NodeOpsError
+
+logger = logging.getLogger(__name__)
+
+# Backend running nodes on this machine, as processes or as containers on
+# the host network, for load tests and CI. Nodes get ports allocated from
+# local_port_range, one for each name in local_ports, instead of static
+# addresses, and their DNS records go to a hosts file (private_dir/hosts)
+# for a local resolver, e.g. dnsmasq --addn-hosts, instead of Cloud DNS.
+#
+# local_command is formatted with the node's name, node, host, fqdn,
+# conf_dir, data_dir and ports, e.g. "--protocol-port={ports[protocol]}".
+# In container mode it is the command of local_image; the data directory
+# is mounted at /var/lib/rnode, the configuration directory at /etc/rnode
+# and the hosts file at /etc/hosts.
+
+_CONTAINER_DATA_DIR = '/var/lib/rnode'
+_CONTAINER_CONF_DIR = '/etc/rnode'
+
+_CONTAINER_STATUSES = {
+    'created': 'TERMINATED',
+    'restarting': 'STAGING',
+    'running': 'RUNNING',
+    'paused': 'SUSPENDED',
+    'removing': 'STOPPING',
+    'exited': 'TERMINATED',
+    'dead': 'TERMINATED',
+}
+
+
+@contextmanager
+def _locked_json(path: Path):
+    # Read-modify-write of a JSON file shared by node CLI processes
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix('.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = json.loads(path.read_text())
+        except (FileNotFoundError, ValueError):
+            state = {}
+        yield state
+        tmp_file = path.with_name(f'.{path.name}')
+        tmp_file.write_text(json.dumps(state))
+        tmp_file.replace(path)
+
+
+def _read_json(path: Path) -> Dict:
+    # Written with a rename, so this needs no lock
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _port_free(host: str, port: int) -> bool:
+    with socket.socket() as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            return False
+    return True
+
+
+def _proc_stat(pid: int):
+    # (state, start time) of a process, None if there's none
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return fields[0], int(fields[19])
+
+
+class _Ports:
+    # Ports of the nodes, {node: {name: port}}. A node keeps its ports
+    # until it's removed with mrproper.
+
+    def __init__(self, ctx: ClusterContext):
+        self.path = ctx.local_ports_file
+
+    def get(self, node: str) -> Dict[str, int]:
+        return _read_json(self.path).get(node)
+
+    def allocate(self, node: str, names: List[str], host: str, port_range):
+        with _locked_json(self.path) as state:
+            ports = state.get(node, {})
+            used = {p for ps in state.values() for p in ps.values()}
+            candidates = (
+                p for p in range(port_range[0], port_range[1] + 1)
+                if p not in used
+            )
+            for name in names:
+                if name in ports:
+                    continue
+                # Skips ports something outside of the testnet listens on
+                port = next((p for p in candidates if _port_free(host, p)), 0)
+                if not port:
+                    raise NodeOpsError(
+                        f'No free port in range {port_range} for {node}'
+                    )
+                ports[name] = port
+            state[node] = ports
+            return dict(ports)
+
+    def release(self, node: str):
+        with _locked_json(self.path) as state:
+            state.pop(node, None)
+
+
+class _Hosts:
+    # DNS records, {fqdn: [address]}, rendered to a hosts file on change
+
+    def __init__(self, ctx: ClusterContext):
+        self.path = ctx.local_dns_file
+        self.hosts_file = ctx.local_hosts_file
+
+    def get(self, fqdn: str) -> List[str]:
+        return _read_json(self.path).get(fqdn, [])
+
+    def set(self, fqdn: str, addrs: List[str] = None):
+        with _locked_json(self.path) as records:
+            if addrs:
+                records[fqdn] = addrs
+            else:
+                records.pop(fqdn, None)
+            lines = ['127.0.0.1 localhost\n'] + [
+                f'{addr} {name}\n' for name, addrs in sorted(records.items())
+                for addr in addrs
+            ]
+            # Rewritten in place, under the lock: containers bind mount it
+            # as their /etc/hosts, and a renamed file would be a new inode
+            # they never see
+            fd = os.open(self.hosts_file, os.O_RDWR | os.O_CREAT, 0o644)
+            with open(fd, 'w') as f:
+                f.write(''.join(lines))
+                f.truncate()
+
+
+class NodeOpsLocal(NodeOps):
+    def __init__(self, ctx: NodeContext, config):
+        self.ctx = ctx
+        self.conf = config
+        self._ports = _Ports(ctx.cluster)
+        self._hosts = _Hosts(ctx.cluster)
+        self._container = config.get('local_mode', 'process') == 'container'
+        if self._container and not config.get('local_image'):
+            raise NodeOpsError('local_image is required in container mode')
+        if not self._container and not config.get('local_command'):
+            raise NodeOpsError('local_command is required in process mode')
+
+    @property
+    def config(self):
+        return self.conf
+
+    @property
+    def _name(self):
+        return self.conf['gce_name']
+
+    @property
+    def _host(self):
+        return self.conf.get('local_host', '127.0.0.1')
+
+    def _domain_name(self, name):
+        return name + '.' + self.conf.get('local_domain', 'local')
+
+    @property
+    def _fqdn(self):
+        return self._domain_name(self.conf.get('dns_name') or self._name)
+
+    def _command(self, ports: Dict[str, int]) -> List[str]:
+        if self._container:
+            data_dir, conf_dir = _CONTAINER_DATA_DIR, _CONTAINER_CONF_DIR
+        else:
+            data_dir = str(self.ctx.local_data_dir)
+            conf_dir = str(self.ctx.conf_dir)
+        try:
+            return [
+                arg.format(
+                    name=self._name,
+                    node=self.ctx.name,
+                    host=self._host,
+                    fqdn=self._fqdn,
+                    conf_dir=conf_dir,
+                    data_dir=data_dir,
+                    ports=ports
+                ) for arg in self.conf.get('local_command', [])
+            ]
+        except (KeyError, IndexError, ValueError) as e:
+            raise NodeOpsError(f'Invalid local_command: {e}') from e
+
+    def _runtime(self, *args, check=True):
+        cmd = [self.conf.get('local_runtime', 'docker'), *args]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        except OSError as e:
+            raise NodeOpsError(f'Could not run {cmd[0]}') from e
+        if check and result.returncode != 0:
+            raise NodeOpsError(
+                f'{cmd[0]} {args[0]} failed: {result.stderr.strip()}'
+            )
+        return result
+
+    def _process_status(self):
+        state = _read_json(self.ctx.local_state_file)
+        stat = _proc_stat(state['pid']) if 'pid' in state else None
+        # The pid may have been reused since
+        if stat and stat[0] not in 'ZX' and stat[1] == state['start_time']:
+            return 'SUSPENDED' if stat[0] in 'Tt' else 'RUNNING'
+        return 'TERMINATED' if self.ctx.local_data_dir.exists() else None
+
+    def _container_status(self):
+        result = self._runtime(
+            'inspect', '-f', '{{.State.Status}}', self._name, check=False
+        )
+        if result.returncode != 0:
+            return 'TERMINATED' if self.ctx.local_data_dir.exists() else None
+        return _CONTAINER_STATUSES.get(result.stdout.strip(), 'TERMINATED')
+
+    def _status(self):
+        if self._container:
+            return self._container_status()
+        return self._process_status()
+
+    def _signal(self, sig):
+        # The node runs in its own session, its children get it too
+        pid = _read_json(self.ctx.local_state_file).get('pid')
+        try:
+            os.killpg(pid, sig)
+        except (ProcessLookupError, TypeError):
+            pass
+
+    def _find_snapshot(self, pattern) -> Path:
+        snapshot_dir = self.ctx.cluster.local_snapshot_dir
+        matching = [
+            p for p in snapshot_dir.glob('*')
+            if not p.name.startswith('.') and
+            fnmatch.fnmatchcase(p.name, pattern)
+        ] if snapshot_dir.exists() else []
+        if not matching:
+            raise NodeOpsError(f'No snapshot matches {pattern}')
+        return max(matching, key=lambda p: p.stat().st_mtime)
+
+    def _create_data_dir(self):
+        data_dir = self.ctx.local_data_dir
+        snapshot = self.conf.get('data_disk_snapshot')
+        if not snapshot:
+            data_dir.mkdir(parents=True)
+            return
+        source = self._find_snapshot(snapshot)
+        logger.debug('Creating %s from snapshot %s', data_dir, source.name)
+        with progress.step(f'copy snapshot {source.name}'):
+            tmp_dir = data_dir.with_name(f'.{data_dir.name}.{os.getpid()}')
+            shutil.copytree(source, tmp_dir, symlinks=True)
+            tmp_dir.rename(data_dir)
+
+    def _spawn(self, ports):
+        cmd = self._command(ports)
+        with open(self.ctx.local_log_file, 'ab') as log:
+            try:
+                proc = subprocess.Popen(
+                    cmd,
+                    cwd=self.ctx.local_data_dir,
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True
+                )
+            except OSError as e:
+                raise NodeOpsError(f'Could not run {cmd[0]}') from e
+        # Reaped if it exits while this process runs, e.g. in the thread job
+        # engine; otherwise it's inherited by init
+        threading.Thread(target=proc.wait, daemon=True).start()
+        stat = _proc_stat(proc.pid)
+        state = {'pid': proc.pid, 'start_time': stat[1] if stat else None}
+        tmp_file = self.ctx.local_state_file.with_name('._local.json')
+        tmp_file.write_text(json.dumps(state))
+        tmp_file.replace(self.ctx.local_state_file)
+
+    def _run_container(self, ports):
+        self._runtime(
+            'run', '--detach',
+            '--name', self._name,
+            '--network', 'host',
+            '--volume', f'{self.ctx.local_data_dir}:{_CONTAINER_DATA_DIR}',
+            '--volume', f'{self.ctx.conf_dir}:{_CONTAINER_CONF_DIR}:ro',
+            '--volume', f'{self._hosts.hosts_file}:/etc/hosts:ro',
+            self.conf['local_image'], *self._command(ports)
+        ) # yapf: disable
+
+    def start(self):
+        status = self._status()
+        if status == 'RUNNING':
+            return
+        ports = self._ports.allocate(
+            self.ctx.name,
+            self.conf.get('local_ports', []),
+            self._host,
+            self.conf.get('local_port_range', [40000, 49999])
+        )
+        # Resolvable before the node looks itself up
+        self._hosts.set(self._fqdn, [self._host])
+        if status == 'SUSPENDED':
+            with progress.step(f'resume {self._name}'):
+                self._resume()
+            return
+        self.ctx.private_dir.mkdir(parents=True, exist_ok=True)
+        if not self.ctx.local_data_dir.exists():
+            self._create_data_dir()
+        with progress.step(f'start {self._name}'):
+            if not self._container:
+                self._spawn(ports)
+            elif self._runtime('inspect', self._name, check=False).returncode:
+                self._run_container(ports)
+            else:
+                self._runtime('start', self._name)
+
+    def _suspend(self):
+        if self._container:
+            self._runtime('pause', self._name)
+        else:
+            self._signal(signal.SIGSTOP)
+
+    def _resume(self):
+        if self._container:
+            self._runtime('unpause', self._name)
+        else:
+            self._signal(signal.SIGCONT)
+
+    def _terminate(self, status):
+        timeout = self.conf.get('local_stop_timeout', 30)
+        if self._container:
+            if status == 'SUSPENDED':
+                self._runtime('unpause', self._name)
+            self._runtime('stop', '--time', str(int(timeout)), self._name)
+            return
+        self._signal(signal.SIGTERM)
+        if status == 'SUSPENDED':
+            self._signal(signal.SIGCONT)
+        deadline = time.monotonic() + timeout
+        while self._process_status() in ('RUNNING', 'SUSPENDED'):
+            if time.monotonic() > deadline:
+                logger.warning('Killing %s after %ss', self._name, timeout)
+                self._signal(signal.SIGKILL)
+                break
+            time.sleep(0.1)
+
+    def stop(self, clean=False, mrproper=False, suspend=False):
+        status = self._status()
+        if suspend and not (clean or mrproper):
+            if status == 'RUNNING':
+                with progress.step(f'suspend {self._name}'):
+                    self._suspend()
+                return
+            if status == 'SUSPENDED':
+                return
+        if status in ('RUNNING', 'SUSPENDED', 'STAGING'):
+            with progress.step(f'stop {self._name}'):
+                self._terminate(status)
+        if clean or mrproper:
+            if self._container:
+                self._runtime('rm', '--force', self._name, check=False)
+            self.ctx.local_state_file.unlink(missing_ok=True)
+            shutil.rmtree(self.ctx.local_data_dir, ignore_errors=True)
+        if mrproper:
+            self._hosts.set(self._fqdn, None)
+            self._ports.release(self.ctx.name)
+
+    def snapshot(self, name, consistent=False):
+        # Copies the data directory. A consistent snapshot freezes a
+        # running node for the copy, its files stay as they were.
+        data_dir = self.ctx.local_data_dir
+        if not data_dir.exists():
+            raise NodeOpsError(f'Node {self.ctx.name} has no data')
+        target = self.ctx.cluster.local_snapshot_dir / name
+        if target.exists():
+            raise NodeOpsError(f'Snapshot {name} exists')
+        frozen = consistent and self._status() == 'RUNNING'
+        if frozen:
+            self._suspend()
+        try:
+            with progress.step(f'snapshot {self._name}'):
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp_dir = target.with_name(f'.{name}.{os.getpid()}')
+                shutil.copytree(data_dir, tmp_dir, symlinks=True)
+                # The latest snapshot is the one with the latest mtime
+                os.utime(tmp_dir)
+                tmp_dir.rename(target)
+        finally:
+            if frozen:
+                self._resume()
+
+    def vm_exists(self) -> bool:
+        return self._status() is not None
+
+    def observe(self) -> Dict:
+        ports = self._ports.get(self.ctx.name)
+        return {
+            'vm': self._status(),
+            'address': self._host if ports else None,
+            'ports': ports,
+        }
+
+    def get_dns_rec_data(self, name) -> List[str]:
+        return self._hosts.get(self._domain_name(name))
+
+    def add_dns_rec(self, name, ttl):
+        # Hosts files have no TTLs
+        if self._ports.get(self.ctx.name):
+            self._hosts.set(self._domain_name(name), [self._host])
@@ -0,0 +1,190 @@
+import logging
+import threading
+
+from concurrent import futures
+from typing import Dict, List
+
+from . import NodeError
+from .gce import GCESession
+
+logger = logging.getLogger(__name__)
+
+# Longer filter expressions are rejected by the API
+_MAX_OPS_PER_POLL = 50
+
+
+class OperationError(NodeError):
+    pass
+
+
+class Operation(futures.Future):
+    # Pending GCE zone operation. Resolves with the final operation
+    # resource; status and progress are updated while it is polled.
+
+    def __init__(self, name: str, label: str):
+        super().__init__()
+        self.name = name
+        self.label = label
+        self.status = 'PENDING'
+        self.progress = 0
+        self.target = None
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'label': self.label,
+            'status': self.status,
+            'progress': self.progress,
+        }
+
+
+class OperationTracker:
+    # Submits compute mutations without waiting for them and polls all
+    # pending operations of a zone with one filtered zoneOperations.list
+    # call. The poll interval starts at min_interval, backs off while
+    # nothing changes and resets whenever an operation makes progress or a
+    # new one is submitted.
+    #
+    # This saves API calls, not threads: whoever submits an operation
+    # still waits for its future in a thread of its own, see
+    # NodeOpsGCE._run_operation. Instance inserts don't come here at all,
+    # libcloud's create_node polls its own operation.
+
+    def __init__(
+        self,
+        session: GCESession,
+        zone: str,
+        min_interval: float = 0.5,
+        max_interval: float = 8.0
+    ):
+        self._session = session
+        self.zone = zone
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._poller = None
+
+    def submit(self, label: str, path: str, data=None) -> Operation:
+        compute = self._session.compute(self.zone)
+        response = compute.connection.request(
+            f'/zones/{self.zone}{path}', method='POST', data=data
+        ).object
+        op = Operation(response['name'], label)
+        logger.debug('Submitted operation %s (%s)', op.name, label)
+        self._update(op, response)
+        if not op.done():
+            with self._cond:
+                self._pending[op.name] = op
+                if not self._poller:
+                    self._poller = threading.Thread(
+                        target=self._poll_loop,
+                        name=f'gce-ops-{self.zone}',
+                        daemon=True
+                    )
+                    self._poller.start()
+                self._cond.notify()
+        return op
+
+    def pending(self) -> List[Dict]:
+        with self._cond:
+            return [
+                dict(op.to_dict(), zone=self.zone)
+                for op in self._pending.values()
+            ]
+
+    def abandon(self, op: Operation, reason: str):
+        # Stops polling an operation nobody waits for anymore
+        with self._cond:
+            self._pending.pop(op.name, None)
+        if not op.done():
+            op.set_exception(OperationError(f'{op.label}: {reason}'))
+
+    def _update(self, op: Operation, resource: Dict) -> bool:
+        changed = (
+            op.status != resource['status'] or
+            op.progress != resource.get('progress', 0)
+        )
+        op.status = resource['status']
+        op.progress = resource.get('progress', 0)
+        op.target = resource.get('targetLink')
+        if changed:
+            logger.debug(
+                'Operation %s (%s): %s %d%%', op.name, op.label, op.status,
+                op.progress
+            )
+        if op.status != 'DONE':
+            return changed
+        if 'error' in resource:
+            errors = resource['error'].get('errors', [])
+            messages = [e.get('message', e.get('code', '')) for e in errors]
+            op.set_exception(
+                OperationError(f'{op.label} failed: ' + '; '.join(messages))
+            )
+        else:
+            op.set_result(resource)
+        return True
+
+    def _poll(self, ops: List[Operation]) -> bool:
+        compute = self._session.compute(self.zone)
+        by_name = {op.name: op for op in ops}
+        changed = False
+        for i in range(0, len(ops), _MAX_OPS_PER_POLL):
+            names = [op.name for op in ops[i:i + _MAX_OPS_PER_POLL]]
+            expr = ' OR '.join(f'(name = "{n}")' for n in names)
+            response = compute.connection.request(
+                f'/zones/{self.zone}/operations',
+                method='GET',
+                params={'filter': expr}
+            ).object
+            for resource in response.get('items', []):
+                op = by_name.get(resource['name'])
+                if op and self._update(op, resource):
+                    changed = True
+        return changed
+
+    def _poll_loop(self):
+        interval = self.min_interval
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._poller = None
+                    return
+                ops = list(self._pending.values())
+            try:
+                changed = self._poll(ops)
+            except Exception:
+                logger.warning('Polling operations failed', exc_info=True)
+                changed = False
+            with self._cond:
+                for op in ops:
+                    if op.done():
+                        self._pending.pop(op.name, None)
+                if changed:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 1.5, self.max_interval)
+                # A new submission wakes us up early
+                if self._cond.wait(interval):
+                    interval = self.min_interval
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_operation_tracker(session: GCESession, zone: str) -> OperationTracker:
+    with _trackers_lock:
+        key = (session, zone)
+        tracker = _trackers.get(key)
+        if not tracker:
+            tracker = OperationTracker(session, zone)
+            _trackers[key] = tracker
+        return tracker
+
+
+def pending_operations() -> List[Dict]:
+    # Operations pending in all zones of this process
+    with _trackers_lock:
+        trackers = list(_trackers.values())
+    return [op for tracker in trackers for op in tracker.pending()]
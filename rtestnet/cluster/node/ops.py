@@ -1,19 +1,88 @@
-import os
-import json
+import abc
+import fnmatch
+import logging
+import contextvars
 
-from pathlib import Path
+from concurrent import futures
+from typing import Dict, List
 
-from libcloud.compute.drivers.gce import GCENodeDriver
-from libcloud.dns.drivers.google import GoogleDNSDriver
-from libcloud.common.google import ResourceNotFoundError
-from libcloud.dns.types import RecordDoesNotExistError
+from libcloud.common.google import ResourceNotFoundError, ResourceExistsError
+from libcloud.compute.drivers.gce import GCEAddress
 
-from . import NodeError
+from . import NodeError, NodeContext, pool
+from .. import progress, tracing
+from .checkpoint import StepCheckpoints
+from .gce import GCESession, request_kind, get_session
+from .dns import get_dns_zone
+from .inventory import VM, ADDR, DISK, get_inventory
+from .operations import get_operation_tracker
+from .scheduler import HIGH, LOW, priority
 
+logger = logging.getLogger(__name__)
 
-# TODO make it "abc"
-class NodeOps:
-    pass
+# Checkpointed steps of VM provisioning
+_PROVISION_STEPS = ('address', 'data disk', 'dns', 'instance', 'attach disk')
+
+class NodeOps(abc.ABC):
+    # A backend running nodes, chosen by the "backend" config option.
+    # Instance statuses are GCE's: RUNNING, SUSPENDED, TERMINATED etc.
+
+    @property
+    @abc.abstractmethod
+    def config(self):
+        pass
+
+    @abc.abstractmethod
+    def start(self):
+        pass
+
+    @abc.abstractmethod
+    def stop(self, clean=False, mrproper=False, suspend=False):
+        pass
+
+    @abc.abstractmethod
+    def snapshot(self, name, consistent=False):
+        pass
+
+    @abc.abstractmethod
+    def vm_exists(self) -> bool:
+        pass
+
+    @abc.abstractmethod
+    def observe(self) -> Dict:
+        # {'vm': instance status or None, 'address': address or None}
+        pass
+
+    @abc.abstractmethod
+    def get_dns_rec_data(self, name) -> List[str]:
+        pass
+
+    @abc.abstractmethod
+    def add_dns_rec(self, name, ttl):
+        pass
+
+
+def create_node_ops(
+    ctx: NodeContext, config, checkpoints: StepCheckpoints = None
+) -> NodeOps:
+    backend = config.get('backend', 'gce')
+    if backend == 'gce':
+        return NodeOpsGCE(config, checkpoints=checkpoints)
+    if backend == 'local':
+        from .local import NodeOpsLocal
+        return NodeOpsLocal(ctx, config)
+    raise NodeOpsError(f'Unknown backend "{backend}"')
+
+
+# Shared by all NodeOpsGCE instances of the process. Steps never wait for
+# other steps, so a bounded pool can't deadlock.
+_steps = futures.ThreadPoolExecutor(
+    max_workers=32, thread_name_prefix='gce-step'
+)
+
+
+def _submit_step(fn, *args):
+    return _steps.submit(contextvars.copy_context().run, fn, *args)
 
 
 class NodeOpsError(NodeError):
@@ -21,34 +90,26 @@ class NodeOpsError(NodeError):
 
 
 class NodeOpsGCE(NodeOps):
-    def __init__(self, config, credentials_file=None):
+    def __init__(
+        self,
+        config,
+        credentials_file=None,
+        session: GCESession = None,
+        checkpoints: StepCheckpoints = None,
+        vm_labels=None
+    ):
         self.conf = config
-        if not credentials_file:
-            try:
-                credentials_file = os.environ['GOOGLE_APPLICATION_CREDENTIALS']
-            except KeyError:
-                raise NodeOpsError(
-                    'You must pass path to credentials file either as ' +
-                    'credentials_file argument or in ' +
-                    'GOOGLE_APPLICATION_CREDENTIALS environment variable'
-                ) from None
-        try:
-            credentials = json.loads(Path(credentials_file).read_text())
-        except Exception as e:
-            raise NodeOpsError(
-                f'Could not read credentials_file = "{credentials_file}"'
-            ) from e
-        self._compute = GCENodeDriver(
-            credentials['client_email'],
-            credentials_file,
-            project=credentials['project_id'],
-            datacenter=config['gce_zone']
-        )
-        self._dns = GoogleDNSDriver(
-            credentials['client_email'],
-            credentials_file,
-            project=credentials['project_id']
-        )
+        self._session = session or get_session(credentials_file)
+        self._checkpoints = checkpoints or StepCheckpoints()
+        self._vm_labels = vm_labels
+
+    @property
+    def _compute(self):
+        return self._session.compute(self.conf['gce_zone'])
+
+    @property
+    def _dns(self):
+        return self._session.dns()
 
     @property
     def _vm_name(self):
@@ -60,47 +121,89 @@ class NodeOpsGCE(NodeOps):
 
     @property
     def _fqdn(self):
-        return self._vm_name + '.' + self.conf['gdns_domain']
+        # The node's DNS name stays when its VM comes from the warm pool;
+        # pool VMs themselves have none
+        name = self.conf.get('dns_name', self._vm_name)
+        if not name:
+            return None
+        return name + '.' + self.conf['gdns_domain']
 
-    def _create_dns_rec(self, str_addr, fqdn, ttl):
-        dns_zone = self._dns.get_zone(self.conf['gdns_zone'])
-        data = {'ttl': ttl, 'rrdatas': [str_addr]}
-        return self._dns.create_record(fqdn, dns_zone, 'A', data)
+    @property
+    def _dns_zone(self):
+        return get_dns_zone(self._session, self.conf['gdns_zone'])
 
     def _maybe_get_dns_rec(self, fqdn):
-        try:
-            return self._dns.get_record(self.conf['gdns_zone'], 'A:' + fqdn)
-        except RecordDoesNotExistError:
-            return None
+        return self._dns_zone.get(fqdn)
 
     def _get_dns_rec(self, str_addr, fqdn=None, ttl=300):
         if not fqdn:
             fqdn = self._fqdn
         rec = self._maybe_get_dns_rec(fqdn)
-        if rec and str_addr not in rec.data['rrdatas']:
-            self._dns.delete_record(rec)
-            rec = None
-        if not rec:
-            rec = self._create_dns_rec(str_addr, fqdn, ttl)
+        if not rec or str_addr not in rec['rrdatas']:
+            self._dns_zone.upsert(fqdn, [str_addr], ttl)
+            rec = self._maybe_get_dns_rec(fqdn)
         return rec
 
     def _delete_dns_rec(self, fqdn=None):
         if not fqdn:
             fqdn = self._fqdn
-        rec = self._maybe_get_dns_rec(fqdn)
-        if rec:
-            self._dns.delete_record(rec)
+        if fqdn and self._maybe_get_dns_rec(fqdn):
+            self._dns_zone.delete(fqdn)
 
-    def _create_addr(self):
-        addr = self._compute.ex_create_address(self._vm_name)
-        return addr
+    @property
+    def _inventory(self):
+        ttl = self.conf.get('gce_inventory_ttl', 30)
+        if ttl <= 0:
+            return None
+        return get_inventory(self._session, self.conf['gce_zone'], ttl)
+
+    @property
+    def _operations(self):
+        return get_operation_tracker(self._session, self.conf['gce_zone'])
+
+    def _run_operation(self, label, path, data=None):
+        # The calling thread waits, blocked, until the operation is done or
+        # times out; only the tracker's poller talks to the API meanwhile
+        timeout = self.conf.get('gce_operation_timeout', 900)
+        kind = request_kind(path)
+        with tracing.span('operation', operation=label, kind=kind), \
+                progress.step(label):
+            op = self._operations.submit(label, path, data)
+            try:
+                return op.result(timeout)
+            except futures.TimeoutError:
+                self._operations.abandon(op, f'not done in {timeout}s')
+                raise NodeOpsError(
+                    f'Operation {op.name} ({label}) not done in {timeout}s'
+                ) from None
 
-    def _maybe_get_addr(self):
+    def _lookup(self, kind, name, fetch, confirm_miss=True):
+        if self._inventory:
+            return self._inventory.lookup(kind, name, fetch, confirm_miss)
         try:
-            return self._compute.ex_get_address(self._vm_name)
+            return fetch()
         except ResourceNotFoundError:
             return None
 
+    def _update_inventory(self, kind, name, obj):
+        if self._inventory:
+            self._inventory.update(kind, name, obj)
+
+    def _invalidate_inventory(self, kind, name):
+        if self._inventory:
+            self._inventory.invalidate(kind, name)
+
+    def _create_addr(self):
+        addr = self._compute.ex_create_address(self._vm_name)
+        self._update_inventory(ADDR, self._vm_name, addr)
+        return addr
+
+    def _maybe_get_addr(self, confirm_miss=True):
+        return self._lookup(
+            ADDR, self._vm_name,
+            lambda: self._compute.ex_get_address(self._vm_name), confirm_miss
+        )
+
     def _get_addr(self):
         addr = self._maybe_get_addr()
         if not addr:
@@ -112,22 +215,70 @@ class NodeOpsGCE(NodeOps):
         addr = self._maybe_get_addr()
         if addr:
             self._compute.ex_destroy_address(self._vm_name)
+            self._update_inventory(ADDR, self._vm_name, None)
+
+    def _find_snapshot(self, pattern):
+        # A snapshot name, or a glob pattern matching the latest one to use
+        if not any(c in pattern for c in '*?['):
+            try:
+                return self._compute.ex_get_snapshot(pattern)
+            except ResourceNotFoundError:
+                raise NodeOpsError(f'Snapshot {pattern} not found') from None
+        matching = [
+            s for s in self._compute.ex_list_snapshots()
+            if s.status == 'READY' and fnmatch.fnmatchcase(s.name, pattern)
+        ]
+        if not matching:
+            raise NodeOpsError(f'No ready snapshot matches {pattern}')
+        return max(matching, key=lambda s: s.extra['creationTimestamp'])
+
+    def _data_disk_source(self):
+        # Source fields of the data disk and the least size it needs, so
+        # new nodes don't have to sync all of the chain state
+        snapshot = self.conf.get('data_disk_snapshot')
+        image = self.conf.get('data_disk_image')
+        if snapshot and image:
+            raise NodeOpsError(
+                'data_disk_snapshot and data_disk_image are exclusive'
+            )
+        if snapshot:
+            snap = self._find_snapshot(snapshot)
+            logger.debug(
+                'Creating %s from snapshot %s', self._data_disk_name, snap.name
+            )
+            return {
+                'sourceSnapshot': f'global/snapshots/{snap.name}'
+            }, int(snap.size)
+        if image:
+            # Image name, "family/NAME" for the latest image of a family or
+            # a resource path
+            if '/' not in image or image.startswith('family/'):
+                image = 'global/images/' + image
+            return {'sourceImage': image}, 0
+        return {}, 0
 
     def _create_data_disk(self):
         disk_type = 'pd-standard'
         if self.conf.get('data_disk_type_ssd', False):
             disk_type = 'pd-ssd'
-        return self._compute.create_volume(
-            self.conf['data_disk_size'],
-            self._data_disk_name,
-            ex_disk_type=disk_type
+        zone = self.conf['gce_zone']
+        source, min_size = self._data_disk_source()
+        self._run_operation(
+            f'create disk {self._data_disk_name}', '/disks', {
+                'name': self._data_disk_name,
+                'sizeGb': str(max(self.conf['data_disk_size'], min_size)),
+                'type': f'zones/{zone}/diskTypes/{disk_type}',
+                **source
+            }
         )
+        self._invalidate_inventory(DISK, self._data_disk_name)
+        return self._maybe_get_data_disk()
 
     def _maybe_get_data_disk(self):
-        try:
-            return self._compute.ex_get_volume(self._data_disk_name)
-        except ResourceNotFoundError:
-            return None
+        return self._lookup(
+            DISK, self._data_disk_name,
+            lambda: self._compute.ex_get_volume(self._data_disk_name)
+        )
 
     def _get_data_disk(self):
         disk = self._maybe_get_data_disk()
@@ -136,57 +287,280 @@ class NodeOpsGCE(NodeOps):
         return disk
 
     def _create_vm(self):
+        # Creates yield to stops and DNS changes when API quota is short
+        with priority(LOW):
+            self._create_vm_steps()
+
+    def _run_step(self, name, fn, *args):
+        # Steps return JSON-able results so they can be checkpointed
+        result = self._checkpoints.get(name)
+        if result is not None:
+            logger.debug('Step "%s" finished before, skipping', name)
+            progress.report(name, 'skipped')
+            return result
+        with tracing.span('step', step=name), progress.step(name):
+            result = fn(*args)
+        self._checkpoints.done(name, result)
+        return result
+
+    def _address_step(self):
         addr = self._get_addr()
-        vm = self._compute.create_node(
-            self._vm_name,
-            size=self.conf['gce_machine_type'],
-            image=self.conf['gce_boot_image'],
-            external_ip=addr,
-            ex_network=self.conf['gce_vpc_net'],
-            ex_subnetwork=self.conf['gce_vpc_subnet'],
-            ex_tags=self.conf['gce_tags']
-        )
+        return {'name': addr.name, 'address': addr.address}
+
+    def _data_disk_step(self):
         disk = self._get_data_disk()
-        self._compute.attach_volume(vm, disk, ex_auto_delete=True)
-        self._get_dns_rec(addr.address)
-        return vm
+        return {'name': disk.name, 'selfLink': disk.extra['selfLink']}
 
-    def _maybe_get_vm(self):
+    def _dns_step(self, address):
+        if self._fqdn:
+            self._get_dns_rec(address)
+        return True
+
+    def _instance_step(self, addr):
+        # Not through the operation tracker: building the instance resource
+        # would duplicate libcloud's image, size and network resolution, so
+        # this thread polls the insert itself
         try:
-            return self._compute.ex_get_node(self._vm_name)
-        except ResourceNotFoundError:
-            return None
+            self._compute.create_node(
+                self._vm_name,
+                size=self.conf['gce_machine_type'],
+                image=self.conf['gce_boot_image'],
+                # Only the address is used from a static address
+                external_ip=GCEAddress(
+                    addr['name'], addr['name'], addr['address'], None, None
+                ),
+                ex_network=self.conf['gce_vpc_net'],
+                ex_subnetwork=self.conf['gce_vpc_subnet'],
+                ex_tags=self.conf['gce_tags'],
+                ex_labels=self._vm_labels
+            )
+        except ResourceExistsError:
+            # Created by an interrupted run of this job that didn't get to
+            # record it
+            logger.debug('Instance %s already exists', self._vm_name)
+        return {'name': self._vm_name}
+
+    def _attach_disk_step(self, disk):
+        self._run_operation(
+            f'attach disk {disk["name"]}',
+            f'/instances/{self._vm_name}/attachDisk', {
+                'source': disk['selfLink'],
+                'deviceName': disk['name'],
+                'type': 'PERSISTENT',
+                'mode': 'READ_WRITE',
+                'autoDelete': True,
+            }
+        )
+        return True
+
+    def _create_vm_steps(self):
+        # Address and data disk are independent, the instance needs the
+        # address and DNS only needs the address too, so the critical path
+        # is address -> instance -> attach.
+        addr_f = _submit_step(self._run_step, 'address', self._address_step)
+        disk_f = _submit_step(
+            self._run_step, 'data disk', self._data_disk_step
+        )
+        steps = [addr_f, disk_f]
+        try:
+            addr = addr_f.result()
+            steps.append(
+                _submit_step(
+                    self._run_step, 'dns', self._dns_step, addr['address']
+                )
+            )
+            self._run_step('instance', self._instance_step, addr)
+            self._run_step(
+                'attach disk', self._attach_disk_step, disk_f.result()
+            )
+            self._invalidate_inventory(VM, self._vm_name)
+            self._invalidate_inventory(DISK, self._data_disk_name)
+            for f in steps:
+                f.result()
+        finally:
+            # Don't leave steps running behind a failed pipeline
+            futures.wait(steps)
+
+    def vm_exists(self):
+        return self._maybe_get_vm() is not None
+
+    def create_stopped(self):
+        # Provisions the VM and leaves it stopped, for the warm pool
+        self._create_vm()
+        self._run_operation(
+            f'stop {self._vm_name}', f'/instances/{self._vm_name}/stop'
+        )
+        self._invalidate_inventory(VM, self._vm_name)
 
-    def _get_vm(self):
+    def adopt_pool_vm(self, node: str):
+        # Labels a VM claimed from the warm pool as the node's and points
+        # the node's DNS name at its address. start() then resumes it.
         vm = self._maybe_get_vm()
-        if not vm:
-            vm = self._create_vm()
-        return vm
+        addr = self._maybe_get_addr()
+        if not vm or not addr:
+            raise NodeOpsError(f'Pool instance {self._vm_name} is gone')
+        self._run_operation(
+            f'label {self._vm_name}', f'/instances/{self._vm_name}/setLabels',
+            {
+                'labels': {pool.NODE_LABEL: pool.label_value(node)},
+                'labelFingerprint': vm.extra.get('labelFingerprint'),
+            }
+        )
+        self._invalidate_inventory(VM, self._vm_name)
+        self._get_dns_rec(addr.address)
+
+    def delete_pool_addr(self):
+        # A deleted pool VM leaves its address behind, named after the VM
+        # rather than the node, so no later start would reuse it. The
+        # node's DNS record points at it, it goes too.
+        self._delete_addr()
+
+    def _maybe_get_vm(self, confirm_miss=True):
+        return self._lookup(
+            VM, self._vm_name,
+            lambda: self._compute.ex_get_node(self._vm_name), confirm_miss
+        )
 
     def _delete_vm(self):
         vm = self._maybe_get_vm()
         if vm:
-            vm.destroy()
+            # Through our driver rather than vm.destroy() so the call is
+            # accounted for
+            self._compute.destroy_node(vm)
+            self._update_inventory(VM, self._vm_name, None)
+            # The data disk is attached with auto-delete
+            self._invalidate_inventory(DISK, self._data_disk_name)
+
+    def _delete_data_disk(self):
+        # A data disk is left detached when its job was stopped before the
+        # attach step; an attached one went with the instance
+        disk = self._maybe_get_data_disk()
+        if disk:
+            self._compute.destroy_volume(disk)
+            self._update_inventory(DISK, self._data_disk_name, None)
 
     @property
     def config(self):
         return self.conf
 
-    def stop(self, clean=False, mrproper=False):
+    def stop(self, clean=False, mrproper=False, suspend=False):
+        with priority(HIGH):
+            self._stop(clean, mrproper, suspend)
+
+    def _stop(self, clean, mrproper, suspend):
         if clean or mrproper:
             self._delete_vm()
+            self._delete_data_disk()
         else:
             vm = self._maybe_get_vm()
+            # Suspending keeps the memory of the instance, so it resumes
+            # without booting and warming up rnode again. Only running
+            # instances can be suspended; stopping a suspended one would
+            # throw its memory away.
+            status = vm.extra.get('status') if vm else None
+            verb = 'stop'
+            if suspend and status in ('SUSPENDED', 'SUSPENDING'):
+                logger.debug('Instance %s is already %s', self._vm_name, status)
+                vm = None
+            elif suspend and status == 'RUNNING':
+                verb = 'suspend'
             if vm:
-                self._compute.ex_stop_node(vm)
+                self._run_operation(
+                    f'{verb} {self._vm_name}',
+                    f'/instances/{self._vm_name}/{verb}'
+                )
+                self._invalidate_inventory(VM, self._vm_name)
         if mrproper:
             self._delete_dns_rec()
             self._delete_addr()
 
     def start(self):
-        self._get_vm()
+        if self._checkpoints.any(_PROVISION_STEPS):
+            # Resuming provisioning interrupted by a controller restart; the
+            # VM may exist without its data disk attached
+            self._create_vm()
+            return
+        vm = self._maybe_get_vm()
+        if not vm:
+            self._create_vm()
+        elif vm.extra.get('status') == 'TERMINATED':
+            self._run_operation(
+                f'start {self._vm_name}', f'/instances/{self._vm_name}/start'
+            )
+            self._invalidate_inventory(VM, self._vm_name)
+        elif vm.extra.get('status') == 'SUSPENDED':
+            self._run_operation(
+                f'resume {self._vm_name}', f'/instances/{self._vm_name}/resume'
+            )
+            self._invalidate_inventory(VM, self._vm_name)
+
+    def _snapshot_stop_step(self, status):
+        if status != 'RUNNING':
+            return False
+        self._run_operation(
+            f'stop {self._vm_name}', f'/instances/{self._vm_name}/stop'
+        )
+        self._invalidate_inventory(VM, self._vm_name)
+        return True
+
+    def _snapshot_step(self, name):
+        try:
+            self._run_operation(
+                f'snapshot {self._data_disk_name}',
+                f'/disks/{self._data_disk_name}/createSnapshot', {'name': name}
+            )
+        except ResourceExistsError:
+            logger.debug('Snapshot %s already exists', name)
+        return {'name': name}
+
+    def _snapshot_start_step(self):
+        self._run_operation(
+            f'start {self._vm_name}', f'/instances/{self._vm_name}/start'
+        )
+        self._invalidate_inventory(VM, self._vm_name)
+        return True
+
+    def snapshot(self, name, consistent=False):
+        # Snapshots the data disk. A consistent snapshot stops a running
+        # node for its duration, otherwise it's only crash-consistent.
+        vm = self._maybe_get_vm()
+        if not vm or not self._maybe_get_data_disk():
+            raise NodeOpsError(
+                f'Instance {self._vm_name} or its data disk does not exist'
+            )
+        status = vm.extra.get('status')
+        if status not in ('RUNNING', 'TERMINATED', 'SUSPENDED'):
+            raise NodeOpsError(f'Instance {self._vm_name} is {status}')
+        stopped = False
+        if consistent:
+            stopped = self._run_step(
+                'snapshot stop', self._snapshot_stop_step, status
+            )
+        try:
+            self._run_step('snapshot', self._snapshot_step, name)
+        finally:
+            if stopped:
+                self._run_step('snapshot start', self._snapshot_start_step)
+
+    def observe(self):
+        # Only observes, a node missing by mistake is started and start()
+        # looks again
+        vm = self._maybe_get_vm(confirm_miss=False)
+        addr = self._maybe_get_addr(confirm_miss=False)
+        return {
+            'vm': vm.extra.get('status') if vm else None,
+            'address': addr.address if addr else None,
+        }
+
+    def get_dns_rec_data(self, name):
+        rec = self._maybe_get_dns_rec(name + '.' + self.conf['gdns_domain'])
+        return rec['rrdatas'] if rec else []
 
     def add_dns_rec(self, name, ttl):
+        with priority(HIGH):
+            self._add_dns_rec(name, ttl)
+
+    def _add_dns_rec(self, name, ttl):
         addr = self._maybe_get_addr()
         if not addr:
             # TODO warn
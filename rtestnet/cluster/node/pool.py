@@ -0,0 +1,171 @@
+import re
+import json
+import time
+import fcntl
+import secrets
+import logging
+
+from concurrent import futures
+from contextlib import contextmanager
+from typing import Dict, List
+
+from .. import ClusterContext, metrics
+from . import NodeError, NodeConfig
+
+logger = logging.getLogger(__name__)
+
+POOL_LABEL = 'rtestnet-pool'
+NODE_LABEL = 'rtestnet-node'
+
+# Reservations whose creator didn't report back within this time are
+# considered failed
+_CREATE_TIMEOUT = 3600
+
+_claims = metrics.counter(
+    'rtestnet_warm_pool_claims_total', 'Warm pool claims by outcome'
+)
+_created = metrics.counter(
+    'rtestnet_warm_pool_created_total', 'Warm pool instances created'
+)
+
+
+class WarmPoolError(NodeError):
+    pass
+
+
+def label_value(value: str) -> str:
+    # GCE label values: lowercase letters, digits, '-' and '_', at most 63
+    return re.sub(r'[^a-z0-9_-]', '-', value.lower())[:63]
+
+
+def _matches(entry: Dict, config) -> bool:
+    return (
+        entry['zone'] == config['gce_zone'] and
+        entry['machine_type'] == config['gce_machine_type'] and
+        entry['boot_image'] == config['gce_boot_image']
+    )
+
+
+class WarmPool:
+    # Stopped instances created ahead of need, each with its address and
+    # data disk, and the nodes that claimed them. The state lives in
+    # private_dir/_warm_pool.json and is changed under an exclusive lock,
+    # so node CLI processes and the controller can share the pool.
+    #
+    #   {"vms": {name: {"zone", "machine_type", "boot_image", "status",
+    #                   "since"}},
+    #    "claims": {node: name}}
+
+    def __init__(self, ctx: ClusterContext):
+        self.state_file = ctx.warm_pool_file
+        self.lock_file = ctx.warm_pool_file.with_suffix('.lock')
+
+    def _read(self) -> Dict:
+        try:
+            state = json.loads(self.state_file.read_text())
+        except (FileNotFoundError, ValueError):
+            state = {}
+        state.setdefault('vms', {})
+        state.setdefault('claims', {})
+        return state
+
+    @contextmanager
+    def _locked(self):
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._read()
+            yield state
+            tmp_file = self.state_file.with_name(f'.{self.state_file.name}')
+            tmp_file.write_text(json.dumps(state))
+            tmp_file.replace(self.state_file)
+
+    def claimed(self, node: str) -> str:
+        # Written with a rename, so this needs no lock
+        return self._read()['claims'].get(node)
+
+    def claim(self, node: str, config: NodeConfig) -> str:
+        with self._locked() as state:
+            if node in state['claims']:
+                return state['claims'][node]
+            for name, entry in state['vms'].items():
+                if entry['status'] == 'ready' and _matches(entry, config):
+                    del state['vms'][name]
+                    state['claims'][node] = name
+                    _claims.inc(outcome='hit')
+                    logger.info('Node %s claimed pool instance %s', node, name)
+                    return name
+        _claims.inc(outcome='miss')
+        return None
+
+    def release(self, node: str):
+        with self._locked() as state:
+            state['claims'].pop(node, None)
+
+    def _reserve(self, config: NodeConfig) -> List[str]:
+        # Names of instances to create to bring the pool to its size
+        size = config.get('warm_pool_size', 0)
+        prefix = config.get('gce_name_prefix', '')
+        now = time.time()
+        with self._locked() as state:
+            vms = state['vms']
+            for name, entry in list(vms.items()):
+                if (
+                    entry['status'] == 'creating' and
+                    now - entry['since'] > _CREATE_TIMEOUT
+                ):
+                    logger.warning('Dropping stale pool reservation %s', name)
+                    del vms[name]
+            count = sum(1 for e in vms.values() if _matches(e, config))
+            names = [
+                f'{prefix}pool-{secrets.token_hex(4)}'
+                for _ in range(size - count)
+            ]
+            for name in names:
+                vms[name] = {
+                    'zone': config['gce_zone'],
+                    'machine_type': config['gce_machine_type'],
+                    'boot_image': config['gce_boot_image'],
+                    'status': 'creating',
+                    'since': now,
+                }
+        return names
+
+    def _set_status(self, name: str, status: str = None):
+        with self._locked() as state:
+            if name not in state['vms']:
+                return
+            if status:
+                state['vms'][name]['status'] = status
+                state['vms'][name]['since'] = time.time()
+            else:
+                del state['vms'][name]
+
+    def _create(self, config: NodeConfig, name: str):
+        from .ops import NodeOpsGCE
+
+        vm_config = NodeConfig(
+            config.mtime, dict(config, gce_name=name, dns_name=None)
+        )
+        try:
+            NodeOpsGCE(
+                vm_config, vm_labels={POOL_LABEL: 'available'}
+            ).create_stopped()
+        except Exception:
+            logger.exception('Creating pool instance %s failed', name)
+            self._set_status(name, None)
+            raise
+        self._set_status(name, 'ready')
+        _created.inc()
+        logger.info('Pool instance %s is ready', name)
+
+    def refill(self, config: NodeConfig, max_parallel=4) -> int:
+        # Creates missing instances for the pool configured by
+        # warm_pool_size and returns how many were created
+        names = self._reserve(config)
+        if not names:
+            return 0
+        logger.info('Refilling warm pool with %d instances', len(names))
+        with futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            results = [executor.submit(self._create, config, n) for n in names]
+        return sum(1 for f in results if not f.exception())
@@ -0,0 +1,226 @@
+import os
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+import contextvars
+
+from contextlib import contextmanager
+from typing import Dict
+
+from libcloud.common.google import GoogleBaseError
+from libcloud.common.exceptions import RateLimitReachedError
+
+from . import NodeError
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+# Every compute and DNS HTTP request goes through the ApiScheduler of its
+# project, see gce.schedule_requests(), so a driver method making several
+# requests takes a token for each. Requests take a token from the bucket of
+# their API and request class (GET is read) before they're sent; when the
+# API still answers with a rate-limit error the whole bucket is paused for
+# a jittered, exponentially growing delay and the request is retried.
+# Waiting requests are served by priority, so stops and DNS changes
+# overtake queued bulk creates.
+#
+# Buckets are per process. With the process job engine every worker has
+# its own, and the backoff is what keeps them within the project quota.
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+QUOTAS_ENV = 'RTESTNET_API_QUOTAS'
+
+# Requests per second; burst is twice the rate. Conservative defaults, set
+# RTESTNET_API_QUOTAS (e.g. "compute.read=50,compute.write=20") to match
+# the project's quotas. A rate of 0 disables throttling of that class.
+_DEFAULT_QUOTAS = {
+    'compute.read': 20.0,
+    'compute.write': 10.0,
+    'dns.read': 10.0,
+    'dns.write': 5.0,
+}
+
+_RATE_LIMIT_REASONS = {
+    'rateLimitExceeded',
+    'userRateLimitExceeded',
+    'RATE_LIMIT_EXCEEDED',
+}
+
+_throttle_wait = metrics.histogram(
+    'rtestnet_cloud_api_throttle_seconds',
+    'Time cloud API calls waited for a token'
+)
+_rate_limited = metrics.counter(
+    'rtestnet_cloud_api_rate_limited_total',
+    'Cloud API calls rejected with a rate-limit error'
+)
+
+_priority = contextvars.ContextVar('rtestnet_api_priority', default=NORMAL)
+
+
+class ApiSchedulerError(NodeError):
+    pass
+
+
+@contextmanager
+def priority(level: int):
+    # Calls made in this context, including steps submitted from it, are
+    # scheduled with the given priority
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def is_rate_limited(e: Exception) -> bool:
+    if isinstance(e, RateLimitReachedError):
+        return True
+    if isinstance(e, GoogleBaseError):
+        return e.http_code == 429 or (
+            e.http_code == 403 and e.code in _RATE_LIMIT_REASONS
+        )
+    return False
+
+
+def parse_quotas(spec: str) -> Dict[str, float]:
+    quotas = {}
+    for item in filter(None, (s.strip() for s in spec.split(','))):
+        try:
+            key, rate = item.split('=')
+            quotas[key.strip()] = float(rate)
+        except ValueError:
+            raise ApiSchedulerError(f'Invalid API quota "{item}"') from None
+    return quotas
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, 2 * rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+        else:
+            self._tokens = self.burst
+        self._updated = now
+
+    def acquire(self, priority: int = NORMAL) -> float:
+        # Blocks until a token is available and no waiter of higher priority
+        # (or the same priority that came earlier) is queued. Returns the
+        # time waited.
+        start = time.monotonic()
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] != entry:
+                        self._cond.wait()
+                        continue
+                    if now < self._paused_until:
+                        self._cond.wait(self._paused_until - now)
+                    elif self._tokens < 1:
+                        self._cond.wait((1 - self._tokens) / self.rate)
+                    else:
+                        self._tokens -= 1
+                        return now - start
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, delay: float):
+        # Holds all callers back after the API told us to slow down
+        with self._cond:
+            self._paused_until = max(
+                self._paused_until,
+                time.monotonic() + delay
+            )
+            self._tokens = 0
+            self._cond.notify_all()
+
+
+class ApiScheduler:
+    def __init__(
+        self,
+        quotas: Dict[str, float] = None,
+        max_retries: int = 8,
+        base_delay: float = 1.0,
+        max_delay: float = 64.0
+    ):
+        self.quotas = dict(_DEFAULT_QUOTAS)
+        self.quotas.update(quotas or {})
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if not bucket:
+                bucket = TokenBucket(self.quotas.get(key, 0))
+                self._buckets[key] = bucket
+            return bucket
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, so callers rejected together don't retry together
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2**attempt)
+        )
+
+    def call(self, api: str, request_class: str, fn, *args, **kwargs):
+        key = f'{api}.{request_class}'
+        bucket = self._bucket(key)
+        level = _priority.get()
+        for attempt in itertools.count():
+            waited = bucket.acquire(level)
+            if waited:
+                _throttle_wait.observe(waited, api=key)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                _rate_limited.inc(api=key)
+                logger.warning(
+                    '%s rate limited, backing off %.1fs (attempt %d)', key,
+                    delay, attempt + 1
+                )
+                bucket.pause(delay)
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(project: str) -> ApiScheduler:
+    # Quotas are per project, so are schedulers
+    with _schedulers_lock:
+        scheduler = _schedulers.get(project)
+        if not scheduler:
+            scheduler = ApiScheduler(
+                parse_quotas(os.environ.get(QUOTAS_ENV, ''))
+            )
+            _schedulers[project] = scheduler
+        return scheduler
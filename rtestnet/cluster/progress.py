@@ -0,0 +1,73 @@
+import os
+import json
+import threading
+import contextvars
+
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from . import ClusterError
+
+# Provisioning progress of a node operation, reported back to the
+# ClusterCtl running the job. The thread job engine installs a reporter
+# callback in the worker's context; a worker process gets the write end of
+# a pipe in RTESTNET_PROGRESS_FD and reports JSON lines to it. Without
+# either, reports go nowhere.
+#
+# Steps are also where a worker thread of a terminated job stops: the
+# thread job engine installs a cancellation check, and a step doesn't
+# start once it's true. A worker process is terminated by a signal.
+
+PROGRESS_FD_ENV = 'RTESTNET_PROGRESS_FD'
+
+_reporter = contextvars.ContextVar('rtestnet_progress', default=None)
+_cancelled = contextvars.ContextVar('rtestnet_cancelled', default=None)
+_fd = None
+_fd_lock = threading.Lock()
+
+if os.environ.get(PROGRESS_FD_ENV):
+    _fd = int(os.environ.pop(PROGRESS_FD_ENV))
+
+
+class StepCancelled(ClusterError):
+    pass
+
+
+def set_reporter(fn: Callable[[Dict], None]):
+    _reporter.set(fn)
+
+
+def set_cancel_check(fn: Callable[[], bool]):
+    _cancelled.set(fn)
+
+
+def report(step: str, status: str, **attrs):
+    global _fd
+    event = dict(attrs, step=step, status=status)
+    fn = _reporter.get()
+    if fn:
+        fn(event)
+        return
+    with _fd_lock:
+        if _fd is None:
+            return
+        try:
+            os.write(_fd, (json.dumps(event) + '\n').encode())
+        except OSError:
+            # The controller went away, the operation carries on
+            _fd = None
+
+
+@contextmanager
+def step(name: str, **attrs):
+    cancelled = _cancelled.get()
+    if cancelled and cancelled():
+        report(name, 'cancelled', **attrs)
+        raise StepCancelled(f'Cancelled before {name}')
+    report(name, 'started', **attrs)
+    try:
+        yield
+    except BaseException as e:
+        report(name, 'failed', error=type(e).__name__, **attrs)
+        raise
+    report(name, 'finished', **attrs)
@@ -0,0 +1,222 @@
+import json
+import asyncio
+import logging
+import reprlib
+
+from typing import Dict
+
+import aioredis
+
+from .common import CONTROL_CHANNEL, WORKER_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+_GROUP = 'workers'
+_LOCK_PREFIX = 'rtestnet:slot-lock:'
+_LATEST_PREFIX = 'rtestnet:slot-latest:'
+_LOCK_TTL_MS = 30000
+_LOCK_REFRESH = 10
+_LOCK_RETRY = 1
+# Messages left unacknowledged by a dead worker for this long are taken over
+_RECLAIM_IDLE_MS = 5 * 60 * 1000
+_RECLAIM_INTERVAL = 60
+# Approximate number of requests kept in the stream
+_STREAM_MAXLEN = 10000
+
+# Append the request and remember it as the latest one of its slot in one
+# step, so that concurrent API replicas agree on which request wins
+_PUBLISH_SCRIPT = '''
+local id = redis.call(
+    'XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*',
+    'key', ARGV[1], 'req', ARGV[2]
+)
+redis.call('SET', KEYS[2], id)
+return id
+'''
+
+# Also forgets the handled request as the latest one of its slot, so that a
+# redelivered copy of it is dropped instead of run again
+_RELEASE_SCRIPT = '''
+if redis.call('GET', KEYS[2]) == ARGV[2] then
+    redis.call('DEL', KEYS[2])
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+_REFRESH_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+
+def _str(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class RedisJobQueue:
+    def __init__(self, redis, stream=CONTROL_CHANNEL):
+        self.redis = redis
+        self.stream = stream
+
+    async def publish(self, key: str, req: Dict) -> str:
+        msg_id = await self.redis.eval(
+            _PUBLISH_SCRIPT,
+            keys=[self.stream, _LATEST_PREFIX + key],
+            args=[key, json.dumps(req), _STREAM_MAXLEN]
+        )
+        logger.debug('Published request for slot %s as %s', key, _str(msg_id))
+        return _str(msg_id)
+
+
+class RedisWorker:
+    # Consumes requests published by RedisJobQueue and runs them through a
+    # local ClusterCtl. A slot is held through a Redis lock for the whole
+    # job, so a node is never operated on by two workers at once. Requests
+    # that are no longer the latest one of their slot are dropped, and a
+    # running job whose request got superseded is terminated if the
+    # controller kills jobs, which mirrors what ClusterCtl does locally.
+
+    def __init__(
+        self, ctl, redis, name: str, max_jobs=16, stream=WORKER_CHANNEL
+    ):
+        self.ctl = ctl
+        self.redis = redis
+        self.name = name
+        self.stream = stream
+        self._slots = asyncio.Semaphore(max_jobs)
+
+    async def _create_group(self):
+        try:
+            await self.redis.xgroup_create(
+                self.stream, _GROUP, latest_id='0', mkstream=True
+            )
+        except aioredis.ReplyError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def _latest(self, key: str) -> str:
+        return _str(await self.redis.get(_LATEST_PREFIX + key))
+
+    async def _acquire(self, key: str, msg_id: str) -> bool:
+        token = f'{self.name}:{msg_id}'
+        while True:
+            if await self._latest(key) != msg_id:
+                return False
+            if await self.redis.set(
+                _LOCK_PREFIX + key,
+                token,
+                pexpire=_LOCK_TTL_MS,
+                exist=self.redis.SET_IF_NOT_EXIST
+            ):
+                return True
+            await asyncio.sleep(_LOCK_RETRY)
+
+    async def _release(self, key: str, msg_id: str):
+        await self.redis.eval(
+            _RELEASE_SCRIPT,
+            keys=[_LOCK_PREFIX + key, _LATEST_PREFIX + key],
+            args=[f'{self.name}:{msg_id}', msg_id]
+        )
+
+    async def _touch(self, msg_id: str):
+        # Resets the idle time of the pending request so that it isn't
+        # reclaimed while its job runs
+        await self.redis.execute(
+            'XCLAIM', self.stream, _GROUP, self.name, 0, msg_id, 'JUSTID'
+        )
+
+    async def _hold(self, key: str, msg_id: str, job):
+        terminated = False
+        while True:
+            await asyncio.sleep(_LOCK_REFRESH)
+            refreshed = await self.redis.eval(
+                _REFRESH_SCRIPT,
+                keys=[_LOCK_PREFIX + key],
+                args=[f'{self.name}:{msg_id}', _LOCK_TTL_MS]
+            )
+            if not refreshed:
+                logger.warning('Lost the lock of slot %s', key)
+            await self._touch(msg_id)
+            if (
+                not terminated and self.ctl.ctx.kill_jobs and job.worker and
+                await self._latest(key) != msg_id
+            ):
+                logger.debug('Request %s superseded, terminating job', msg_id)
+                job.worker.terminate()
+                terminated = True
+
+    async def _handle(self, msg_id: str, fields: Dict):
+        try:
+            key = _str(fields[b'key'])
+            req = json.loads(_str(fields[b'req']))
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('Received request %s: %s', msg_id, reprlib.repr(req))
+            if not await self._acquire(key, msg_id):
+                logger.debug('Dropping superseded request %s', msg_id)
+                return
+            try:
+                job = await self.ctl.dispatch(req)
+                holder = asyncio.create_task(self._hold(key, msg_id, job))
+                try:
+                    await asyncio.wait([job.done])
+                finally:
+                    holder.cancel()
+            finally:
+                await self._release(key, msg_id)
+        except Exception:
+            logger.exception('Failed to handle request %s', msg_id)
+        finally:
+            await self.redis.xack(self.stream, _GROUP, msg_id)
+            self._slots.release()
+
+    async def _spawn(self, msg_id, fields):
+        if not fields:
+            # Trimmed from the stream before it was handled
+            logger.warning('Dropping trimmed request %s', _str(msg_id))
+            await self.redis.xack(self.stream, _GROUP, msg_id)
+            return
+        await self._slots.acquire()
+        asyncio.create_task(self._handle(_str(msg_id), fields))
+
+    async def _reclaim(self):
+        while True:
+            try:
+                reply = await self.redis.execute(
+                    'XAUTOCLAIM', self.stream, _GROUP, self.name,
+                    _RECLAIM_IDLE_MS, '0-0'
+                )
+                for msg_id, kvs in reply[1]:
+                    fields = dict(zip(kvs[::2], kvs[1::2])) if kvs else None
+                    logger.info('Reclaimed request %s', _str(msg_id))
+                    await self._spawn(msg_id, fields)
+            except Exception:
+                logger.warning('Reclaiming requests failed', exc_info=True)
+            await asyncio.sleep(_RECLAIM_INTERVAL)
+
+    async def run(self):
+        await self._create_group()
+        # Requests delivered to this consumer before it was restarted
+        pending = await self.redis.xread_group(
+            _GROUP, self.name, [self.stream], latest_ids=['0']
+        )
+        for _, msg_id, fields in pending:
+            await self._spawn(msg_id, fields)
+        reclaimer = asyncio.create_task(self._reclaim())
+        try:
+            while True:
+                messages = await self.redis.xread_group(
+                    _GROUP,
+                    self.name, [self.stream],
+                    timeout=5000,
+                    count=1,
+                    latest_ids=['>']
+                )
+                for _, msg_id, fields in messages:
+                    await self._spawn(msg_id, fields)
+        finally:
+            reclaimer.cancel()
@@ -0,0 +1,98 @@
+import json
+import logging
+
+from concurrent import futures
+from typing import Dict, List, Tuple
+
+from schema import Schema, SchemaError, And, Or, Optional as Opt
+
+from . import ClusterError, ClusterContext
+
+_MANIFEST_SCHEMA = Schema(
+    {
+        'nodes': {
+            And(str, len): {
+                Opt('state', default='running'):
+                    Or('running', 'stopped', 'absent')
+            }
+        },
+        Opt('leader'): And(str, len),
+        Opt('concurrency'): And(int, lambda n: n > 0),
+    }
+)
+
+# GCE instance statuses in which the VM is, or is about to be, running
+_UP_STATUSES = ('PROVISIONING', 'STAGING', 'RUNNING')
+
+logger = logging.getLogger(__name__)
+
+
+class ReconcileError(ClusterError):
+    pass
+
+
+def validate_manifest(manifest: Dict) -> Dict:
+    try:
+        manifest = _MANIFEST_SCHEMA.validate(manifest)
+    except SchemaError as e:
+        raise ReconcileError('Invalid manifest: ' + str(e)) from e
+    leader = manifest.get('leader')
+    if leader and manifest['nodes'].get(leader, {}).get('state') != 'running':
+        raise ReconcileError(f'Leader "{leader}" must be a running node')
+    return manifest
+
+
+def load_manifest(ctx: ClusterContext) -> Dict:
+    try:
+        return validate_manifest(json.loads(ctx.manifest_file.read_text()))
+    except (OSError, ValueError) as e:
+        raise ReconcileError(
+            f'Could not read manifest "{ctx.manifest_file}"'
+        ) from e
+
+
+def observe(ctx: ClusterContext, nodes: List[str], max_workers=16):
+    # Imported here to keep libcloud out of processes that never reconcile
+    from .node import NodeContext, NodeCtl
+    from .node.ops import create_node_ops
+
+    ops = {}
+    for node in nodes:
+        node_ctx = NodeContext(ctx, node)
+        config = NodeCtl(node_ctx).load_config()
+        ops[node] = create_node_ops(node_ctx, config)
+    # On GCE the first lookup loads the zone inventory, the rest are served
+    # by it
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        observed = dict(
+            zip(ops, executor.map(lambda o: o.observe(), ops.values()))
+        )
+    boot = []
+    if ops:
+        boot = next(iter(ops.values())).get_dns_rec_data('boot')
+    return observed, boot
+
+
+def plan(manifest: Dict, observed: Dict, boot: List[str]) -> Tuple[List, Dict]:
+    reqs = []
+    for node, desired in manifest['nodes'].items():
+        state = desired['state']
+        vm = observed[node]['vm']
+        action, args = None, {}
+        if state == 'running' and vm not in _UP_STATUSES:
+            action = 'start'
+        elif state == 'stopped' and vm in _UP_STATUSES:
+            action = 'stop'
+        elif state == 'absent' and (vm or observed[node]['address']):
+            action, args = 'stop', {'clean': 'all'}
+        if action:
+            reqs.append({'node': node, 'action': action, 'args': args})
+
+    lead_req = None
+    leader = manifest.get('leader')
+    if leader:
+        addr = observed.get(leader, {}).get('address')
+        # A leader without an address gets one when it's started above
+        if not addr or boot != [addr]:
+            lead_req = {'node': leader, 'action': 'lead', 'args': {}}
+    return reqs, lead_req
@@ -0,0 +1,185 @@
+import json
+import time
+import asyncio
+import logging
+import urllib.error
+import urllib.request
+
+from concurrent import futures
+from typing import Dict, List
+
+from schema import Schema, SchemaError, And, Or, Use, Optional as Opt
+
+from . import ClusterError, ClusterContext
+
+_ROLLOUT_SCHEMA = Schema(
+    {
+        # All nodes by default
+        Opt('nodes'): [And(str, len)],
+        # The manifest's leader by default
+        Opt('leader'): And(str, len),
+        Opt('max_unavailable', default=1): And(int, lambda n: n > 0),
+        Opt('max_surge', default=0): And(int, lambda n: n >= 0),
+        Opt('health_timeout', default=600): And(Use(float), lambda n: n > 0),
+        # Restart started nodes even if nothing changed
+        Opt('force', default=False): bool,
+        Opt('args', default={}): {
+            Opt('clean'): Or('data', 'all'),
+            Opt('suspend'): Or('0', '1', 'false', 'true')
+        },
+    }
+)
+
+# Seconds between health polls of a wave
+_HEALTH_INTERVAL = 5
+# Timeout of a supervisor health request
+_HEALTH_REQUEST_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+class RolloutError(ClusterError):
+    pass
+
+
+def validate_request(rreq: Dict) -> Dict:
+    try:
+        return _ROLLOUT_SCHEMA.validate(rreq)
+    except SchemaError as e:
+        raise RolloutError('Invalid rollout request: ' + str(e)) from e
+
+
+def manifest_leader(ctx: ClusterContext) -> str:
+    from .reconcile import ReconcileError, load_manifest
+
+    try:
+        return load_manifest(ctx).get('leader')
+    except ReconcileError:
+        return None
+
+
+def find_changes(
+    ctx: ClusterContext, nodes: List[str], force=False, max_workers=16
+) -> Dict[str, List[str]]:
+    # Started nodes a restart would change, with what changes
+    from .node import NodeContext, NodeCtl
+
+    def changes(node):
+        return NodeCtl(NodeContext(ctx, node)).pending_changes()
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        found = dict(zip(nodes, executor.map(changes, nodes)))
+    affected = {}
+    for node, node_changes in found.items():
+        if node_changes or (force and node_changes is not None):
+            affected[node] = node_changes or ['forced']
+    return affected
+
+
+def plan_waves(
+    nodes: List[str],
+    serving: Dict[str, bool],
+    leader: str = None,
+    max_unavailable: int = 1,
+    max_surge: int = 0
+) -> List[List[str]]:
+    # Each wave takes at most max_unavailable serving nodes down. Nodes are
+    # restarted in place, so there are no extra instances to surge with;
+    # instead nodes that are down or unhealthy already, whose restart costs
+    # no capacity, go first and may fill max_surge more places in a wave.
+    # The leader goes last, alone.
+    down = [n for n in nodes if n != leader and not serving.get(n)]
+    up = [n for n in nodes if n != leader and serving.get(n)]
+    size = max_unavailable + max_surge
+    waves = []
+    while down or up:
+        wave = down[:size]
+        del down[:len(wave)]
+        taken = min(max_unavailable, size - len(wave))
+        wave += up[:taken]
+        del up[:taken]
+        waves.append(wave)
+    if leader in nodes:
+        waves.append([leader])
+    return waves
+
+
+class HealthCheck:
+    # Node health as reported to the supervisor at ctx.health_url, or, when
+    # there's none, whether the node's instance runs
+
+    def __init__(self, ctx: ClusterContext):
+        self.ctx = ctx
+
+    def _supervisor_state(self, node: str) -> Dict:
+        url = f'{self.ctx.health_url.rstrip("/")}/supervisor/nodes/{node}'
+        try:
+            with urllib.request.urlopen(
+                url, timeout=_HEALTH_REQUEST_TIMEOUT
+            ) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                logger.warning('Health of %s: HTTP %d', node, e.code)
+        except (OSError, ValueError) as e:
+            logger.warning('Health of %s: %s', node, e)
+        return None
+
+    def _instance_running(self, node: str) -> bool:
+        from .node import NodeContext, NodeCtl
+        from .node.ops import create_node_ops
+
+        node_ctx = NodeContext(self.ctx, node)
+        config = NodeCtl(node_ctx).load_config()
+        return create_node_ops(node_ctx, config).observe()['vm'] == 'RUNNING'
+
+    def _healthy(self, node: str, after: int) -> bool:
+        if not self.ctx.health_url:
+            return self._instance_running(node)
+        state = self._supervisor_state(node)
+        # Only a report newer than the mark counts. Marks are supervisor
+        # event seqs, so no clocks are compared across hosts.
+        return bool(
+            state and state.get('healthy') and
+            (after is None or state.get('healthy_seq', 0) > after)
+        )
+
+    def _mark(self, node: str) -> int:
+        state = self._supervisor_state(node)
+        return state.get('last_seq', 0) if state else 0
+
+    async def healthy(self, node: str, after: int = None) -> bool:
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(
+                None, self._healthy, node, after
+            )
+        except Exception:
+            logger.warning('Health of %s unknown', node, exc_info=True)
+            return False
+
+    async def marks(self, nodes: List[str]) -> Dict[str, int]:
+        # Positions in the supervisor's event stream to wait for health
+        # reports past, taken before the nodes are restarted
+        if not self.ctx.health_url:
+            return {}
+        loop = asyncio.get_event_loop()
+        marks = await asyncio.gather(
+            *[loop.run_in_executor(None, self._mark, n) for n in nodes]
+        )
+        return dict(zip(nodes, marks))
+
+    async def wait(
+        self, nodes: List[str], marks: Dict[str, int], timeout: float
+    ) -> List[str]:
+        # Returns the nodes that didn't become healthy in time
+        deadline = time.monotonic() + timeout
+        pending = list(nodes)
+        while True:
+            results = await asyncio.gather(
+                *[self.healthy(n, marks.get(n)) for n in pending]
+            )
+            pending = [n for n, ok in zip(pending, results) if not ok]
+            if not pending or time.monotonic() >= deadline:
+                return pending
+            await asyncio.sleep(_HEALTH_INTERVAL)
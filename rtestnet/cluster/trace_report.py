@@ -0,0 +1,98 @@
+import sys
+import json
+import argparse
+
+from collections import defaultdict
+from typing import Dict, List
+
+from .tracing import Span
+
+# Attributes telling spans of the same name apart: which provisioning step,
+# cloud method or kind of operation is slow. Job lines also show the
+# operation, which names the resource.
+_GROUP_ATTRS = ('step', 'api', 'method', 'kind')
+_DETAIL_ATTRS = _GROUP_ATTRS + ('operation', )
+
+
+def _load(path) -> List[Span]:
+    spans = []
+    with open(path) as f:
+        for line in f:
+            try:
+                spans.append(Span(**json.loads(line)))
+            except (ValueError, TypeError):
+                pass
+    return spans
+
+
+def _label(span: Span, attrs=_GROUP_ATTRS) -> str:
+    details = [str(span.attrs[a]) for a in attrs if a in span.attrs]
+    return ' '.join([span.name] + details)
+
+
+def _critical_path(span: Span, children: Dict) -> List[Span]:
+    # Walk back from the end of the span, always following the child that
+    # finished last before the current point in time
+    path = [span]
+    cursor = span.end
+    for child in sorted(children[span.span_id], key=lambda c: -c.end):
+        if child.end <= cursor:
+            path.extend(_critical_path(child, children))
+            cursor = child.start
+    return path
+
+
+def report(path, job=None, out=sys.stdout):
+    spans = _load(path)
+    children = defaultdict(list)
+    for s in spans:
+        children[s.parent_id].append(s)
+    roots = [
+        s for s in spans
+        if s.name == 'job' and (not job or s.attrs.get('job') == job)
+    ]
+    # Self time on the critical paths of all jobs, by label
+    breakdown = defaultdict(lambda: [0, 0.0])
+    for root in sorted(roots, key=lambda s: s.start):
+        total = root.end - root.start
+        attrs = ' '.join(f'{k}={v}' for k, v in root.attrs.items())
+        print(f'job {attrs} total={total:.3f}s', file=out)
+        path = _critical_path(root, children)
+        for s in path[1:]:
+            on_path = sum(
+                c.end - c.start for c in path if c.parent_id == s.span_id
+            )
+            own = (s.end - s.start) - on_path
+            share = 100 * (s.end - s.start) / total if total else 0
+            print(
+                f'  {s.start - root.start:8.3f}s {s.end - s.start:8.3f}s '
+                f'(self {own:7.3f}s, {share:5.1f}%) '
+                f'{_label(s, _DETAIL_ATTRS)}'
+                f'{" ERROR " + s.error if s.error else ""}',
+                file=out
+            )
+            breakdown[_label(s)][0] += 1
+            breakdown[_label(s)][1] += own
+    if len(roots) > 1:
+        print(f'critical path self time of {len(roots)} jobs', file=out)
+        for label, (count, own) in sorted(
+            breakdown.items(), key=lambda item: -item[1][1]
+        ):
+            print(
+                f'  {own:9.3f}s {count:6d}x {own / count:8.3f}s avg  {label}',
+                file=out
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print per-job critical path breakdown of a trace file'
+    )
+    parser.add_argument('trace_file', help='JSON lines written by tracing')
+    parser.add_argument('-j', '--job', help='Only show this job id')
+    args = parser.parse_args()
+    report(args.trace_file, args.job)
+
+
+if __name__ == '__main__':
+    main()
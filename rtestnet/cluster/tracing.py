@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import secrets
+import threading
+import contextvars
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from typing import Dict
+
+# Minimal span tracing. Spans are appended as JSON lines to the file named
+# by RTESTNET_TRACE_FILE (or set with configure()); tracing is off when no
+# file is configured. Context crosses process boundaries in the
+# TRACEPARENT environment variable using the W3C traceparent format.
+# python -m rtestnet.cluster.trace_report prints per-job breakdowns.
+
+TRACE_FILE_ENV = 'RTESTNET_TRACE_FILE'
+TRACEPARENT_ENV = 'TRACEPARENT'
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str = field(default_factory=lambda: secrets.token_hex(8))
+    parent_id: str = None
+    start: float = field(default_factory=time.time)
+    end: float = None
+    attrs: Dict = field(default_factory=dict)
+    error: str = None
+
+    @property
+    def traceparent(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+
+_current = contextvars.ContextVar('rtestnet_span', default=None)
+_fd = None
+_fd_lock = threading.Lock()
+
+
+def configure(path=None):
+    global _fd
+    path = path or os.environ.get(TRACE_FILE_ENV)
+    with _fd_lock:
+        if _fd is not None:
+            os.close(_fd)
+            _fd = None
+        if path:
+            _fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.environ[TRACE_FILE_ENV] = str(path)
+
+
+def enabled() -> bool:
+    return _fd is not None
+
+
+def _export(span: Span):
+    # One write per line on an O_APPEND descriptor, so lines from
+    # concurrent threads and processes don't interleave
+    line = (json.dumps(asdict(span)) + '\n').encode()
+    with _fd_lock:
+        if _fd is not None:
+            os.write(_fd, line)
+
+
+def current() -> Span:
+    return _current.get()
+
+
+def attach_traceparent(traceparent: str):
+    # Continue a trace started in another process
+    try:
+        _, trace_id, span_id, _ = traceparent.split('-')
+    except (AttributeError, ValueError):
+        return
+    _current.set(Span('remote', trace_id, span_id))
+
+
+def child_env(env=None) -> Dict:
+    env = dict(os.environ if env is None else env)
+    span = current()
+    if enabled() and span:
+        env[TRACEPARENT_ENV] = span.traceparent
+    return env
+
+
+@contextmanager
+def span(name: str, **attrs):
+    if not enabled():
+        yield None
+        return
+    parent = current()
+    s = Span(
+        name,
+        parent.trace_id if parent else secrets.token_hex(16),
+        parent_id=parent.span_id if parent else None,
+        attrs=attrs
+    )
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        s.end = time.time()
+        _export(s)
+
+
+configure()
@@ -0,0 +1,84 @@
+import os
+import socket
+import asyncio
+import argparse
+import logging
+
+from pathlib import Path
+
+from . import ClusterContext, ClusterCtl
+from .common import create_redis_from_env
+from .queue import RedisWorker
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Run cluster jobs published to the Redis control stream'
+    )
+
+    parser.add_argument(
+        '-d',
+        '--conf-dir',
+        default='.',
+        type=lambda x: Path(x),
+        help='Configuration directory'
+    )
+    parser.add_argument(
+        '-p',
+        '--private-dir',
+        default=None,
+        type=lambda x: Path(x),
+        help='Private directory (defaults to --conf-dir)'
+    )
+    parser.add_argument(
+        '-n',
+        '--name',
+        default=f'{socket.gethostname()}-{os.getpid()}',
+        help='Consumer name, unique among workers (defaults to host-pid)'
+    )
+    parser.add_argument(
+        '-j',
+        '--max-jobs',
+        default=16,
+        type=int,
+        help='Maximum number of jobs run concurrently'
+    )
+    parser.add_argument(
+        '-e',
+        '--job-engine',
+        default='thread',
+        choices=['process', 'thread'],
+        help='How node operations are executed'
+    )
+    parser.add_argument(
+        '-k',
+        '--kill-jobs',
+        action='store_true',
+        help='Terminate jobs whose request got superseded'
+    )
+
+    return parser
+
+
+async def run_with_args(args):
+    ctx = ClusterContext(
+        args.conf_dir,
+        args.private_dir,
+        kill_jobs=args.kill_jobs,
+        job_engine=args.job_engine,
+        job_workers=args.max_jobs
+    )
+    redis = await create_redis_from_env()
+    await RedisWorker(
+        ClusterCtl(ctx), redis, args.name, max_jobs=args.max_jobs
+    ).run()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = create_arg_parser().parse_args()
+    asyncio.run(run_with_args(args))
+
+
+if __name__ == '__main__':
+    main()
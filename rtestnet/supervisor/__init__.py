@@ -0,0 +1,5 @@
+class SupervisorError(Exception):
+    pass
+
+from .context import NetworkContext
+from .ctl import Supervisor
@@ -1,27 +1,94 @@
+import os
+import json
 import asyncio
 import traceback
 import logging
 
 from quart import Quart, request
 
-from . import ClusterError, ClusterContext, ClusterCtl
+from rtestnet.cluster import metrics
+
+from . import SupervisorError, NetworkContext, Supervisor
 
 logging.basicConfig(level=logging.DEBUG)
 
 CONFIG_DIR = '/home/woky/rchain/20wip/public-testnet/data/config'
 
+# Bodies larger than this are parsed off the event loop
+_INLINE_PARSE_MAX = 64 * 1024
+
 app = Quart(__name__)
-cluster = ClusterCtl(ClusterContext(CONFIG_DIR, kill_jobs=True))
+supervisor = Supervisor(
+    NetworkContext(
+        CONFIG_DIR, event_log=os.environ.get('RTESTNET_EVENT_LOG', 'file')
+    )
+)
+
+
+@app.before_serving
+async def start_supervisor():
+    await supervisor.start()
+
+
+@app.after_serving
+async def close_supervisor():
+    await supervisor.close()
 
-@app.route('/supervisor/notify/nodes/<node>/<event>', methods=['POST'])
-async def handle_node_notify(node, event):
 
-    req = {'node': node, 'action': action, 'args': request.args.to_dict()}
+async def _parse_body(body: bytes):
+    try:
+        if len(body) <= _INLINE_PARSE_MAX:
+            return json.loads(body)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, json.loads, body
+        )
+    except ValueError as e:
+        raise SupervisorError(f'Invalid JSON: {e}') from None
+
+
+@app.route('/metrics', methods=['GET'])
+async def handle_metrics():
+    return metrics.render(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4'
+    }
+
+
+@app.route('/supervisor/notify/nodes/<node>/<event>', methods=['POST'])
+async def handle_node_notify(*, node, event):
     try:
-        await cluster.dispatch(req)
+        body = await request.get_data()
+        data = await _parse_body(body) if body else request.args.to_dict()
+        await supervisor.ingest([{'node': node, 'event': event, 'data': data}])
         return '', 202
-    except ClusterError as e:
+    except SupervisorError as e:
         return str(e), 400
     except Exception as e:
         traceback.print_exc()
         return '', 500
+
+
+@app.route('/supervisor/notify/events', methods=['POST'])
+async def handle_events_notify():
+    # Batch of {"node": ..., "event": ..., "data": {...}} objects
+    try:
+        events = await _parse_body(await request.get_data())
+        count = await supervisor.ingest(events)
+        return {'accepted': count}, 202
+    except SupervisorError as e:
+        return str(e), 400
+    except Exception as e:
+        traceback.print_exc()
+        return '', 500
+
+
+@app.route('/supervisor/nodes', methods=['GET'])
+async def handle_nodes():
+    return supervisor.nodes()
+
+
+@app.route('/supervisor/nodes/<node>', methods=['GET'])
+async def handle_node(*, node):
+    try:
+        return supervisor.node_state(node)
+    except SupervisorError as e:
+        return str(e), 404
@@ -1,2 +1,28 @@
+from pathlib import Path
+from dataclasses import dataclass
+
+
+@dataclass
 class NetworkContext:
-    pass
+    conf_dir: Path
+    private_dir: Path = None
+    # 'file' appends events to event_log_file, 'redis' to the events stream
+    event_log: str = 'file'
+    # Upper bound of events accepted in one notify request
+    max_batch: int = 10000
+    # Events buffered for the log before ingestion waits for a flush
+    max_pending: int = 100000
+    # Entries kept in the Redis stream (approximately)
+    stream_max_len: int = 1000000
+    # Nodes not heard from for this many seconds are reported as stale
+    stale_after: float = 120
+
+    def __post_init__(self):
+        self.conf_dir = Path(self.conf_dir)
+        if not self.private_dir:
+            self.private_dir = self.conf_dir
+        self.private_dir = Path(self.private_dir)
+
+    @property
+    def event_log_file(self):
+        return self.private_dir / '_events.log'
@@ -0,0 +1,101 @@
+import time
+import logging
+
+from typing import Dict, List
+
+from rtestnet.cluster import metrics
+
+from . import SupervisorError, NetworkContext
+from .eventlog import create_event_log
+from .state import StateTable
+
+logger = logging.getLogger(__name__)
+
+_events_ingested = metrics.counter(
+    'rtestnet_supervisor_events_total', 'Node events ingested'
+)
+_nodes_tracked = metrics.gauge(
+    'rtestnet_supervisor_nodes', 'Nodes in the supervisor state table'
+)
+_log_pending = metrics.gauge(
+    'rtestnet_supervisor_log_pending', 'Events not yet written to the log'
+)
+
+
+class Supervisor:
+    # Ingests node events: each accepted batch is numbered, folded into the
+    # state table and handed to the event log, whose writes happen in the
+    # background. On start the table is rebuilt by replaying the log.
+
+    def __init__(self, ctx: NetworkContext):
+        self.ctx = ctx
+        self.table = StateTable()
+        self._log = None
+        self._seq = 0
+
+    async def start(self):
+        self._log = await create_event_log(self.ctx)
+        await self._log.replay(self._replay)
+        logger.info(
+            'Replayed %d events of %d nodes', self._seq, len(self.table)
+        )
+        await self._log.start()
+
+    async def close(self):
+        if self._log:
+            await self._log.close()
+
+    def _replay(self, event: Dict):
+        self._seq = max(self._seq, event['seq'])
+        self.table.apply(event)
+
+    def _validate(self, event) -> Dict:
+        # Plain checks rather than a Schema, this runs for every event
+        if not isinstance(event, dict):
+            raise SupervisorError('Event must be an object')
+        node = event.get('node')
+        name = event.get('event')
+        data = event.get('data', {})
+        if not isinstance(node, str) or not node:
+            raise SupervisorError('Event "node" must be a non-empty string')
+        if not isinstance(name, str) or not name:
+            raise SupervisorError('Event "event" must be a non-empty string')
+        if not isinstance(data, dict):
+            raise SupervisorError('Event "data" must be an object')
+        return {'node': node, 'event': name, 'data': data}
+
+    async def ingest(self, events: List[Dict]) -> int:
+        if not isinstance(events, list):
+            raise SupervisorError('Expected a list of events')
+        if len(events) > self.ctx.max_batch:
+            raise SupervisorError(
+                f'Batch of {len(events)} events exceeds {self.ctx.max_batch}'
+            )
+        # A batch is accepted or rejected as a whole
+        records = [self._validate(e) for e in events]
+        now = time.time()
+        for record in records:
+            self._seq += 1
+            record['seq'] = self._seq
+            record['ts'] = now
+            self.table.apply(record)
+        self._log.append(records)
+        _events_ingested.inc(len(records))
+        _nodes_tracked.set(len(self.table))
+        _log_pending.set(self._log.pending)
+        if self._log.pending > self.ctx.max_pending:
+            # Backpressure when the log can't keep up
+            await self._log.flush()
+        return len(records)
+
+    def node_state(self, node: str) -> Dict:
+        state = self.table.get(node)
+        if not state:
+            raise SupervisorError(f'Unknown node "{node}"')
+        return state.to_dict()
+
+    def nodes(self) -> Dict:
+        return {
+            'nodes': self.table.to_list(),
+            'stale': self.table.stale(self.ctx.stale_after),
+        }
@@ -0,0 +1,179 @@
+import abc
+import json
+import asyncio
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from . import SupervisorError, NetworkContext
+
+logger = logging.getLogger(__name__)
+
+EVENTS_STREAM = 'rtestnet:events'
+
+# Buffered events are written at least this often
+_FLUSH_INTERVAL = 0.05
+_REPLAY_CHUNK = 10000
+
+
+class EventLogError(SupervisorError):
+    pass
+
+
+class EventLog(abc.ABC):
+    # Append-only record of ingested events. append() only buffers, so
+    # ingestion never waits for I/O; a background task writes the buffer
+    # out in one batch per flush interval.
+
+    def __init__(self):
+        self._buffer = []
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._writing = 0
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer) + self._writing
+
+    def append(self, events: List[Dict]):
+        self._buffer.extend(events)
+        if len(self._buffer) >= 1000:
+            self._wakeup.set()
+
+    async def flush(self):
+        # Waits until what's buffered now has been written
+        while self._task and self.pending:
+            self._flushed.clear()
+            self._wakeup.set()
+            await self._flushed.wait()
+
+    @abc.abstractmethod
+    async def replay(self, apply):
+        # Calls apply with every logged event in order, before start()
+        pass
+
+    @abc.abstractmethod
+    async def _write(self, events: List[Dict]):
+        pass
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), _FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            events, self._buffer = self._buffer, []
+            self._writing = len(events)
+            try:
+                if events:
+                    await self._write(events)
+            except Exception:
+                # Kept in memory and retried with the next batch
+                logger.exception('Writing %d events failed', len(events))
+                self._buffer[:0] = events
+                await asyncio.sleep(1)
+            finally:
+                self._writing = 0
+            self._flushed.set()
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        await self.flush()
+        if self._task:
+            self._task.cancel()
+
+
+class FileEventLog(EventLog):
+    # JSON lines appended to a local file by a single writer thread
+
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = path
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='event-log'
+        )
+
+    def _read(self, apply):
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Torn last line of a crashed writer
+                        logger.warning('Skipping corrupt line in %s', self.path)
+                        continue
+                    apply(event)
+        except FileNotFoundError:
+            pass
+
+    def _append(self, data: bytes):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    async def replay(self, apply):
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._read, apply
+        )
+
+    async def _write(self, events):
+        data = ''.join(json.dumps(e) + '\n' for e in events).encode()
+        await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._append, data
+        )
+
+    async def close(self):
+        await super().close()
+        self._executor.shutdown()
+
+
+class RedisEventLog(EventLog):
+    # Events appended to a capped Redis stream with one pipelined round
+    # trip per batch
+
+    def __init__(self, redis, stream=EVENTS_STREAM, max_len=1000000):
+        super().__init__()
+        self.redis = redis
+        self.stream = stream
+        self.max_len = max_len
+
+    async def replay(self, apply):
+        start = '-'
+        while True:
+            entries = await self.redis.xrange(
+                self.stream, start=start, count=_REPLAY_CHUNK
+            )
+            for _, fields in entries:
+                apply(json.loads(fields[b'e']))
+            if len(entries) < _REPLAY_CHUNK:
+                return
+            ms, seq = entries[-1][0].decode().split('-')
+            start = f'{ms}-{int(seq) + 1}'
+
+    async def _write(self, events):
+        pipe = self.redis.pipeline()
+        for e in events:
+            pipe.xadd(
+                self.stream, {'e': json.dumps(e)},
+                max_len=self.max_len,
+                exact_len=False
+            )
+        await pipe.execute()
+
+
+async def create_event_log(ctx: NetworkContext) -> EventLog:
+    if ctx.event_log == 'file':
+        return FileEventLog(ctx.event_log_file)
+    if ctx.event_log == 'redis':
+        from rtestnet.cluster.common import create_redis_from_env
+        return RedisEventLog(
+            await create_redis_from_env(), max_len=ctx.stream_max_len
+        )
+    raise EventLogError(f'Unknown event log "{ctx.event_log}"')
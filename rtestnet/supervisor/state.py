@@ -0,0 +1,88 @@
+import time
+
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List
+
+# Lifecycle state implied by an event; other events only refresh last_seen
+_EVENT_STATES = {
+    'starting': 'starting',
+    'started': 'running',
+    'running': 'running',
+    'stopping': 'stopping',
+    'stopped': 'stopped',
+    'crashed': 'failed',
+    'failed': 'failed',
+}
+
+_EVENT_HEALTH = {
+    'healthy': True,
+    'started': True,
+    'unhealthy': False,
+    'starting': False,
+    'stopping': False,
+    'stopped': False,
+    'crashed': False,
+    'failed': False,
+}
+
+
+@dataclass
+class NodeState:
+    node: str
+    state: str = 'unknown'
+    healthy: bool = None
+    last_event: str = None
+    last_seen: float = None
+    last_seq: int = 0
+    # Seq of the last event that reported the node healthy
+    healthy_seq: int = 0
+    events: int = 0
+    data: Dict = field(default_factory=dict)
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class StateTable:
+    # Per-node state folded from the event stream. Applying an event and
+    # looking a node up are dict operations; nothing here scans the table
+    # except the listing methods.
+
+    def __init__(self):
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def apply(self, event: Dict):
+        node = event['node']
+        state = self._nodes.get(node)
+        if not state:
+            state = self._nodes[node] = NodeState(node)
+        # Replayed or reordered events don't roll state back
+        if event['seq'] <= state.last_seq:
+            return
+        name = event['event']
+        state.last_seq = event['seq']
+        state.last_event = name
+        state.last_seen = event['ts']
+        state.events += 1
+        state.state = _EVENT_STATES.get(name, state.state)
+        state.healthy = _EVENT_HEALTH.get(name, state.healthy)
+        if _EVENT_HEALTH.get(name):
+            state.healthy_seq = event['seq']
+        if event.get('data'):
+            state.data.update(event['data'])
+
+    def get(self, node: str) -> NodeState:
+        return self._nodes.get(node)
+
+    def to_list(self) -> List[Dict]:
+        return [s.to_dict() for s in self._nodes.values()]
+
+    def stale(self, max_age: float) -> List[str]:
+        deadline = time.time() - max_age
+        return [
+            s.node for s in self._nodes.values()
+            if s.last_seen is not None and s.last_seen < deadline
+        ]
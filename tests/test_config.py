@@ -0,0 +1,131 @@
+import os
+import json
+
+import pytest
+
+from rtestnet.cluster.node import NodeConfig
+from rtestnet.cluster.node import config as config_module
+from rtestnet.cluster.node.config import NodeConfigError
+
+_CONFIG = {
+    'gce_zone': 'zone-a',
+    'gce_machine_type': 'n1-standard-1',
+    'gce_boot_image': 'rnode',
+    'gce_vpc_net': 'default',
+    'gce_vpc_subnet': 'default',
+    'gce_tags': ['rnode'],
+    'gdns_zone': 'dns-zone',
+    'gdns_domain': 'example.',
+    'data_disk_size': 10,
+}
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    cache = config_module._ConfigCache()
+    monkeypatch.setattr(config_module, '_cache', cache)
+    return cache
+
+
+def _write(path, **kvs):
+    path.write_text(json.dumps(dict(_CONFIG, **kvs)))
+    return path
+
+
+def test_values_are_converted(tmp_path):
+    path = _write(
+        tmp_path / 'config.json',
+        data_disk_size='20',
+        warm_pool_size='2',
+        gce_inventory_ttl='5',
+        gce_operation_timeout='60',
+        rnode_config='a { b = 1 }'
+    )
+    config = NodeConfig.load(path)
+    assert config['data_disk_size'] == 20
+    assert config['warm_pool_size'] == 2
+    assert config['gce_inventory_ttl'] == 5.0
+    assert config['gce_operation_timeout'] == 60.0
+    # Checked, but kept as HOCON
+    assert config['rnode_config'] == 'a { b = 1 }'
+    assert config['backend'] == 'gce'
+
+
+def test_values_are_converted_for_validated_digests(tmp_path, cache):
+    path = _write(tmp_path / 'config.json', data_disk_size='20')
+    cache_file = tmp_path / 'cache.json'
+    NodeConfig.load(path, cache_file=cache_file)
+    cache._merged.clear()
+    assert NodeConfig.load(path, cache_file=cache_file)['data_disk_size'] == 20
+
+
+def test_invalid_hocon_is_rejected(tmp_path):
+    path = _write(tmp_path / 'config.json', rnode_config='a { b = ')
+    with pytest.raises(NodeConfigError):
+        NodeConfig.load(path)
+
+
+def test_cache_hit(tmp_path, cache):
+    path = _write(tmp_path / 'config.json')
+    first = NodeConfig.load(path)
+    first['data_disk_size'] = 99
+    # Callers get their own copy
+    assert NodeConfig.load(path)['data_disk_size'] == 10
+
+
+def test_cache_invalidated_by_size(tmp_path):
+    path = _write(tmp_path / 'config.json')
+    st = path.stat()
+    NodeConfig.load(path)
+    _write(path, data_disk_size=200)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert NodeConfig.load(path)['data_disk_size'] == 200
+
+
+def test_cache_invalidated_by_mtime(tmp_path):
+    path = _write(tmp_path / 'config.json')
+    st = path.stat()
+    NodeConfig.load(path)
+    # Same size
+    _write(path, data_disk_size=20)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert NodeConfig.load(path)['data_disk_size'] == 20
+
+
+def test_cache_invalidated_by_new_source(tmp_path):
+    path = _write(tmp_path / 'config.json')
+    override = tmp_path / 'override.json'
+    assert NodeConfig.load(path, override)['data_disk_size'] == 10
+    override.write_text(json.dumps({'data_disk_size': 30}))
+    assert NodeConfig.load(path, override)['data_disk_size'] == 30
+    override.unlink()
+    assert NodeConfig.load(path, override)['data_disk_size'] == 10
+
+
+def test_validated_digests_are_persisted(tmp_path, cache, monkeypatch):
+    path = _write(tmp_path / 'config.json', rnode_config='a = 1')
+    cache_file = tmp_path / 'cache.json'
+    NodeConfig.load(path, cache_file=cache_file)
+    checks = []
+    validate = config_module._validate
+    monkeypatch.setattr(
+        config_module, '_validate',
+        lambda kvs, check_hocon=True:
+        checks.append(check_hocon) or validate(kvs, check_hocon)
+    )
+    # A new process only has the cache file
+    monkeypatch.setattr(config_module, '_cache', config_module._ConfigCache())
+    NodeConfig.load(path, cache_file=cache_file)
+    assert checks == [False]
+
+
+def test_validated_digests_are_bounded(tmp_path, cache, monkeypatch):
+    monkeypatch.setattr(config_module, '_MAX_VALIDATED', 3)
+    path = tmp_path / 'config.json'
+    cache_file = tmp_path / 'cache.json'
+    for size in range(1, 6):
+        _write(path, data_disk_size=size)
+        os.utime(path, ns=(0, size))
+        NodeConfig.load(path, cache_file=cache_file)
+    assert len(cache._validated) == 3
+    assert len(json.loads(cache_file.read_text())['validated']) == 3
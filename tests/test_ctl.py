@@ -0,0 +1,179 @@
+import asyncio
+
+import pytest
+
+from rtestnet.cluster import ClusterContext, ClusterCtl, events
+from rtestnet.cluster import ctl as ctl_module
+from rtestnet.cluster.engine import JobEngine, Worker
+
+
+class FakeWorker(Worker):
+    def __init__(self, pid):
+        self.pid = pid
+        self.future = asyncio.get_running_loop().create_future()
+        self.terminated = False
+
+    @property
+    def returncode(self):
+        return self.future.result() if self.future.done() else None
+
+    async def wait(self):
+        return await asyncio.shield(self.future)
+
+    def terminate(self):
+        self.terminated = True
+
+
+class FakeEngine(JobEngine):
+    # Workers run until finish() is called for their node
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.workers = {}
+        self.spawned = []
+
+    async def spawn(self, req, on_progress=None, job_id=None, on_output=None):
+        worker = FakeWorker(len(self.spawned) + 1)
+        self.workers[req['node']] = worker
+        self.spawned.append((job_id, req))
+        return worker
+
+    def finish(self, node, returncode=0):
+        self.workers[node].future.set_result(returncode)
+
+
+def _ctl(tmp_path, **kwargs):
+    kwargs = dict({'journal_jobs': True, 'job_log_size': 0}, **kwargs)
+    ctl = ClusterCtl(ClusterContext(tmp_path, **kwargs))
+    ctl._engine = FakeEngine(ctl.ctx)
+    return ctl
+
+
+def _req(node, action='start', **args):
+    return {'node': node, 'action': action, 'args': args}
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_shutdown_leaves_jobs_to_recover(tmp_path):
+    async def main():
+        ctl = _ctl(tmp_path)
+        await ctl.recover()
+        running = await ctl.dispatch(_req('node0'))
+        finished = await ctl.dispatch(_req('node1'))
+        await _settle()
+        ctl._engine.finish('node1')
+        await finished.done
+        await ctl.close()
+        assert running.state == events.CANCELLED
+
+        ctl = _ctl(tmp_path)
+        recovered = await ctl.recover()
+        await _settle()
+        await ctl.close()
+        return running, recovered
+
+    running, recovered = asyncio.run(main())
+    assert [(j.id, j.req) for j in recovered] == [(running.id, running.req)]
+
+
+def test_superseded_jobs_are_not_recovered(tmp_path):
+    async def main():
+        ctl = _ctl(tmp_path)
+        await ctl.recover()
+        old = await ctl.dispatch(_req('node0'))
+        await _settle()
+        new = await ctl.dispatch(_req('node0', 'stop'))
+        await _settle()
+        await ctl.close()
+
+        ctl = _ctl(tmp_path)
+        recovered = await ctl.recover()
+        await ctl.close()
+        return old, new, recovered
+
+    old, new, recovered = asyncio.run(main())
+    assert old.state == events.CANCELLED
+    assert [j.id for j in recovered] == [new.id]
+
+
+def test_finished_jobs_are_evicted_behind_running_ones(tmp_path, monkeypatch):
+    monkeypatch.setattr(ctl_module, '_MAX_RECENT_JOBS', 10)
+
+    async def main():
+        ctl = _ctl(tmp_path, job_log_size=1024)
+        running = await ctl.dispatch(_req('node0'))
+        finished = []
+        for i in range(50):
+            job = await ctl.dispatch(_req(f'node{i + 1}'))
+            await _settle()
+            ctl._engine.finish(job.req['node'])
+            await job.done
+            finished.append(job)
+        await ctl.close()
+        return ctl, running, finished
+
+    ctl, running, finished = asyncio.run(main())
+    assert list(ctl._recent_jobs) == [running.id] + [
+        j.id for j in finished[-9:]
+    ]
+    assert all(j.log.closed for j in finished[:-9])
+
+
+@pytest.mark.parametrize(
+    'active, pending, new, result', [
+        # Served by the active job, the pending one is dropped
+        ('start', 'stop', 'start', 'active'),
+        ('restart', None, 'start', 'active'),
+        # Served by the pending job
+        ('stop', 'start', 'start', 'pending'),
+        ('stop', 'restart', 'start', 'pending'),
+        # Replaces the pending job or becomes it
+        ('stop', 'start', 'snapshot', 'new'),
+        ('start', None, 'stop', 'new'),
+    ]
+)
+def test_coalesce(tmp_path, active, pending, new, result):
+    async def main():
+        ctl = _ctl(tmp_path, coalesce_jobs=True)
+        active_job = await ctl.dispatch(_req('node0', active))
+        pending_job = None
+        if pending:
+            pending_job = await ctl.dispatch(_req('node0', pending))
+            assert active_job.next is pending_job
+        new_job = await ctl.dispatch(_req('node0', new))
+        jobs = {'active': active_job, 'pending': pending_job, 'new': new_job}
+        assert new_job is jobs[result]
+        if result == 'active':
+            assert active_job.next is None
+        else:
+            assert active_job.next is new_job
+        if pending_job and pending_job is not new_job:
+            assert pending_job.state == events.CANCELLED
+            assert pending_job.done.cancelled()
+        await ctl.close()
+
+    asyncio.run(main())
+
+
+def test_follow_up_runs_after_active_job(tmp_path):
+    async def main():
+        ctl = _ctl(tmp_path, coalesce_jobs=True)
+        active = await ctl.dispatch(_req('node0', 'start'))
+        await _settle()
+        await ctl.dispatch(_req('node0', 'stop'))
+        follow_up = await ctl.dispatch(_req('node0', 'restart'))
+        await _settle()
+        assert len(ctl._engine.spawned) == 1
+        ctl._engine.finish('node0')
+        await active.done
+        await _settle()
+        assert ctl._engine.spawned[-1] == (follow_up.id, follow_up.req)
+        ctl._engine.finish('node0')
+        assert await follow_up.done == 0
+        await ctl.close()
+
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+import sys
+import threading
+
+from pathlib import Path
+
+import pytest
+
+# The fake cloud lives with the benchmarks
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+
+import fake_cloud as fake
+
+from rtestnet.cluster.node.dns import DNSZone
+
+_ZONE = 'test-zone'
+_COMMITS = 'dns.ex_bulk_record_changes'
+
+
+@pytest.fixture
+def cloud():
+    return fake.FakeCloud()
+
+
+@pytest.fixture
+def zone(cloud):
+    return DNSZone(fake.FakeSession(cloud), _ZONE, batch_window=0.05)
+
+
+def _records(cloud):
+    return {
+        name: (r['ttl'], r['rrdatas'])
+        for (name, _), r in cloud.records.get(_ZONE, {}).items()
+    }
+
+
+def test_upsert_and_delete(cloud, zone):
+    zone.upsert('a.example', ['10.0.0.1'], 300)
+    assert _records(cloud) == {'a.example.': (300, ['10.0.0.1'])}
+    assert zone.get('a.example.')['rrdatas'] == ['10.0.0.1']
+
+    zone.upsert('a.example', ['10.0.0.2'], 60)
+    assert _records(cloud) == {'a.example.': (60, ['10.0.0.2'])}
+
+    zone.delete('a.example')
+    assert _records(cloud) == {}
+    assert zone.get('a.example') is None
+    assert cloud.calls[_COMMITS] == 3
+
+
+def test_unchanged_records_are_not_committed(cloud, zone):
+    zone.upsert('a.example', ['10.0.0.1'], 300)
+    zone.upsert('a.example.', ['10.0.0.1'], 300)
+    zone.delete('b.example')
+    assert cloud.calls[_COMMITS] == 1
+
+
+def test_diff(zone):
+    zone.upsert('a.example', ['10.0.0.1'], 300)
+    zone.upsert('b.example', ['10.0.0.2'], 300)
+    a = zone.get('a.example')
+    b = zone.get('b.example')
+    additions, deletions = zone._diff({
+        ('a.example.', 'A'): {'ttl': 300, 'rrdatas': ['10.0.0.1']},
+        ('b.example.', 'A'): {'ttl': 300, 'rrdatas': ['10.0.0.3']},
+        ('c.example.', 'A'): {'ttl': 60, 'rrdatas': ['10.0.0.4']},
+        ('d.example.', 'A'): None,
+    })
+    assert deletions == [b]
+    assert additions == [
+        dict(b, rrdatas=['10.0.0.3']), {
+            'name': 'c.example.',
+            'type': 'A',
+            'ttl': 60,
+            'rrdatas': ['10.0.0.4']
+        }
+    ]
+    additions, deletions = zone._diff({('a.example.', 'A'): None})
+    assert (additions, deletions) == ([], [a])
+
+
+def test_concurrent_changes_are_batched(cloud):
+    # Long enough a window for all threads to join
+    zone = DNSZone(fake.FakeSession(cloud), _ZONE, batch_window=0.5)
+    # Loaded before, so that the batch is the only call
+    zone.get('x.example')
+    threads = [
+        threading.Thread(
+            target=zone.upsert, args=(f'n{i}.example', [f'10.0.0.{i}'], 300)
+        ) for i in range(20)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(_records(cloud)) == 20
+    assert cloud.calls[_COMMITS] == 1
+
+
+def test_conflict_is_retried_with_fresh_index(cloud, zone):
+    zone.upsert('a.example', ['10.0.0.1'], 300)
+    # Changed behind the index's back
+    cloud.records[_ZONE][('a.example.', 'A')]['rrdatas'] = ['10.0.0.9']
+    zone.upsert('a.example', ['10.0.0.2'], 300)
+    assert _records(cloud) == {'a.example.': (300, ['10.0.0.2'])}
+    assert cloud.calls[_COMMITS] == 3
@@ -0,0 +1,57 @@
+import json
+import os
+
+from pyhocon import ConfigFactory
+
+from rtestnet.cluster import ClusterContext
+from rtestnet.cluster.node import NodeContext, NodeConfig
+from rtestnet.cluster.node.files import NodeFiles
+
+
+def _setup(tmp_path, n):
+    (tmp_path / 'rnode.conf').write_text('rnode { a = 1, b { c = 2 } }')
+    ctx = ClusterContext(tmp_path)
+    configs = {}
+    for i in range(n):
+        (tmp_path / f'node{i}').mkdir()
+        configs[NodeContext(ctx, f'node{i}')] = NodeConfig(0, {})
+    return configs
+
+
+def test_batch_parses_defaults_once(tmp_path, monkeypatch):
+    configs = _setup(tmp_path, 20)
+    (tmp_path / 'node3' / 'rnode.override.conf').write_text('rnode.a = 3')
+    parsed = []
+    parse_file = ConfigFactory.parse_file
+
+    def counting_parse_file(path, *args, **kwargs):
+        parsed.append(path)
+        return parse_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(ConfigFactory, 'parse_file', counting_parse_file)
+    changed = NodeFiles.update_rnode_confs(configs)
+    assert all(changed.values())
+    assert sorted(parsed) == sorted([
+        str(tmp_path / 'rnode.conf'),
+        str(tmp_path / 'node3' / 'rnode.override.conf')
+    ])
+    rendered = json.loads((tmp_path / 'node3' / 'rnode.conf').read_text())
+    assert rendered == {'rnode': {'a': 3, 'b': {'c': 2}}}
+    rendered = json.loads((tmp_path / 'node0' / 'rnode.conf').read_text())
+    assert rendered == {'rnode': {'a': 1, 'b': {'c': 2}}}
+
+
+def test_batch_skips_unchanged_files(tmp_path):
+    configs = _setup(tmp_path, 5)
+    NodeFiles.update_rnode_confs(configs)
+    inodes = [
+        (tmp_path / f'node{i}' / 'rnode.conf').stat().st_ino for i in range(5)
+    ]
+    # Touched, not changed
+    os.utime(tmp_path / 'rnode.conf', ns=(1, 1))
+    assert not any(NodeFiles.update_rnode_confs(configs).values())
+    assert inodes == [
+        (tmp_path / f'node{i}' / 'rnode.conf').stat().st_ino for i in range(5)
+    ]
+    (tmp_path / 'rnode.conf').write_text('rnode { a = 2 }')
+    assert all(NodeFiles.update_rnode_confs(configs).values())
@@ -0,0 +1,181 @@
+import time
+import shutil
+import socket
+import asyncio
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+import aioredis
+
+from rtestnet.cluster import queue
+from rtestnet.cluster.queue import RedisJobQueue, RedisWorker
+
+pytestmark = pytest.mark.skipif(
+    not shutil.which('redis-server'), reason='redis-server not installed'
+)
+
+_STREAM = 'test-control'
+
+
+@pytest.fixture
+def redis_url():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(
+        [
+            'redis-server', '--port', str(port), '--save', '',
+            '--appendonly', 'no'
+        ],
+        stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    yield f'redis://127.0.0.1:{port}/0'
+    server.terminate()
+    server.wait()
+
+
+@pytest.fixture
+def fast_timers(monkeypatch):
+    monkeypatch.setattr(queue, '_LOCK_REFRESH', 0.05)
+    monkeypatch.setattr(queue, '_LOCK_RETRY', 0.05)
+    monkeypatch.setattr(queue, '_RECLAIM_IDLE_MS', 300)
+    monkeypatch.setattr(queue, '_RECLAIM_INTERVAL', 0.1)
+
+
+class FakeCtl:
+    # Records dispatched requests; each job takes duration seconds
+
+    def __init__(self, duration=0):
+        self.ctx = SimpleNamespace(kill_jobs=False)
+        self.duration = duration
+        self.dispatched = []
+        self.running = 0
+        self.max_running = 0
+
+    async def dispatch(self, req):
+        self.dispatched.append(req)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        done = asyncio.get_running_loop().create_future()
+
+        def finish():
+            self.running -= 1
+            done.set_result(0)
+
+        asyncio.get_running_loop().call_later(self.duration, finish)
+        return SimpleNamespace(done=done, worker=None)
+
+
+async def _run_worker(redis_url, ctl, name, duration):
+    redis = await aioredis.create_redis(redis_url)
+    worker = RedisWorker(ctl, redis, name, stream=_STREAM)
+    task = asyncio.create_task(worker.run())
+    await asyncio.sleep(duration)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    redis.close()
+    await redis.wait_closed()
+
+
+def _req(node, action='start'):
+    return {'node': node, 'action': action, 'args': {}}
+
+
+async def _publish(redis_url, *reqs):
+    redis = await aioredis.create_redis(redis_url)
+    jobs = RedisJobQueue(redis, stream=_STREAM)
+    for req in reqs:
+        await jobs.publish(req['node'], req)
+    redis.close()
+    await redis.wait_closed()
+
+
+def test_superseded_requests_are_dropped(redis_url, fast_timers):
+    async def main():
+        await _publish(
+            redis_url, _req('node0'), _req('node0', 'stop'), _req('node1')
+        )
+        ctl = FakeCtl()
+        await _run_worker(redis_url, ctl, 'w1', 0.5)
+        return ctl
+
+    ctl = asyncio.run(main())
+    assert sorted((r['node'], r['action']) for r in ctl.dispatched) == [
+        ('node0', 'stop'), ('node1', 'start')
+    ]
+
+
+def test_slot_is_exclusive_across_workers(redis_url, fast_timers):
+    async def main():
+        ctl = FakeCtl(duration=0.3)
+        workers = asyncio.gather(
+            _run_worker(redis_url, ctl, 'w1', 1.5),
+            _run_worker(redis_url, ctl, 'w2', 1.5)
+        )
+        await asyncio.sleep(0.2)
+        await _publish(redis_url, _req('node0'))
+        await asyncio.sleep(0.05)
+        await _publish(redis_url, _req('node0', 'stop'))
+        await workers
+        return ctl
+
+    ctl = asyncio.run(main())
+    assert ctl.max_running == 1
+    assert ctl.dispatched[-1]['action'] == 'stop'
+
+
+def test_long_job_is_not_reclaimed(redis_url, fast_timers):
+    # The job outlives the reclaim idle time several times over
+    async def main():
+        await _publish(redis_url, _req('node0'))
+        ctl = FakeCtl(duration=1.5)
+        await _run_worker(redis_url, ctl, 'w1', 2.5)
+        return ctl
+
+    ctl = asyncio.run(main())
+    assert len(ctl.dispatched) == 1
+
+
+def test_requests_of_dead_worker_are_reclaimed(redis_url, fast_timers):
+    async def main():
+        await _publish(redis_url, _req('node0'))
+        redis = await aioredis.create_redis(redis_url)
+        dead = RedisWorker(FakeCtl(), redis, 'dead', stream=_STREAM)
+        await dead._create_group()
+        # Delivered, never handled
+        await redis.xread_group(
+            queue._GROUP, 'dead', [_STREAM], count=1, latest_ids=['>']
+        )
+        redis.close()
+        await redis.wait_closed()
+        await asyncio.sleep(0.4)
+        ctl = FakeCtl()
+        await _run_worker(redis_url, ctl, 'w1', 0.5)
+        return ctl
+
+    ctl = asyncio.run(main())
+    assert len(ctl.dispatched) == 1
+
+
+def test_stream_is_trimmed(redis_url, monkeypatch):
+    monkeypatch.setattr(queue, '_STREAM_MAXLEN', 100)
+
+    async def main():
+        await _publish(redis_url, *[_req(f'node{i}') for i in range(1000)])
+        redis = await aioredis.create_redis(redis_url)
+        length = await redis.xlen(_STREAM)
+        redis.close()
+        await redis.wait_closed()
+        return length
+
+    assert asyncio.run(main()) < 1000
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from rtestnet.cluster import ClusterContext
+from rtestnet.cluster.node import NodeContext, NodeCtl, NodeFiles
+from rtestnet.cluster.rollout import find_changes, plan_waves
+
+_CONFIG = {
+    'gce_zone': 'zone-a',
+    'gce_machine_type': 'n1-standard-1',
+    'gce_boot_image': 'rnode',
+    'gce_vpc_net': 'default',
+    'gce_vpc_subnet': 'default',
+    'gce_tags': ['rnode'],
+    'gdns_zone': 'dns-zone',
+    'gdns_domain': 'example.',
+    'data_disk_size': 10,
+}
+
+
+@pytest.mark.parametrize(
+    'serving, leader, max_unavailable, max_surge, waves', [
+        # One serving node down at a time, the leader last
+        ('abcd', 'a', 1, 0, [['b'], ['c'], ['d'], ['a']]),
+        ('abcd', None, 2, 0, [['a', 'b'], ['c', 'd']]),
+        # Nodes that are down already go first and fill surge places
+        ('ab', None, 1, 1, [['c', 'd'], ['a'], ['b']]),
+        ('ab', None, 1, 2, [['c', 'd', 'a'], ['b']]),
+        ('', 'd', 2, 0, [['a', 'b'], ['c'], ['d']]),
+    ]
+)
+def test_plan_waves(serving, leader, max_unavailable, max_surge, waves):
+    nodes = ['a', 'b', 'c', 'd']
+    assert plan_waves(
+        nodes, {n: n in serving for n in nodes}, leader, max_unavailable,
+        max_surge
+    ) == waves
+
+
+def test_plan_waves_without_leader_in_nodes():
+    assert plan_waves(['a', 'b'], {'a': True, 'b': True}, 'x') == [
+        ['a'], ['b']
+    ]
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    (tmp_path / 'config.json').write_text(json.dumps(_CONFIG))
+    (tmp_path / 'rnode.conf').write_text('rnode { a = 1 }')
+    ctx = ClusterContext(tmp_path)
+    for node in ('started', 'stopped'):
+        (tmp_path / node).mkdir()
+    _start(ctx, 'started')
+    return ctx
+
+
+def _start(ctx, node):
+    # What NodeCtl.start() leaves behind, without the cloud
+    node_ctx = NodeContext(ctx, node)
+    config = NodeCtl(node_ctx).load_config(with_state=False)
+    NodeFiles(node_ctx, config).update()
+    config.save(node_ctx.config_state_file)
+
+
+def test_find_changes_unchanged(cluster):
+    assert find_changes(cluster, ['started', 'stopped']) == {}
+
+
+def test_find_changes_forced(cluster):
+    # Only started nodes are restarted
+    assert find_changes(cluster, ['started', 'stopped'], force=True) == {
+        'started': ['forced']
+    }
+
+
+def test_find_changes_config(cluster):
+    override = cluster.conf_dir / 'started' / 'config.json'
+    override.write_text(json.dumps({'data_disk_size': 20}))
+    assert find_changes(cluster, ['started', 'stopped']) == {
+        'started': ['config']
+    }
+
+
+def test_find_changes_rnode_conf(cluster):
+    (cluster.conf_dir / 'rnode.conf').write_text('rnode { a = 2 }')
+    assert find_changes(cluster, ['started', 'stopped']) == {
+        'started': ['rnode.conf']
+    }